@@ -0,0 +1,247 @@
+import asyncio
+import inspect
+import json
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from feedback import metrics
+
+def estimate_tokens(text):
+    """Roughly estimate the number of tokens in a piece of text
+
+    Arguments:
+        text: String, text sent to the LLM
+
+    Returns: Integer, approximate token count (about 4 characters per token)"""
+
+    return len(text)//4 + 1
+
+class RateLimiter:
+    """Sliding-window limiter that keeps requests and tokens per minute
+        under a budget"""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, window=60):
+        """Create a rate limiter
+
+        Arguments:
+            requests_per_minute: Integer or None, maximum requests per window
+            tokens_per_minute: Integer or None, maximum tokens per window
+            window: Float, length of the window in seconds"""
+
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self.history = deque()
+        self.tokens_in_window = 0
+
+    def _expire(self, now):
+        while self.history and now - self.history[0][0] >= self.window:
+            _, tokens = self.history.popleft()
+            self.tokens_in_window -= tokens
+
+    def _has_room(self, tokens):
+        if self.requests_per_minute is not None and len(self.history) >= self.requests_per_minute:
+            return False
+        if self.tokens_per_minute is not None and len(self.history) > 0 \
+                and self.tokens_in_window + tokens > self.tokens_per_minute:
+            return False
+        return True
+
+    async def acquire(self, tokens):
+        """Wait until a request with a given number of tokens fits in the budget
+
+        Arguments:
+            tokens: Integer, number of tokens the request is expected to use
+
+        Returns: Nothing
+
+        Side Effects: Records the request in the sliding window"""
+
+        while True:
+            now = time.monotonic()
+            self._expire(now)
+            if self._has_room(tokens):
+                self.history.append((now, tokens))
+                self.tokens_in_window += tokens
+                return
+            await asyncio.sleep(max(self.window - (now - self.history[0][0]), 0.01))
+
+def is_async_client(client):
+    """Whether a client's calls are coroutines, as AsyncOpenAI's are
+
+    Arguments:
+        client: OpenAI or AsyncOpenAI client
+
+    Returns: Boolean"""
+
+    # The SDK wraps its methods, so look through the wrapper
+    return inspect.iscoroutinefunction(inspect.unwrap(client.chat.completions.create))
+
+def parse_json_output(content):
+    """Parse a model's JSON output, also when the model wraps it in other
+        text, as some Together models do with a <think> block or a code fence
+
+    Arguments:
+        content: String, the message content of the response
+
+    Returns: Parsed JSON
+
+    Raises: json.JSONDecodeError if the content holds no JSON object"""
+
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        # Reasoning may contain braces of its own
+        stripped = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
+        match = re.search(r'\{.*\}', stripped, re.DOTALL)
+        if match is None:
+            raise
+        return json.loads(match.group(0))
+
+async def call_model(client, model_name, content):
+    """Make a single chat completion call, with either a sync or async client
+
+    Arguments:
+        client: OpenAI or AsyncOpenAI client
+        model_name: String, name of the model
+        content: String, the full prompt
+
+    Returns: OpenAI chat completion response"""
+
+    kwargs = {
+        'model': model_name.replace("_self_reflection",""),
+        'messages': [{"role": "user", "content": content}],
+        'response_format': {"type": "json_object"},
+    }
+    if is_async_client(client):
+        return await client.chat.completions.create(**kwargs)
+    # Sync clients run on the default thread pool
+    return await asyncio.to_thread(client.chat.completions.create, **kwargs)
+
+async def run_requests_async(client, requests, model_name, max_concurrency=16,
+                             requests_per_minute=None, tokens_per_minute=None,
+                             expected_output_tokens=100, usage=None, retry=None, on_result=None):
+    """Run a list of LLM requests concurrently under a rate-limit budget
+
+    Arguments:
+        client: OpenAI or AsyncOpenAI client
+        requests: List of dictionaries, each with a 'key' and 'content', and
+            optionally the 'task' its usage is recorded under
+        model_name: String, name of the model
+        max_concurrency: Integer, maximum number of calls in flight
+        requests_per_minute: Integer or None, request budget
+        tokens_per_minute: Integer or None, token budget
+        expected_output_tokens: Integer, output tokens budgeted per call
+        usage: UsageTracker or None, records the tokens and latency of each call
+        retry: RetryPolicy or None, retries failed calls with backoff
+        on_result: Function or None, called with the key and parsed output
+            of each request as soon as it succeeds
+
+    Returns: Tuple of (dictionary mapping key to parsed JSON output,
+        dictionary of run statistics, including 'errors', mapping the key
+        of each failed request to its error)"""
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    results = {}
+    stats = {'requests': len(requests), 'succeeded': 0, 'failed': 0, 'total_tokens': 0, 'errors': {}}
+    retries_before = retry.retries if retry is not None else 0
+
+    async def attempt(request):
+        # Every attempt, retries included, spends from the budget
+        await limiter.acquire(estimate_tokens(request['content']) + expected_output_tokens)
+        call_start = time.perf_counter()
+        response = await call_model(client, model_name, request['content'])
+        seconds = time.perf_counter() - call_start
+        if usage is not None:
+            usage.record(request.get('task'), getattr(response, 'usage', None), seconds)
+        metrics.record_llm_call(model_name, request.get('task'), getattr(response, 'usage', None), seconds)
+        # Parsed here, so a malformed response is retried like a failed call
+        return response, parse_json_output(response.choices[0].message.content)
+
+    async def run_one(request):
+        async with semaphore:
+            try:
+                if retry is not None:
+                    response, results[request['key']] = await retry.call_async(attempt, request)
+                else:
+                    response, results[request['key']] = await attempt(request)
+                stats['succeeded'] += 1
+                if on_result is not None:
+                    on_result(request['key'], results[request['key']])
+                if getattr(response, 'usage', None) is not None:
+                    stats['total_tokens'] += response.usage.total_tokens
+            except Exception as e:
+                stats['failed'] += 1
+                stats['errors'][request['key']] = e
+                metrics.increment('llm_calls', model=model_name, task=request.get('task') or 'unknown', status='error')
+                print(f"Error processing request {request['key']}: {e}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_one(r) for r in requests])
+    stats['wall_time'] = time.perf_counter() - start
+    stats['requests_per_second'] = stats['requests']/max(stats['wall_time'], 1e-9)
+    stats['tokens_per_second'] = stats['total_tokens']/max(stats['wall_time'], 1e-9)
+    stats['retries'] = (retry.retries if retry is not None else 0) - retries_before
+
+    return results, stats
+
+def run_requests(client, requests, model_name, close_client=False, **kwargs):
+    """Synchronous wrapper around run_requests_async
+        Falls back to a worker thread when an event loop is already running
+        (e.g. inside a Jupyter notebook)
+
+    Arguments:
+        client: OpenAI or AsyncOpenAI client
+        requests: List of dictionaries, each with a 'key' and 'content'
+        model_name: String, name of the model
+        close_client: Boolean, whether to close an async client at the end
+            of the run; pass True when handing over a client created for this
+            run alone, since its connections belong to the event loop the run
+            creates and can't be reused after it
+        kwargs: Passed on to run_requests_async
+
+    Returns: Tuple of (dictionary mapping key to parsed JSON output,
+        dictionary of run statistics)"""
+
+    async def run_and_close():
+        try:
+            return await run_requests_async(client, requests, model_name, **kwargs)
+        finally:
+            if close_client and is_async_client(client):
+                await client.close()
+
+    return run_coroutine(run_and_close())
+
+def run_coroutine(coroutine):
+    """Run a coroutine to completion from synchronous code, in a worker
+        thread when an event loop is already running
+
+    Arguments:
+        coroutine: Coroutine to run
+
+    Returns: The coroutine's result"""
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+def print_run_stats(stats):
+    """Print a one-line summary of a concurrent run
+
+    Arguments:
+        stats: Dictionary, returned by run_requests
+
+    Returns: Nothing
+
+    Side Effects: Prints wall-clock time and throughput"""
+
+    print("Ran {} requests ({} failed, {} retries) in {:.1f}s: {:.2f} requests/s, {:.1f} tokens/s".format(
+        stats['requests'], stats['failed'], stats.get('retries', 0), stats['wall_time'],
+        stats['requests_per_second'], stats['tokens_per_second']))
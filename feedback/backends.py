@@ -0,0 +1,145 @@
+import os
+
+import openai
+
+# Backend name -> class, and model name prefix -> backend name
+backends = {}
+model_prefixes = {}
+
+def register_backend(name, prefixes=()):
+    """Class decorator that registers a model backend, so new backends are
+        added without editing the classification code
+
+    Arguments:
+        name: String, name of the backend (e.g. 'openai')
+        prefixes: Tuple of model name prefixes served by this backend
+
+    Returns: Decorator"""
+
+    def decorator(backend_class):
+        backend_class.name = name
+        backends[name] = backend_class
+        for prefix in prefixes:
+            model_prefixes[prefix] = name
+        return backend_class
+    return decorator
+
+class ModelBackend:
+    """Interface for a model provider: sync and async chat clients, and a
+        client for Batch API submission, all shaped like the OpenAI SDK's"""
+
+    name = None
+    supports_batch = False
+
+    def get_client(self, max_retries=2):
+        """Client with chat.completions.create, for serial calls
+            max_retries is the client's own retries; 0 leaves them to a RetryPolicy"""
+        raise NotImplementedError
+
+    def get_async_client(self, max_retries=2):
+        """Client with an async chat.completions.create, for concurrent calls"""
+        raise NotImplementedError
+
+    def get_batch_client(self):
+        """Client with files and batches, for Batch API submission"""
+        if not self.supports_batch:
+            raise Exception("Backend {} does not support batch submission".format(self.name))
+        return self.get_client()
+
+@register_backend('openai', prefixes=('gpt', 'o1', 'o3', 'o4'))
+class OpenAIBackend(ModelBackend):
+    """The OpenAI API"""
+
+    supports_batch = True
+
+    def __init__(self, api_key=None):
+        """Arguments:
+            api_key: String or None, defaults to OPENAI_API_KEY"""
+
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+
+    def get_client(self, max_retries=2):
+        return openai.OpenAI(api_key=self.api_key, max_retries=max_retries)
+
+    def get_async_client(self, max_retries=2):
+        return openai.AsyncOpenAI(api_key=self.api_key, max_retries=max_retries)
+
+@register_backend('openai_compatible')
+class OpenAICompatibleBackend(ModelBackend):
+    """Any HTTP endpoint that implements the OpenAI chat completions API,
+        e.g. vLLM, Ollama or a hosted provider"""
+
+    base_url_variable = "OPENAI_COMPATIBLE_BASE_URL"
+    api_key_variable = "OPENAI_COMPATIBLE_API_KEY"
+    default_base_url = None
+
+    def __init__(self, base_url=None, api_key=None, supports_batch=None, timeout=None):
+        """Arguments:
+            base_url: String or None, e.g. http://localhost:8000/v1; defaults
+                to the backend's environment variable
+            api_key: String or None, defaults to the backend's environment variable
+            supports_batch: Boolean or None, whether the endpoint implements
+                files and batches; defaults to the backend's setting
+            timeout: Float or None, request timeout in seconds"""
+
+        self.base_url = base_url or os.environ.get(self.base_url_variable, self.default_base_url)
+        if self.base_url is None:
+            raise Exception("Set {} or pass base_url for backend {}".format(self.base_url_variable, self.name))
+        # The SDK requires a key even when the endpoint ignores it
+        self.api_key = api_key or os.environ.get(self.api_key_variable) or "none"
+        if supports_batch is not None:
+            self.supports_batch = supports_batch
+        self.timeout = timeout
+
+    def get_client_kwargs(self, max_retries):
+        kwargs = {'base_url': self.base_url, 'api_key': self.api_key, 'max_retries': max_retries}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        return kwargs
+
+    def get_client(self, max_retries=2):
+        return openai.OpenAI(**self.get_client_kwargs(max_retries))
+
+    def get_async_client(self, max_retries=2):
+        return openai.AsyncOpenAI(**self.get_client_kwargs(max_retries))
+
+@register_backend('together', prefixes=('deepseek-ai/', 'meta-llama/', 'Qwen/', 'mistralai/'))
+class TogetherBackend(OpenAICompatibleBackend):
+    """Together AI, through its OpenAI-compatible endpoint"""
+
+    base_url_variable = "TOGETHER_BASE_URL"
+    api_key_variable = "TOGETHER_API_KEY"
+    default_base_url = "https://api.together.xyz/v1"
+
+@register_backend('fake', prefixes=('fake',))
+class FakeBackend(OpenAICompatibleBackend):
+    """The deterministic local server in feedback/fake_server.py, for
+        offline load tests of the concurrency, retry and batch code"""
+
+    supports_batch = True
+    base_url_variable = "FAKE_SERVER_URL"
+    api_key_variable = "FAKE_SERVER_API_KEY"
+    default_base_url = "http://localhost:8765/v1"
+
+def get_backend(model_name, backend=None, **kwargs):
+    """Find the backend for a model
+
+    Arguments:
+        model_name: String, name of the model
+        backend: String, ModelBackend or None; by default the backend is
+            chosen by the longest registered prefix of the model name
+        kwargs: Passed on to the backend
+
+    Returns: ModelBackend"""
+
+    # Not isinstance, since scripts import this module as backends rather than feedback.backends
+    if backend is not None and not isinstance(backend, str):
+        return backend
+    if backend is None:
+        matches = [p for p in model_prefixes if model_name.startswith(p)]
+        if len(matches) == 0:
+            raise Exception("Model {} not found; pass a backend, one of {}".format(model_name, sorted(backends)))
+        backend = model_prefixes[max(matches, key=len)]
+    if backend not in backends:
+        raise Exception("Backend {} not found; registered backends are {}".format(backend, sorted(backends)))
+    return backends[backend](**kwargs)
@@ -0,0 +1,454 @@
+import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from feedback import metrics
+from feedback.async_engine import parse_json_output
+from feedback.batch_manager import FINISHED_STATUSES, MAX_ATTEMPTS, requeue_requests
+from feedback.bulk_writer import write_rescue_feedback, feedback_columns
+from feedback.custom_id import decode_custom_id
+from feedback.fr_feedback import all_tasks, parse_feedback_output, is_complete_output
+
+cached_file_name = "{}/cached_feedbacks.jsonl".format(os.path.dirname(__file__))
+cache_key_file_name = "{}/pending_cache_keys.jsonl".format(os.path.dirname(__file__))
+
+# Batch statuses that may still change
+ACTIVE_STATUSES = ['validating', 'in_progress', 'finalizing', 'cancelling']
+
+# Shard statuses after which a shard is no longer checked
+CLOSED_STATUSES = ['ingested', 'cancelled', 'abandoned']
+
+def load_pending_cache_keys(file_name=cache_key_file_name):
+    """Load the cache keys of requests sent to the Batch API
+
+    Arguments:
+        file_name: String, written by batch_make_requests.py
+
+    Returns: Dictionary mapping custom_id to its cache key"""
+
+    pending_cache_keys = {}
+    if os.path.exists(file_name):
+        for line in open(file_name):
+            try:
+                cache_key = json.loads(line)
+                pending_cache_keys[cache_key['custom_id']] = cache_key
+            except:
+                pass
+    return pending_cache_keys
+
+def save_pending_cache_keys(pending_cache_keys, file_name=cache_key_file_name):
+    """Rewrite the cache keys of requests whose responses have not arrived
+
+    Arguments:
+        pending_cache_keys: Dictionary mapping custom_id to its cache key
+        file_name: String, location of the file
+
+    Returns: Nothing"""
+
+    w = open(file_name, "w")
+    for cache_key in pending_cache_keys.values():
+        w.write(json.dumps(cache_key))
+        w.write("\n")
+    w.close()
+
+def stream_output_lines(client, file_id):
+    """Stream a batch output file line by line, without loading it into memory
+
+    Arguments:
+        client: OpenAI client
+        file_id: String, id of the output file
+
+    Returns: Generator of Strings, one per line"""
+
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if line:
+                yield line
+
+def get_error_custom_ids(client, file_id):
+    """Custom ids of the requests listed in a batch's error file, e.g.
+        those that failed or were not run before the batch expired
+
+    Arguments:
+        client: OpenAI client
+        file_id: String or None, id of the error file
+
+    Returns: Set of Strings"""
+
+    if file_id is None:
+        return set()
+    custom_ids = set()
+    for line in stream_output_lines(client, file_id):
+        try:
+            custom_ids.add(json.loads(line)['custom_id'])
+        except (json.JSONDecodeError, KeyError):
+            print("Error reading line of error file {}".format(file_id))
+    return custom_ids
+
+def is_true(value):
+    """Interpret a label from a model response as a boolean
+
+    Arguments:
+        value: Label; boolean or string
+
+    Returns: Boolean"""
+
+    return value is True or (isinstance(value, str) and value.lower() == 'true')
+
+class ResultAssembler:
+    """Collects the labels of each owner as they arrive, keeping only the
+        tasks that were actually seen, since one owner's tasks may arrive
+        in different shards or in the cached responses"""
+
+    def __init__(self, tasks=all_tasks):
+        """Create an empty assembler
+
+        Arguments:
+            tasks: List of tasks, one column each"""
+
+        self.tasks = tasks
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_row(self, owner_id, owner_type):
+        """Labels of an owner, adding an empty row if needed
+
+        Arguments:
+            owner_id: String, id of the rescue
+            owner_type: String, type of the owner
+
+        Returns: Dictionary with owner_type and the labels seen so far"""
+
+        row = self.rows.get(owner_id)
+        if row is None:
+            row = self.rows[owner_id] = {'owner_type': owner_type, 'labels': {}}
+        return row
+
+    def add(self, task, owner_id, owner_type, feedback_info):
+        """Record the labels from one parsed response
+
+        Arguments:
+            task: String, task name or FUSED_TASK
+            owner_id: String, id of the rescue
+            owner_type: String, type of the owner
+            feedback_info: Dictionary, the JSON output of the model
+
+        Returns: Nothing"""
+
+        labels = self.get_row(owner_id, owner_type)['labels']
+        for label, value in parse_feedback_output(feedback_info, task, self.tasks).items():
+            labels[label] = is_true(value)
+
+    def add_line(self, line):
+        """Record one line of Batch API output
+
+        Arguments:
+            line: String or Dictionary, a line of Batch API output
+
+        Returns: Tuple of (custom_id, task, parsed response)"""
+
+        if isinstance(line, (str, bytes)):
+            line = json.loads(line)
+        custom_id = line['custom_id']
+        task, owner_id, owner_type = decode_custom_id(custom_id)
+        feedback_info = parse_json_output(line['response']['body']['choices'][0]['message']['content'])
+        self.add(task, owner_id, owner_type, feedback_info)
+        return custom_id, task, feedback_info
+
+    def fan_out(self, manifest):
+        """Copy each representative's labels to the other members of its
+            group of near-identical comments, once every one of its tasks
+            has been collected, here or in an earlier write
+
+        Arguments:
+            manifest: BatchManifest, with the members of each representative
+                and the labels collected for it so far
+
+        Returns: List of the representatives that were fanned out"""
+
+        fanned_out = []
+        for owner_id, row in list(self.rows.items()):
+            key = "{}:{}".format(owner_id, row['owner_type'])
+            if key not in manifest.members:
+                continue
+            labels = manifest.collect_labels(key, row['labels'])
+            if len(labels) < len(self.tasks):
+                continue
+            for member_id, member_type in manifest.members[key]:
+                self.get_row(member_id, member_type)['labels'].update(labels)
+            fanned_out.append(key)
+        return fanned_out
+
+    def get_written_tasks(self):
+        """Tasks seen for each owner, which write_results writes
+
+        Returns: Dictionary mapping owner id to a list of tasks"""
+
+        return {owner_id: list(row['labels']) for owner_id, row in self.rows.items()}
+
+    def to_values(self, current_time):
+        """Emit one tuple per owner for write_rescue_feedback, ordered like
+            owner_id, owner_type, created_at, updated_at, then the tasks
+            Tasks that were not seen are None, so the merge leaves them
+            to the shard that has them
+
+        Arguments:
+            current_time: datetime, used for created_at and updated_at
+
+        Returns: List of tuples"""
+
+        return [(owner_id, row['owner_type'], current_time, current_time,
+                 *[row['labels'].get(task) for task in self.tasks])
+                for owner_id, row in self.rows.items()]
+
+def parse_output_lines(lines, cache=None, pending_cache_keys=None, cache_lock=None, usage=None):
+    """Parse Batch API output lines into one row of labels per rescue
+
+    Arguments:
+        lines: Iterable of JSON Strings, in the Batch API output format
+        cache: ResponseCache or None, where successful responses are stored
+        pending_cache_keys: Dictionary mapping custom_id to its cache key
+        cache_lock: threading.Lock or None, guards the cache across threads
+        usage: UsageTracker or None, records the tokens of each response
+
+    Returns: ResultAssembler with the labels"""
+
+    assembler = ResultAssembler()
+    for idx, line in enumerate(lines):
+        try:
+            line = json.loads(line)
+            custom_id, which_task, feedback_info = assembler.add_line(line)
+            # Lines answered from our own cache have no usage
+            body = line['response']['body']
+            if 'usage' in body:
+                if usage is not None:
+                    usage.record(which_task, body['usage'])
+                metrics.record_llm_call(body.get('model', 'unknown'), which_task, body['usage'], batch=True)
+            if cache is not None and custom_id in pending_cache_keys and is_complete_output(feedback_info, which_task):
+                cache_key = pending_cache_keys.pop(custom_id)
+                with cache_lock:
+                    cache.put_by_key(cache_key['key'], cache_key['model'], cache_key['task'],
+                                     cache_key['prompt_hash'], feedback_info)
+        except:
+            print("Error processing request on line {}".format(idx+1))
+    return assembler
+
+def write_results(pool, assembler, on_conflict='ignore'):
+    """Write parsed rows to rescue_feedback
+
+    Arguments:
+        pool: ConnectionPool
+        assembler: ResultAssembler with the labels
+        on_conflict: String, 'ignore' or 'update'
+
+    Returns: Dictionary of write statistics"""
+
+    values = assembler.to_values(datetime.datetime.now())
+    return write_rescue_feedback(pool, values, feedback_columns, on_conflict=on_conflict)
+
+def refresh_shards(client, manifest):
+    """Check the status of every submitted shard that has not been ingested
+        A shard whose batch failed or expired goes back to written, to be
+        submitted again, until it has been submitted MAX_ATTEMPTS times
+
+    Arguments:
+        client: OpenAI client
+        manifest: BatchManifest
+
+    Returns: List of names of shards ready to ingest"""
+
+    ready = []
+    for name in list(manifest.shards):
+        shard = manifest.shards[name]
+        if shard['batch_id'] is None or shard['status'] in CLOSED_STATUSES:
+            continue
+        try:
+            batch = client.batches.retrieve(shard['batch_id'])
+        except Exception as e:
+            print("Error checking shard {}: {}".format(name, e))
+            continue
+
+        if (batch.output_file_id or batch.error_file_id) and batch.status in FINISHED_STATUSES:
+            manifest.update_shard(name, status=batch.status, output_file_id=batch.output_file_id,
+                                  error_file_id=batch.error_file_id)
+            ready.append(name)
+        elif batch.status in ['failed', 'expired']:
+            attempts = shard.get('attempts', 1)
+            if attempts >= MAX_ATTEMPTS:
+                metrics.increment('batch_requests_abandoned', shard['num_requests'])
+                print("Gave up on shard {} after its batch {} {} times".format(name, batch.status, attempts))
+                manifest.update_shard(name, status='abandoned')
+                manifest.release_shard(name)
+            else:
+                # The next batch_make_requests.py run submits the shard again
+                manifest.update_shard(name, batch_id=None, status='written', attempts=attempts+1)
+        elif batch.status == 'cancelled':
+            manifest.update_shard(name, status='cancelled')
+            manifest.release_shard(name)
+        elif batch.status != shard['status']:
+            manifest.update_shard(name, status=batch.status)
+    manifest.save()
+    return ready
+
+def ingest_shard(client, manifest, pool, name, cache=None, pending_cache_keys=None, cache_lock=None,
+                 on_conflict='ignore', usage=None):
+    """Stream one shard's output, write its results, and mark it ingested
+        Requests in its error file are requeued in the same shard, which goes
+        back to written instead, until it has been submitted MAX_ATTEMPTS times
+
+    Arguments:
+        client: OpenAI client
+        manifest: BatchManifest
+        pool: ConnectionPool
+        name: String, name of the shard
+        cache: ResponseCache or None
+        pending_cache_keys: Dictionary mapping custom_id to its cache key
+        cache_lock: threading.Lock or None, guards the cache across threads
+        on_conflict: String, 'ignore' or 'update'
+        usage: UsageTracker or None, records the tokens of each response
+
+    Returns: Integer, number of rows written"""
+
+    shard = manifest.shards[name]
+    failed = get_error_custom_ids(client, shard.get('error_file_id'))
+    output_lines = stream_output_lines(client, shard['output_file_id']) if shard['output_file_id'] else []
+    assembler = parse_output_lines(output_lines, cache, pending_cache_keys, cache_lock, usage)
+    fanned_out = assembler.fan_out(manifest)
+    rows_written = write_results(pool, assembler, on_conflict)['rows_written'] if len(assembler) > 0 else 0
+    manifest.release_members(fanned_out)
+    manifest.mark_written(assembler.get_written_tasks())
+
+    requeued = requeue_requests(manifest, name, failed) if len(failed) > 0 else 0
+    if requeued > 0:
+        metrics.increment('batch_requests_requeued', requeued)
+        print("Requeued {} failed requests of shard {}".format(requeued, name))
+    else:
+        if len(failed) > 0:
+            metrics.increment('batch_requests_abandoned', len(failed))
+            print("Gave up on {} failed requests of shard {} after {} attempts".format(
+                len(failed), name, shard.get('attempts', 1)))
+        manifest.update_shard(name, status='ingested', ingested_at=str(datetime.datetime.now()))
+        manifest.release_shard(name)
+    manifest.save()
+    return rows_written
+
+def ingest_cached_responses(pool, on_conflict='ignore', file_name=cached_file_name, manifest=None):
+    """Write responses answered from the cache or the pre-filter by
+        batch_make_requests.py
+        A rescue's other tasks may have gone to the Batch API; its row here
+        holds NULL for them, which the merge fills in from the shard's row
+
+    Arguments:
+        pool: ConnectionPool
+        on_conflict: String, 'ignore' or 'update'
+        file_name: String, location of the cached responses
+        manifest: BatchManifest or None, whose duplicate comments are given
+            their representative's labels
+
+    Returns: Integer, number of rows written
+
+    Side Effects: Removes the file once its rows are written"""
+
+    if not os.path.exists(file_name):
+        return 0
+    assembler = parse_output_lines(open(file_name))
+    fanned_out = assembler.fan_out(manifest) if manifest is not None else []
+    rows_written = write_results(pool, assembler, on_conflict)['rows_written'] if len(assembler) > 0 else 0
+    if manifest is not None:
+        manifest.release_members(fanned_out)
+        manifest.mark_written(assembler.get_written_tasks())
+        manifest.save()
+    os.remove(file_name)
+    return rows_written
+
+def collect(client, manifest, pool, cache=None, max_workers=4, on_conflict='ignore', usage=None):
+    """One collection pass: refresh every outstanding shard, then ingest the
+        finished ones concurrently, each written as soon as it is parsed
+
+    Arguments:
+        client: OpenAI client
+        manifest: BatchManifest
+        pool: ConnectionPool
+        cache: ResponseCache or None
+        max_workers: Integer, number of shards ingested at once
+        on_conflict: String, 'ignore' or 'update'
+        usage: UsageTracker or None, records the tokens of each response
+
+    Returns: List of names of shards ingested"""
+
+    ready = refresh_shards(client, manifest)
+    pending_cache_keys = load_pending_cache_keys()
+    cache_lock = threading.Lock()
+
+    def ingest(name):
+        try:
+            rows_written = ingest_shard(client, manifest, pool, name, cache, pending_cache_keys,
+                                        cache_lock, on_conflict, usage)
+            print("Ingested shard {} ({} rows)".format(name, rows_written))
+            return name
+        except Exception as e:
+            print("Error ingesting shard {}: {}".format(name, e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        ingested = [name for name in executor.map(ingest, ready) if name is not None]
+
+    ingest_cached_responses(pool, on_conflict, manifest=manifest)
+    save_pending_cache_keys(pending_cache_keys)
+    if cache is not None:
+        cache.commit()
+    return ingested
+
+def get_outstanding_shards(manifest):
+    """Shards submitted but not yet ingested
+
+    Arguments:
+        manifest: BatchManifest
+
+    Returns: List of shard names"""
+
+    return [name for name in manifest.shards
+            if manifest.shards[name]['batch_id'] is not None
+            and manifest.shards[name]['status'] not in CLOSED_STATUSES]
+
+def collect_until_done(client, manifest, pool, cache=None, max_workers=4, on_conflict='ignore',
+                       min_interval=60, max_interval=3600, timeout=None, usage=None):
+    """Poll until every submitted shard is ingested, backing off while
+        nothing finishes and polling quickly again once something does
+
+    Arguments:
+        client: OpenAI client
+        manifest: BatchManifest
+        pool: ConnectionPool
+        cache: ResponseCache or None
+        max_workers: Integer, number of shards ingested at once
+        on_conflict: String, 'ignore' or 'update'
+        min_interval: Float, shortest wait between polls, in seconds
+        max_interval: Float, longest wait between polls, in seconds
+        timeout: Float or None, give up after this many seconds
+        usage: UsageTracker or None, records the tokens of each response
+
+    Returns: List of names of shards ingested"""
+
+    start = time.time()
+    interval = min_interval
+    ingested = []
+    while True:
+        newly_ingested = collect(client, manifest, pool, cache, max_workers, on_conflict, usage)
+        ingested += newly_ingested
+        outstanding = get_outstanding_shards(manifest)
+        if len(outstanding) == 0:
+            break
+        if timeout is not None and time.time() - start + interval > timeout:
+            print("Stopping with {} shards outstanding".format(len(outstanding)))
+            break
+
+        interval = min_interval if len(newly_ingested) > 0 else min(interval*2, max_interval)
+        print("{} shards outstanding; checking again in {:.0f}s".format(len(outstanding), interval))
+        time.sleep(interval)
+    return ingested
@@ -1,10 +1,18 @@
-from fr_feedback import get_feedback_by_date, generate_prompts_and_analyze_feedback
-from database import open_connection
+from fr_feedback import get_feedback_by_date, stream_feedback_by_date, generate_prompts_and_analyze_feedback, \
+    load_request_prompts
+from database import ConnectionPool
+from backends import get_backend
+from cache import ResponseCache
+from prefilter import load_prefilter
+from dedup import deduplicate, get_members, get_cluster_report
+from watermark import load_watermark, get_unprocessed_feedback
+from batch_manager import BatchManifest, write_shards, submit_shards, MAX_REQUESTS_PER_SHARD
+from feedback import metrics
 import argparse
 import datetime
 import os
 import json
-import openai
+import time
 
 current_time = datetime.datetime.now()
 
@@ -12,7 +20,23 @@ model_name = 'gpt-4o-mini'
 parser = argparse.ArgumentParser()
 parser.add_argument('--start_date',   help='num beneficiaries (arms)', type=str)
 parser.add_argument('--end_date', help='volunteers per arm', type=str)
+parser.add_argument('--fused', help='classify all tasks with one combined prompt', action='store_true')
+parser.add_argument('--no_cache', help='do not reuse cached LLM responses', action='store_true')
+parser.add_argument('--incremental', help='only process comments published since the last run; --start_date is used for the first run', action='store_true')
+parser.add_argument('--lookback_days', help='in incremental mode, how far back to look for late comments', type=float, default=7)
+parser.add_argument('--stream', help='fetch and process comments in chunks through a server-side cursor', action='store_true')
+parser.add_argument('--chunk_size', help='number of rows per chunk when streaming', type=int, default=10000)
+parser.add_argument('--prefilter', help='resolve labels a local TF-IDF model is confident about without the LLM (train with train_prefilter.py)', action='store_true')
+parser.add_argument('--prefilter_threshold', help='confidence the pre-filter needs to resolve a label; defaults to the trained threshold', type=float)
+parser.add_argument('--dedup_threshold', help='group comments at least this similar (1: identical after normalization) and classify one per group', type=float)
+parser.add_argument('--shard_size', help='maximum requests per batch shard', type=int, default=MAX_REQUESTS_PER_SHARD)
+parser.add_argument('--submit_workers', help='number of shards uploaded and submitted in parallel', type=int, default=4)
+parser.add_argument('--resume_only', help='only resubmit shards from earlier runs that were not submitted', action='store_true')
+parser.add_argument('--backend', help='model backend, e.g. openai, together, openai_compatible or fake; chosen from the model name by default', type=str)
+parser.add_argument('--metrics_file', help='record stage timers, counters, tokens and latencies to this file: Prometheus text if it ends in .prom, JSON lines otherwise', type=str)
 args = parser.parse_args()
+if args.stream and args.incremental:
+    parser.error("--stream reads a date range, so it can't be combined with --incremental")
 start_date      = args.start_date
 end_date = args.end_date
 
@@ -21,39 +45,92 @@ username = os.environ.get("POSTGRES_USER")
 password = os.environ.get("POSTGRES_PASSWORD") 
 ip_address = os.environ.get("DATABASE_HOST") 
 port = os.environ.get("DATABASE_PORT")
-openai_api_key = os.environ.get("OPENAI_API_KEY")
-
-client = openai.OpenAI(api_key=openai_api_key)
-
-connection_dict = open_connection(db_name,username,password,ip_address,port)
-connection = connection_dict['connection']
-cursor = connection_dict['cursor']
-
-feedbacks = get_feedback_by_date(connection,start_date,end_date)
-annotated_feedback = generate_prompts_and_analyze_feedback(feedbacks,model_name,batch=True)
-
-processed_ids = set()
-
-# Write the feedbacks to the appropriate file
-w = open("{}/feedbacks.jsonl".format(os.path.dirname(__file__)),"w")
-for feedback in annotated_feedback:
-    if feedback['custom_id'] not in processed_ids:
-        w.write(json.dumps(feedback))
-        w.write("\n")
-        processed_ids.add(feedback['custom_id'])
-w.close()
-
-if len(annotated_feedback) > 0:
-    # Run the processing script
-    batch_input_file_id = client.files.create(
-        file=open("{}/feedbacks.jsonl".format(os.path.dirname(__file__)), "rb"),
-        purpose="batch"
-    ).id
-    batch_info = client.batches.create(
-        input_file_id=batch_input_file_id,
-        endpoint="/v1/chat/completions",
-        completion_window="24h",
-        metadata={
-            "description": "Food Rescue Eval."
-        }
-    )
\ No newline at end of file
+
+if args.metrics_file:
+    metrics.enable('batch_make_requests')
+run_start = time.perf_counter()
+
+backend = get_backend(model_name,args.backend)
+client = backend.get_batch_client()
+
+pool = ConnectionPool(db_name,username,password,ip_address,port)
+
+cache = None if args.no_cache else ResponseCache()
+prefilter = load_prefilter(threshold=args.prefilter_threshold) if args.prefilter else None
+prompts = load_request_prompts(fused=args.fused,cache=cache)
+
+manifest = BatchManifest()
+
+if args.resume_only:
+    feedback_chunks = []
+elif args.incremental:
+    watermark = load_watermark('batch_make_requests')
+    with metrics.timer('stage_seconds', stage='fetch'):
+        feedbacks = get_unprocessed_feedback(pool,watermark,start_date,end_date,args.lookback_days)
+    print("Found {} new comments since {}".format(len(feedbacks),watermark['published_at']))
+    # batch_process_requests.py advances the watermark as their labels are written
+    manifest.add_pending_rescues(feedbacks)
+    manifest.save()
+    feedback_chunks = [feedbacks]
+elif args.stream:
+    feedback_chunks = stream_feedback_by_date(pool,start_date,end_date,args.chunk_size)
+else:
+    with metrics.timer('stage_seconds', stage='fetch'):
+        feedback_chunks = [get_feedback_by_date(pool,start_date,end_date)]
+
+# Cached and pre-filtered responses skip the API, and are picked up by batch_process_requests.py
+# They hold only some of a rescue's tasks; the write merges them with the shard rows
+# holding the rest, since a missing label is NULL and never replaces one already there
+cached_file = open("{}/cached_feedbacks.jsonl".format(os.path.dirname(__file__)),"a")
+cache_key_file = open("{}/pending_cache_keys.jsonl".format(os.path.dirname(__file__)),"a")
+
+def get_requests():
+    """Yield each new Batch API request once, writing cached responses
+        and cache keys to their files along the way"""
+
+    processed_ids = set()
+    for feedbacks in feedback_chunks:
+        metrics.increment('comments', len(feedbacks))
+        if args.dedup_threshold is not None:
+            representatives, clusters = deduplicate(feedbacks,args.dedup_threshold)
+            distribution, summary = get_cluster_report(clusters)
+            print("Cluster sizes:\n{}\n{}".format(distribution.to_string(index=False),summary))
+            # The collector copies each representative's labels to its members
+            manifest.add_members(get_members(feedbacks,clusters))
+            manifest.save()
+            feedbacks = representatives
+        annotated_feedback = generate_prompts_and_analyze_feedback(feedbacks,model_name,batch=True,fused=args.fused,cache=cache,
+                                                                   prefilter=prefilter,backend=backend,prompts=prompts)
+        for feedback in annotated_feedback:
+            if feedback['custom_id'] not in processed_ids:
+                processed_ids.add(feedback['custom_id'])
+                if 'response' in feedback:
+                    cached_file.write(json.dumps(feedback))
+                    cached_file.write("\n")
+                    continue
+                if 'cache_key' in feedback:
+                    cache_key_file.write(json.dumps({'custom_id': feedback['custom_id'], **feedback.pop('cache_key')}))
+                    cache_key_file.write("\n")
+                yield feedback
+
+# Requests are built as the shards are written, so both are timed together
+with metrics.timer('stage_seconds', stage='build'):
+    new_shards = write_shards(get_requests(),manifest,max_requests=args.shard_size)
+metrics.increment('shards_written', len(new_shards))
+print("Wrote {} new shards".format(len(new_shards)))
+cached_file.close()
+cache_key_file.close()
+
+if cache is not None:
+    print("Cache: {}".format(cache.stats()))
+    cache.close()
+
+# Submits the new shards, along with any earlier ones that failed to submit
+with metrics.timer('stage_seconds', stage='submit'):
+    submit_shards(client,manifest,max_workers=args.submit_workers)
+
+pool.close()
+metrics.observe('run_seconds', time.perf_counter() - run_start)
+metrics.save(args.metrics_file)
+if args.metrics_file:
+    print("Metrics written to {}".format(args.metrics_file))
@@ -0,0 +1,367 @@
+import datetime
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from feedback.custom_id import decode_custom_id
+
+default_manifest_path = "{}/../data/state/batch_manifest.json".format(os.path.dirname(__file__))
+default_shard_dir = "{}/../data/batches".format(os.path.dirname(__file__))
+
+# OpenAI Batch API limits are 50,000 requests and 200 MB per input file
+MAX_REQUESTS_PER_SHARD = 50000
+MAX_BYTES_PER_SHARD = 190*1024*1024
+
+# Batch statuses after which a batch's requests are no longer in flight
+FINISHED_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+
+# Times a request in a batch's error file is submitted before it is given up on
+MAX_ATTEMPTS = 3
+
+class BatchManifest:
+    """Local record of every shard: shard -> file id -> batch id -> status,
+        plus the custom_ids that are in flight, the duplicate comments
+        waiting for their representative's labels, with the labels
+        collected for each representative so far, and the rescues of
+        incremental runs whose labels are not all written yet"""
+
+    def __init__(self, path=default_manifest_path):
+        """Load the manifest, or start an empty one
+
+        Arguments:
+            path: String, location of the manifest file"""
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.shards = {}
+        self.in_flight = {}
+        self.members = {}
+        self.collected = {}
+        self.pending_rescues = {}
+        if os.path.exists(path):
+            manifest = json.load(open(path))
+            self.shards = manifest['shards']
+            self.in_flight = manifest['in_flight']
+            self.members = manifest.get('members', {})
+            self.collected = manifest.get('collected', {})
+            self.pending_rescues = manifest.get('pending_rescues', {})
+
+    def save(self):
+        """Atomically write the manifest to disk
+
+        Returns: Nothing"""
+
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary_path = self.path + ".tmp"
+            w = open(temporary_path, "w")
+            json.dump({'shards': self.shards, 'in_flight': self.in_flight, 'members': self.members,
+                       'collected': self.collected, 'pending_rescues': self.pending_rescues}, w)
+            w.close()
+            os.replace(temporary_path, self.path)
+
+    def add_shard(self, name, path, custom_ids, num_bytes):
+        """Record a newly written shard, and mark its requests as in flight
+
+        Arguments:
+            name: String, name of the shard
+            path: String, location of the shard's JSONL file
+            custom_ids: List of custom ids in the shard
+            num_bytes: Integer, size of the shard file
+
+        Returns: Nothing"""
+
+        with self.lock:
+            self.shards[name] = {'path': path, 'num_requests': len(custom_ids), 'num_bytes': num_bytes,
+                                 'file_id': None, 'batch_id': None, 'status': 'written',
+                                 'created_at': str(datetime.datetime.now())}
+            for custom_id in custom_ids:
+                self.in_flight[custom_id] = name
+
+    def update_shard(self, name, **fields):
+        """Update a shard's record, e.g. its file id, batch id or status,
+            and save the manifest
+
+        Arguments:
+            name: String, name of the shard
+            fields: Fields to update
+
+        Returns: Nothing"""
+
+        with self.lock:
+            self.shards[name].update(fields)
+        self.save()
+
+    def release_shard(self, name):
+        """Stop tracking a shard's requests as in flight, e.g. once its results
+            are written or its batch failed, so they may be sent again
+
+        Arguments:
+            name: String, name of the shard
+
+        Returns: Nothing"""
+
+        with self.lock:
+            self.in_flight = {c: s for c, s in self.in_flight.items() if s != name}
+
+    def add_members(self, members):
+        """Record duplicate comments whose labels are copied from their
+            representative once its results are collected
+
+        Arguments:
+            members: Dictionary, from dedup.get_members
+
+        Returns: Nothing"""
+
+        with self.lock:
+            for key, owners in members.items():
+                self.members.setdefault(key, []).extend(owners)
+
+    def collect_labels(self, key, labels):
+        """Add labels of a representative to those collected from earlier
+            writes; its tasks may arrive in different shards or the cache
+
+        Arguments:
+            key: String, "owner_id:owner_type" of the representative
+            labels: Dictionary mapping task name to label
+
+        Returns: Dictionary of every label collected for it so far"""
+
+        with self.lock:
+            collected = self.collected.setdefault(key, {})
+            collected.update(labels)
+            return dict(collected)
+
+    def release_members(self, keys):
+        """Stop tracking the members of representatives whose labels were written
+
+        Arguments:
+            keys: List of "owner_id:owner_type" of representatives
+
+        Returns: Nothing"""
+
+        with self.lock:
+            for key in keys:
+                self.members.pop(key, None)
+                self.collected.pop(key, None)
+
+    def add_pending_rescues(self, feedbacks):
+        """Record the rescues fetched by an incremental run; the watermark
+            only moves past them once all their labels are written
+
+        Arguments:
+            feedbacks: DataFrame with id and published_at
+
+        Returns: Nothing"""
+
+        with self.lock:
+            for rescue_id, published_at in zip(feedbacks['id'], feedbacks['published_at']):
+                self.pending_rescues.setdefault(str(rescue_id), {'published_at': str(published_at), 'written': []})
+
+    def mark_written(self, written):
+        """Record the labels written for pending rescues
+
+        Arguments:
+            written: Dictionary mapping owner id to the tasks written for it
+
+        Returns: Nothing"""
+
+        with self.lock:
+            for owner_id, tasks in written.items():
+                pending = self.pending_rescues.get(str(owner_id))
+                if pending is not None:
+                    pending['written'] = sorted(set(pending['written']) | set(tasks))
+
+    def take_written_rescues(self, tasks):
+        """Stop tracking the pending rescues that have every label written
+
+        Arguments:
+            tasks: List of every task
+
+        Returns: Dictionary mapping rescue id to its publish time"""
+
+        with self.lock:
+            written = {rescue_id: pending['published_at'] for rescue_id, pending in self.pending_rescues.items()
+                       if set(tasks) <= set(pending['written'])}
+            for rescue_id in written:
+                del self.pending_rescues[rescue_id]
+        return written
+
+    def get_shard_by_batch(self, batch_id):
+        """Find the shard a batch was created from
+
+        Arguments:
+            batch_id: String, OpenAI batch id
+
+        Returns: String, shard name, or None"""
+
+        for name in self.shards:
+            if self.shards[name]['batch_id'] == batch_id:
+                return name
+        return None
+
+def write_shards(requests, manifest, shard_dir=default_shard_dir, max_requests=MAX_REQUESTS_PER_SHARD,
+                 max_bytes=MAX_BYTES_PER_SHARD):
+    """Split a stream of batch requests into size-capped JSONL shards
+        Requests whose custom_id is already in flight are skipped
+        Shards are only closed between owners, so each shard holds every
+        new request of the rescues in it; requests must arrive grouped by owner
+
+    Arguments:
+        requests: Iterable of Batch API request dictionaries
+        manifest: BatchManifest
+        shard_dir: String, directory for shard files
+        max_requests: Integer, maximum requests per shard
+        max_bytes: Integer, maximum bytes per shard
+
+    Returns: List of names of the new shards
+
+    Side Effects: Writes shard files and records them in the manifest"""
+
+    os.makedirs(shard_dir, exist_ok=True)
+    run_name = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    new_shards = []
+    w = None
+    custom_ids = []
+    num_bytes = 0
+
+    def close_shard():
+        w.close()
+        manifest.add_shard(new_shards[-1], w.name, custom_ids, num_bytes)
+        manifest.save()
+
+    def add_group(group):
+        """Write one owner's requests to the current shard, or to a new one
+            if they don't fit"""
+
+        nonlocal w, custom_ids, num_bytes
+        if len(group) == 0:
+            return
+        group_bytes = sum(len(line) for _, line in group)
+        if w is not None and (len(custom_ids) + len(group) > max_requests or num_bytes + group_bytes > max_bytes):
+            close_shard()
+            w = None
+        if w is None:
+            new_shards.append("{}_{:04d}".format(run_name, len(new_shards)))
+            w = open("{}/{}.jsonl".format(shard_dir, new_shards[-1]), "wb")
+            custom_ids = []
+            num_bytes = 0
+
+        for custom_id, line in group:
+            w.write(line)
+            custom_ids.append(custom_id)
+        num_bytes += group_bytes
+
+    skipped = 0
+    group = []
+    group_owner = None
+    for request in requests:
+        if request['custom_id'] in manifest.in_flight:
+            skipped += 1
+            continue
+        owner = decode_custom_id(request['custom_id'])[1:]
+        if owner != group_owner:
+            add_group(group)
+            group = []
+            group_owner = owner
+        group.append((request['custom_id'], (json.dumps(request) + "\n").encode('utf-8')))
+    add_group(group)
+
+    if w is not None:
+        close_shard()
+
+    if skipped > 0:
+        print("Skipped {} requests that are already in flight".format(skipped))
+    return new_shards
+
+def requeue_requests(manifest, name, custom_ids):
+    """Rewrite a shard with only the requests that failed and set it back to
+        written, so the next batch_make_requests.py run submits them again;
+        they stay in flight meanwhile, and the shard's other requests are released
+
+    Arguments:
+        manifest: BatchManifest
+        name: String, name of the shard
+        custom_ids: Set of custom ids of the failed requests
+
+    Returns: Integer, number of requests requeued; 0 once the shard has
+        been submitted MAX_ATTEMPTS times"""
+
+    shard = manifest.shards[name]
+    attempts = shard.get('attempts', 1)
+    if attempts >= MAX_ATTEMPTS or not os.path.exists(shard['path']):
+        return 0
+
+    temporary_path = shard['path'] + ".tmp"
+    requeued = []
+    num_bytes = 0
+    with open(shard['path'], "rb") as f, open(temporary_path, "wb") as w:
+        for line in f:
+            custom_id = json.loads(line)['custom_id']
+            if custom_id in custom_ids:
+                w.write(line)
+                requeued.append(custom_id)
+                num_bytes += len(line)
+    os.replace(temporary_path, shard['path'])
+
+    with manifest.lock:
+        manifest.in_flight = {c: s for c, s in manifest.in_flight.items() if s != name}
+        for custom_id in requeued:
+            manifest.in_flight[custom_id] = name
+    manifest.update_shard(name, num_requests=len(requeued), num_bytes=num_bytes, file_id=None, batch_id=None,
+                          output_file_id=None, error_file_id=None, status='written', attempts=attempts+1)
+    return len(requeued)
+
+def submit_shard(client, manifest, name, description="Food Rescue Eval."):
+    """Upload one shard and create its batch, resuming from whichever
+        step last succeeded
+
+    Arguments:
+        client: OpenAI client
+        manifest: BatchManifest
+        name: String, name of the shard
+        description: String, batch metadata description
+
+    Returns: String, the shard's status"""
+
+    shard = manifest.shards[name]
+    try:
+        if shard['file_id'] is None:
+            file_id = client.files.create(file=open(shard['path'], "rb"), purpose="batch").id
+            manifest.update_shard(name, file_id=file_id, status='uploaded')
+        if shard['batch_id'] is None:
+            batch_info = client.batches.create(
+                input_file_id=shard['file_id'],
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+                metadata={
+                    "description": description,
+                    "shard": name
+                }
+            )
+            manifest.update_shard(name, batch_id=batch_info.id, status='submitted')
+    except Exception as e:
+        print("Error submitting shard {}: {}".format(name, e))
+    return manifest.shards[name]['status']
+
+def submit_shards(client, manifest, max_workers=4):
+    """Submit every shard that has not been submitted yet, in parallel
+        Safe to rerun: shards that were uploaded or submitted are not sent again
+
+    Arguments:
+        client: OpenAI client
+        manifest: BatchManifest
+        max_workers: Integer, number of shards submitted at once
+
+    Returns: Dictionary mapping shard name to its status"""
+
+    pending = [name for name in manifest.shards if manifest.shards[name]['batch_id'] is None]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        statuses = list(executor.map(lambda name: submit_shard(client, manifest, name), pending))
+    manifest.save()
+
+    statuses = dict(zip(pending, statuses))
+    print("Submitted {} of {} pending shards".format(
+        sum([s == 'submitted' for s in statuses.values()]), len(pending)))
+    return statuses
@@ -1,90 +1,77 @@
-from database import open_connection
-import datetime
+from database import ConnectionPool
+from backends import get_backend
+from cache import ResponseCache
+from batch_manager import BatchManifest
+from batch_collector import collect, collect_until_done, get_outstanding_shards
+from usage import UsageTracker
+from watermark import load_watermark, save_watermark, advance_watermark
+from fr_feedback import all_tasks
+from feedback import metrics
 import os
-import json
-import openai
-from psycopg2.extras import execute_values
-import time 
+import argparse
 import sys
-
-unix_time = time.time()
-current_time = datetime.datetime.now()
+import time
+import pandas as pd
 
 model_name = 'gpt-4o-mini'
+parser = argparse.ArgumentParser()
+parser.add_argument('--on_conflict', help='ignore: keep existing predictions; update: overwrite them', type=str, default='ignore', choices=['ignore','update'])
+parser.add_argument('--max_workers', help='number of batches downloaded and written at once', type=int, default=4)
+parser.add_argument('--wait', help='keep polling, with backoff, until every submitted batch is written', action='store_true')
+parser.add_argument('--min_interval', help='shortest wait between polls, in seconds', type=float, default=60)
+parser.add_argument('--max_interval', help='longest wait between polls, in seconds', type=float, default=3600)
+parser.add_argument('--lookback_days', help='lookback of the incremental batch_make_requests.py runs; processed ids are remembered for this long', type=float, default=7)
+parser.add_argument('--backend', help='model backend, e.g. openai, together, openai_compatible or fake; chosen from the model name by default', type=str)
+parser.add_argument('--metrics_file', help='record stage timers, counters, tokens and latencies to this file: Prometheus text if it ends in .prom, JSON lines otherwise', type=str)
+args = parser.parse_args()
 
 db_name = os.environ.get("POSTGRES_DB")
 username = os.environ.get("POSTGRES_USER")
 password = os.environ.get("POSTGRES_PASSWORD") 
 ip_address = os.environ.get("DATABASE_HOST") 
 port = os.environ.get("DATABASE_PORT")
-openai_api_key = os.environ.get("OPENAI_API_KEY")
-
-client = openai.OpenAI(api_key=openai_api_key)
-
-connection_dict = open_connection(db_name,username,password,ip_address,port)
-connection = connection_dict['connection']
-cursor = connection_dict['cursor']
-
-check_requests_within_hours = 28
-sample_requests = []
-all_batches = list(client.batches.list(limit=10))
 
-nothing_found = True
-for batch in all_batches:
-    if batch.output_file_id and (time.time()-batch.created_at) < (check_requests_within_hours*3600):
-        nothing_found = False 
-        file_response = client.files.content(batch.output_file_id).text.split("\n")
-
-        for line in file_response:
-            try:
-                sample_requests.append(json.loads(line))
-            except:
-                pass 
-
-if nothing_found:
+if args.metrics_file:
+    metrics.enable('batch_process_requests')
+run_start = time.perf_counter()
+
+client = get_backend(model_name,args.backend).get_batch_client()
+
+pool = ConnectionPool(db_name,username,password,ip_address,port,maxconn=args.max_workers+1)
+manifest = BatchManifest()
+cache = ResponseCache()
+usage = UsageTracker(model_name,batch=True)
+
+with metrics.timer('stage_seconds', stage='collect'):
+    if args.wait:
+        ingested = collect_until_done(client,manifest,pool,cache,max_workers=args.max_workers,on_conflict=args.on_conflict,
+                                      min_interval=args.min_interval,max_interval=args.max_interval,usage=usage)
+    else:
+        ingested = collect(client,manifest,pool,cache,max_workers=args.max_workers,on_conflict=args.on_conflict,usage=usage)
+metrics.increment('batches_ingested', len(ingested))
+
+# Incremental batch_make_requests.py runs leave the watermark to us, so it
+# only moves past rescues whose labels were all written
+written = manifest.take_written_rescues(all_tasks)
+if len(written) > 0:
+    written = pd.DataFrame({'id': list(written.keys()), 'published_at': list(written.values())})
+    save_watermark('batch_make_requests', advance_watermark(load_watermark('batch_make_requests'),written,args.lookback_days))
+    manifest.save()
+    print("Watermark advanced past {} fully labelled rescues".format(len(written)))
+
+usage.print_report()
+if len(ingested) > 0:
+    print("Usage report written to {}".format(usage.save_report('batch_process_requests')))
+
+print("Cache: {}".format(cache.stats()))
+cache.close()
+pool.close()
+
+print("Ingested {} batches; {} still outstanding".format(len(ingested),len(get_outstanding_shards(manifest))))
+metrics.observe('run_seconds', time.perf_counter() - run_start)
+metrics.save(args.metrics_file)
+if args.metrics_file:
+    print("Metrics written to {}".format(args.metrics_file))
+if len(ingested) == 0:
     print("Nothing found")
     sys.exit(1)
-
-all_data = {}
-current_time = datetime.datetime.now()
-all_labels = ['recipient_problem', 'inadequate_food', 'donor_problem', 
-    'direction_problem','earlier_pickup','system_problem',
-    'update_contact','positive_comment']
-
-for idx,i in enumerate(sample_requests): 
-    try:
-        custom_id = i['custom_id']
-        which_task = "_".join(custom_id.split("_")[:-2])
-        owner_id = custom_id.split("_")[-2]
-        owner_type = custom_id.split("_")[-1]
-
-        if owner_id not in all_data:
-            all_data[owner_id] = {
-                'owner_id': owner_id, 
-                'owner_type': owner_type, 
-                'created_at': current_time, 
-                'updated_at': current_time
-            }
-
-            for j in all_labels:
-                all_data[owner_id][j] = False 
-        feedback_info = json.loads(i['response']['body']['choices'][0]['message']['content'])
-        all_data[owner_id][which_task] = feedback_info[which_task]
-    except:
-        print("Error processing request {} of {}".format(idx+1,len(sample_requests)))
-
-columns = ['owner_id', 'owner_type', 'created_at', 'updated_at', 'recipient_problem', 'inadequate_food', 'donor_problem', 'direction_problem', 'earlier_pickup', 'system_problem', 'update_contact', 'positive_comment']
-values = [tuple([all_data[i][c] for c in columns]) for i in all_data]
-
-insert_query = f"""
-    INSERT INTO rescue_feedback ({', '.join(columns)}) 
-    VALUES %s
-    ON CONFLICT DO NOTHING
-"""
-
-execute_values(cursor, insert_query, values)
-connection.commit()
-cursor.close()
-connection.close()
-
-print("Wrote {} values".format(len(sample_requests)))
\ No newline at end of file
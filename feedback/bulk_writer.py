@@ -0,0 +1,158 @@
+import csv
+import io
+import time
+
+import pandas as pd
+
+from feedback import metrics
+from feedback.database import is_pool
+from feedback.fr_feedback import all_tasks
+
+feedback_columns = ['owner_id', 'owner_type', 'created_at', 'updated_at'] + all_tasks
+
+STAGING_TABLE = 'rescue_feedback_staging'
+NULL_MARKER = '\\N'
+
+def format_copy_value(value):
+    """Format a Python value for COPY ... FROM STDIN in CSV format
+
+    Arguments:
+        value: Any value from a result tuple
+
+    Returns: Value the csv module can write, with missing values (None, NaN,
+        NaT, NA) as NULL_MARKER and lists of numbers as Postgres array literals"""
+
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join(str(v) for v in value) + '}'
+    if pd.isnull(value):
+        return NULL_MARKER
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+def copy_rows(cursor, table, columns, values, rows_per_copy=100000):
+    """Stream rows into a table with COPY, a block of rows at a time
+
+    Arguments:
+        cursor: Cursor on a PSQL connection
+        table: String, table to copy into
+        columns: List of column names, in the order of each tuple
+        values: Iterable of tuples
+        rows_per_copy: Integer, rows buffered per COPY statement
+
+    Returns: Integer, number of rows copied"""
+
+    copy_query = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(
+        table, ', '.join(columns), NULL_MARKER)
+
+    num_rows = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffered = 0
+    for row in values:
+        writer.writerow([format_copy_value(v) for v in row])
+        buffered += 1
+        if buffered == rows_per_copy:
+            buffer.seek(0)
+            cursor.copy_expert(copy_query, buffer)
+            num_rows += buffered
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            buffered = 0
+
+    if buffered > 0:
+        buffer.seek(0)
+        cursor.copy_expert(copy_query, buffer)
+        num_rows += buffered
+    return num_rows
+
+def get_merge_query(columns, on_conflict='ignore', conflict_columns=('owner_id', 'owner_type'),
+                    table='rescue_feedback'):
+    """Build the statement that merges the staging table into rescue_feedback
+        A row may hold only some of its labels, with NULL for the rest (e.g.
+        when its tasks were split between shards), so a NULL never replaces
+        a label that is already there
+
+    Arguments:
+        columns: List of column names being written
+        on_conflict: String, 'ignore' keeps existing labels and only fills in
+            missing ones; 'update' overwrites them with the new labels
+        conflict_columns: Tuple of columns with a unique index on the table
+        table: String, table to merge into
+
+    Returns: String, SQL statement"""
+
+    if on_conflict not in ['ignore', 'update']:
+        raise Exception("on_conflict must be 'ignore' or 'update', not {}".format(on_conflict))
+
+    column_list = ', '.join(columns)
+    conflict_list = ', '.join(conflict_columns)
+    label_columns = [c for c in columns if c not in conflict_columns and c not in ['created_at', 'updated_at']]
+    if len(label_columns) == 0:
+        return f"""
+            INSERT INTO {table} ({column_list})
+            SELECT {column_list} FROM pg_temp.{STAGING_TABLE}
+            ON CONFLICT DO NOTHING
+        """
+
+    if on_conflict == 'ignore':
+        updates = ['{c} = COALESCE({table}.{c}, EXCLUDED.{c})'.format(c=c, table=table) for c in label_columns]
+        # Rows with nothing to fill in are left alone, updated_at included
+        condition = ' OR '.join(['({table}.{c} IS NULL AND EXCLUDED.{c} IS NOT NULL)'.format(c=c, table=table)
+                                 for c in label_columns])
+    else:
+        updates = ['{c} = COALESCE(EXCLUDED.{c}, {table}.{c})'.format(c=c, table=table) for c in label_columns]
+        condition = 'TRUE'
+    if 'updated_at' in columns:
+        updates.append('updated_at = EXCLUDED.updated_at')
+    # DISTINCT ON so a key repeated in one write doesn't update the same row twice
+    return f"""
+        INSERT INTO {table} ({column_list})
+        SELECT DISTINCT ON ({conflict_list}) {column_list} FROM pg_temp.{STAGING_TABLE}
+        ON CONFLICT ({conflict_list}) DO UPDATE SET {', '.join(updates)}
+        WHERE {condition}
+    """
+
+def write_rescue_feedback(cursor, values, columns=feedback_columns, on_conflict='ignore',
+                          conflict_columns=('owner_id', 'owner_type'), table='rescue_feedback'):
+    """Bulk write results to rescue_feedback: COPY into a temporary staging
+        table, then merge with one INSERT ... ON CONFLICT statement
+        The caller commits, unless a pool is given
+
+    Arguments:
+        cursor: Cursor on a PSQL connection, or a ConnectionPool, in which case
+            a pooled connection is used and committed
+        values: Iterable of tuples, one per row, ordered like columns
+        columns: List of column names
+        on_conflict: String, 'ignore' or 'update'; see get_merge_query
+        conflict_columns: Tuple of columns with a unique index on the table
+        table: String, table to merge into
+
+    Returns: Dictionary with rows staged, rows written, seconds and rows per second"""
+
+    if is_pool(cursor):
+        with cursor.cursor() as pooled_cursor:
+            return write_rescue_feedback(pooled_cursor, values, columns, on_conflict, conflict_columns, table)
+
+    start = time.perf_counter()
+    # Qualified with pg_temp, so a permanent table of the same name is never dropped;
+    # one may be left from an earlier write in the same transaction
+    cursor.execute(f"DROP TABLE IF EXISTS pg_temp.{STAGING_TABLE}")
+    cursor.execute(f"CREATE TEMP TABLE {STAGING_TABLE} ON COMMIT DROP AS "
+                   f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA")
+
+    rows_staged = copy_rows(cursor, f"pg_temp.{STAGING_TABLE}", columns, values)
+    cursor.execute(get_merge_query(columns, on_conflict, conflict_columns, table))
+    rows_written = cursor.rowcount
+    cursor.execute(f"DROP TABLE pg_temp.{STAGING_TABLE}")
+
+    seconds = time.perf_counter() - start
+    metrics.observe('write_seconds', seconds, table=table)
+    metrics.increment('rows_staged', rows_staged, table=table)
+    # rowcount is -1 when the cursor can't tell
+    metrics.increment('rows_written', max(rows_written, 0), table=table)
+    stats = {'rows_staged': rows_staged, 'rows_written': rows_written, 'seconds': seconds,
+             'rows_per_second': rows_staged/max(seconds, 1e-9)}
+    print("Wrote {} of {} rows to {} in {:.2f}s ({:.0f} rows/s)".format(
+        rows_written, rows_staged, table, seconds, stats['rows_per_second']))
+    return stats
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from feedback import metrics
+
+default_cache_path = "{}/../data/cache/responses.sqlite".format(os.path.dirname(__file__))
+
+def get_prompt_hash(prompt):
+    """Hash the contents of a prompt file
+
+    Arguments:
+        prompt: String, the prompt text
+
+    Returns: String, hex SHA-256 digest"""
+
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+def get_cache_key(model_name, prompt, comment, prompt_hash=None):
+    """Content-addressed key for one LLM classification
+
+    Arguments:
+        model_name: String, name of the model
+        prompt: String, the prompt text for the task
+        comment: String, the rendered rescue comment
+        prompt_hash: String or None, get_prompt_hash(prompt), if already known
+
+    Returns: String, hex SHA-256 digest of (model, prompt contents, comment)"""
+
+    if prompt_hash is None:
+        prompt_hash = get_prompt_hash(prompt)
+    key = "\0".join([model_name, prompt_hash, comment])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Persistent SQLite cache of parsed LLM responses, with size and age eviction"""
+
+    def __init__(self, path=default_cache_path, max_entries=1000000, max_age_days=180):
+        """Open (or create) a response cache
+
+        Arguments:
+            path: String, location of the SQLite file
+            max_entries: Integer, number of entries kept after eviction
+            max_age_days: Float, entries older than this are evicted"""
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.pending_writes = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            task TEXT,
+            prompt_hash TEXT,
+            response TEXT,
+            created_at REAL,
+            last_used REAL
+        )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_task ON responses (task, prompt_hash)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+
+    def get_by_key(self, key):
+        """Look up a response by its cache key
+
+        Arguments:
+            key: String, from get_cache_key
+
+        Returns: Dictionary with the parsed response, or None on a miss"""
+
+        row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            metrics.increment('cache_lookups', result='miss')
+            return None
+        self.hits += 1
+        metrics.increment('cache_lookups', result='hit')
+        self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self._write_done()
+        return json.loads(row[0])
+
+    def get(self, model_name, task, prompt, comment):
+        """Look up the response for a (model, prompt, comment)
+
+        Arguments:
+            model_name: String, name of the model
+            task: String, the task the prompt is for
+            prompt: String, the prompt text
+            comment: String, the rendered rescue comment
+
+        Returns: Dictionary with the parsed response, or None on a miss"""
+
+        return self.get_by_key(get_cache_key(model_name, prompt, comment))
+
+    def put_by_key(self, key, model_name, task, prompt_hash, response):
+        """Store a parsed response under a precomputed key
+
+        Arguments:
+            key: String, from get_cache_key
+            model_name: String, name of the model
+            task: String, the task the prompt is for
+            prompt_hash: String, from get_prompt_hash
+            response: Dictionary, the parsed JSON output
+
+        Returns: Nothing
+
+        Side Effects: Inserts or replaces the entry"""
+
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, model_name, task, prompt_hash, json.dumps(response), now, now))
+        self._write_done()
+
+    def _write_done(self, commit_every=1000):
+        # Commit in groups; a commit per write dominates the cost of large runs
+        self.pending_writes += 1
+        if self.pending_writes >= commit_every:
+            self.commit()
+
+    def commit(self):
+        """Commit pending writes to disk
+
+        Returns: Nothing"""
+
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def put(self, model_name, task, prompt, comment, response):
+        """Store the parsed response for a (model, prompt, comment)
+
+        Arguments:
+            model_name: String, name of the model
+            task: String, the task the prompt is for
+            prompt: String, the prompt text
+            comment: String, the rendered rescue comment
+            response: Dictionary, the parsed JSON output
+
+        Returns: Nothing
+
+        Side Effects: Inserts or replaces the entry"""
+
+        self.put_by_key(get_cache_key(model_name, prompt, comment), model_name, task,
+                        get_prompt_hash(prompt), response)
+
+    def remove_stale_prompts(self, prompts):
+        """Drop entries written with an older version of a task's prompt
+            Other tasks' entries are left untouched
+
+        Arguments:
+            prompts: Dictionary mapping task name to the current prompt text
+
+        Returns: Integer, number of entries removed"""
+
+        removed = 0
+        for task in prompts:
+            cursor = self.connection.execute(
+                "DELETE FROM responses WHERE task = ? AND prompt_hash != ?",
+                (task, get_prompt_hash(prompts[task])))
+            removed += cursor.rowcount
+        self.commit()
+        return removed
+
+    def evict(self):
+        """Evict entries older than max_age_days, then the least recently used
+            entries beyond max_entries
+
+        Returns: Integer, number of entries removed"""
+
+        cutoff = time.time() - self.max_age_days*24*3600
+        removed = self.connection.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+        removed += self.connection.execute(
+            """DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+            (self.max_entries,)).rowcount
+        self.commit()
+        return removed
+
+    def stats(self):
+        """Hit/miss counters for this session
+
+        Returns: Dictionary with hits, misses, hit_rate and entries"""
+
+        entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits/lookups if lookups else 0.0, 'entries': entries}
+
+    def close(self):
+        """Evict old entries, commit and close the cache
+
+        Returns: Nothing"""
+
+        self.evict()
+        self.connection.close()
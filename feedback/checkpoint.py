@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+default_checkpoint_path = "{}/../data/state/checkpoints/generate_feedback.jsonl".format(os.path.dirname(__file__))
+
+class Checkpoint:
+    """Append-only JSONL file of the labels of completed (rescue, task)
+        requests, so a run that crashes or is killed can resume where it
+        stopped instead of calling the model again
+        Each record holds the hash of the prompt its labels came from, so
+        labels from a prompt edited since are not reused"""
+
+    def __init__(self, model_name, path=default_checkpoint_path, flush_every=100, flush_interval=5):
+        """Open a checkpoint, loading the labels a previous run left in it
+
+        Arguments:
+            model_name: String, name of the model; labels from other models are ignored
+            path: String, location of the checkpoint file
+            flush_every: Integer, completed requests buffered before writing
+            flush_interval: Float, seconds between writes at most"""
+
+        self.model_name = model_name
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.labels = self.load()
+        self.resumed = len(self.labels)
+        self.added = 0
+
+    def load(self):
+        """Read the labels in the checkpoint file
+
+        Returns: Dictionary mapping (owner_id, owner_type) as Strings to a
+            dictionary mapping task name to a tuple of (label, prompt hash)"""
+
+        labels = {}
+        if not os.path.exists(self.path):
+            return labels
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line is cut short if the run was killed mid-write
+                    continue
+                if record['model'] != self.model_name:
+                    continue
+                # Records written before prompt hashes were kept never match a prompt
+                prompt_hash = record.get('prompt_hash')
+                labels.setdefault((record['id'], record['type']), {}).update(
+                    {task: (value, prompt_hash) for task, value in record['labels'].items()})
+        return labels
+
+    def add(self, owner_id, owner_type, labels, prompt_hash):
+        """Record the labels of a completed request
+
+        Arguments:
+            owner_id: Id of the rescue
+            owner_type: String, type of the rescue
+            labels: Dictionary mapping task name to its label
+            prompt_hash: String, from get_prompt_hash of the prompt that was asked
+
+        Returns: Nothing"""
+
+        key = (str(owner_id), str(owner_type))
+        with self.lock:
+            self.labels.setdefault(key, {}).update({task: (value, prompt_hash) for task, value in labels.items()})
+            self.buffer.append({'id': key[0], 'type': key[1], 'model': self.model_name, 'prompt_hash': prompt_hash,
+                                'labels': labels})
+            self.added += 1
+            if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._write()
+
+    def _write(self):
+        if len(self.buffer) > 0:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as w:
+                w.write("".join(json.dumps(record) + "\n" for record in self.buffer))
+                w.flush()
+                os.fsync(w.fileno())
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        """Write the buffered labels to disk"""
+        with self.lock:
+            self._write()
+
+    def get_local_labels(self, feedbacks, tasks, prompt_hashes):
+        """Labels already in the checkpoint, in the format of LocalPrefilter.resolve
+            Labels from a prompt other than the current one are ignored
+
+        Arguments:
+            feedbacks: DataFrame with id and owner_type
+            tasks: List of task names
+            prompt_hashes: Dictionary mapping task name to the hash of the
+                prompt its label now comes from
+
+        Returns: DataFrame with the same index as feedbacks and one column
+            per task, holding the label where completed and None elsewhere"""
+
+        local_labels = pd.DataFrame(None, index=feedbacks.index, columns=tasks, dtype=object)
+        for i, owner_id, owner_type in zip(feedbacks.index, feedbacks['id'], feedbacks['owner_type']):
+            labels = self.labels.get((str(owner_id), str(owner_type)))
+            if labels is None:
+                continue
+            for task, (value, prompt_hash) in labels.items():
+                if task in local_labels and prompt_hash is not None and prompt_hash == prompt_hashes.get(task):
+                    local_labels.at[i, task] = value
+        return local_labels
+
+    def clear(self):
+        """Remove the checkpoint, once every result is written to the database"""
+        with self.lock:
+            self.buffer = []
+            self.labels = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+def merge_local_labels(local_labels, other_labels):
+    """Combine two sets of locally resolved labels, the first taking precedence
+
+    Arguments:
+        local_labels: DataFrame, e.g. from Checkpoint.get_local_labels
+        other_labels: DataFrame with the same index and columns, or None
+
+    Returns: DataFrame"""
+
+    if other_labels is None:
+        return local_labels
+    return local_labels.where(local_labels.notnull(), other_labels)
@@ -0,0 +1,35 @@
+# Tasks are encoded by their position here, so batches in flight still
+# decode after a change; only ever append to this list
+task_codes = ['recipient_problem', 'inadequate_food', 'donor_problem',
+              'direction_problem', 'earlier_pickup', 'system_problem',
+              'update_contact', 'positive_comment', 'fused']
+task_index = {task: idx for idx, task in enumerate(task_codes)}
+
+def encode_custom_id(task, owner_id, owner_type):
+    """Encode a batch request's custom_id as task code:owner id:owner type
+        e.g. 3:1234:Rescue
+
+    Arguments:
+        task: String, task name or FUSED_TASK
+        owner_id: Integer or String, id of the rescue
+        owner_type: String, type of the owner, e.g. Rescue
+
+    Returns: String, custom_id"""
+
+    return "{}:{}:{}".format(task_index[task], owner_id, owner_type)
+
+def decode_custom_id(custom_id):
+    """Decode a custom_id from encode_custom_id, or from the older
+        task_ownerid_ownertype format used by earlier batches
+
+    Arguments:
+        custom_id: String
+
+    Returns: Tuple of (task, owner_id, owner_type), with owner_id a String"""
+
+    if ':' in custom_id:
+        code, owner_id, owner_type = custom_id.split(':', 2)
+        return task_codes[int(code)], owner_id, owner_type
+
+    task, owner_id, owner_type = custom_id.rsplit('_', 2)
+    return task, owner_id, owner_type
@@ -1,5 +1,12 @@
 import psycopg2
+import psycopg2.pool
 import pandas as pd 
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from feedback import metrics
 
 def open_connection(dbname,user,password,host,port='5432'):
     """Connect to a PostgreSQL database 
@@ -25,38 +32,283 @@ def open_connection(dbname,user,password,host,port='5432'):
 
     except (Exception, psycopg2.Error) as error:
         print("Error while connecting to PostgreSQL:", error)
+        raise
     
     return {'connection': connection, 'cursor': cursor} 
 
-def run_query(cursor,sql_statement):
+class ConnectionPool:
+    """Thread-safe pool of PSQL connections, shared by the scripts,
+        classification workers and writers"""
+
+    def __init__(self,dbname,user,password,host,port='5432',minconn=1,maxconn=8,
+                 health_check_after=30,connect_retries=3):
+        """Create the pool
+        
+        Arguments:
+            dbname: String, database name
+            user: String, database username
+            password: String, database password for username
+            host: String, IP Address trying to connect to
+            port: String, should be 5432 by default
+            minconn: Integer, connections opened up front
+            maxconn: Integer, maximum connections open at once
+            health_check_after: Float, connections idle for longer than this
+                many seconds are checked with SELECT 1 before use
+            connect_retries: Integer, attempts to open the pool or replace 
+                a broken connection"""
+
+        self.connect_kwargs = {'dbname': dbname, 'user': user, 'password': password, 
+                               'host': host, 'port': port}
+        self.health_check_after = health_check_after
+        self.connect_retries = connect_retries
+        self.last_used = {}
+        self.pool = self._retry(lambda: psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **self.connect_kwargs))
+
+    def _retry(self, function):
+        for attempt in range(self.connect_retries):
+            try:
+                return function()
+            except psycopg2.OperationalError as error:
+                print("Error while connecting to PostgreSQL (attempt {} of {}):".format(attempt+1, self.connect_retries), error)
+                if attempt == self.connect_retries-1:
+                    raise
+                time.sleep(2**attempt)
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        if time.time() - self.last_used.get(id(connection), 0) < self.health_check_after:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _getconn(self):
+        start = time.perf_counter()
+        connection = self._retry(self.pool.getconn)
+        while not self._is_healthy(connection):
+            # Drop the broken connection; the pool opens a fresh one
+            self.last_used.pop(id(connection), None)
+            self.pool.putconn(connection, close=True)
+            connection = self._retry(self.pool.getconn)
+        metrics.observe('pool_wait_seconds', time.perf_counter() - start)
+        return connection
+
+    @contextmanager
+    def checkout(self):
+        """Check out a connection, committing on success and rolling back on error
+        
+        Returns: Context manager yielding a psycopg2 connection"""
+
+        connection = self._getconn()
+        broken = False
+        try:
+            yield connection
+            connection.commit()
+        except Exception:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            broken = broken or bool(connection.closed)
+            if broken:
+                self.last_used.pop(id(connection), None)
+            else:
+                self.last_used[id(connection)] = time.time()
+            self.pool.putconn(connection, close=broken)
+
+    @contextmanager
+    def cursor(self):
+        """Check out a connection and open a cursor on it
+        
+        Returns: Context manager yielding a psycopg2 cursor"""
+
+        with self.checkout() as connection:
+            cursor = connection.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def close(self):
+        """Close every connection in the pool
+        
+        Returns: Nothing"""
+
+        self.pool.closeall()
+
+def open_pool_from_environment(minconn=1,maxconn=8):
+    """Create a connection pool from the POSTGRES_DB, POSTGRES_USER, 
+        POSTGRES_PASSWORD, DATABASE_HOST and DATABASE_PORT environment variables
+    
+    Arguments:
+        minconn: Integer, connections opened up front
+        maxconn: Integer, maximum connections open at once
+        
+    Returns: ConnectionPool"""
+
+    return ConnectionPool(os.environ.get("POSTGRES_DB"), os.environ.get("POSTGRES_USER"),
+                          os.environ.get("POSTGRES_PASSWORD"), os.environ.get("DATABASE_HOST"),
+                          os.environ.get("DATABASE_PORT") or '5432', minconn=minconn, maxconn=maxconn)
+
+def is_pool(conn):
+    """Whether a database handle is a ConnectionPool rather than a 
+        connection or cursor
+    
+    Arguments:
+        conn: ConnectionPool, connection or cursor
+        
+    Returns: Boolean"""
+
+    return hasattr(conn, 'checkout')
+
+def run_query(cursor,sql_statement,params=None):
     """Run an SQL statement and retrieve results from a PSQL database
     
     Arguments:
-        cursor: Connection to PSQL Database
+        cursor: Connection to PSQL Database, or a ConnectionPool
         sql_statement: String, SQL Statement
+        params: Dictionary or None, values for the statement's %(name)s placeholders
         
     Returns: List of rows, from psycopg2"""
 
-    cursor.execute(sql_statement)
-    column_names = [desc[0] for desc in cursor.description]
+    if is_pool(cursor):
+        with cursor.cursor() as pooled_cursor:
+            return run_query(pooled_cursor, sql_statement, params)
+
+    with metrics.timer('query_seconds', statement='run_query'):
+        cursor.execute(sql_statement, params)
+        column_names = [desc[0] for desc in cursor.description]
     
-    results = []
-    for row in cursor.fetchall():
-        row_dict = dict(zip(column_names, row))
-        results.append(row_dict)
+        results = []
+        for row in cursor.fetchall():
+            row_dict = dict(zip(column_names, row))
+            results.append(row_dict)
+    metrics.increment('rows_fetched', len(results), statement='run_query')
 
     return results 
 
-def load_data(query, conn):
+def load_data(query, conn, params=None):
     """Read in a query into a Pandas Dataframe
     
     Arguments:
         query: String, what query to run
-        conn: PSQL Connection
+        conn: PSQL Connection, or a ConnectionPool
+        params: Dictionary or None, values for the query's %(name)s placeholders
         
     Returns: Pandas Dataframe"""
 
-    return pd.read_sql_query(query, conn)
+    if is_pool(conn):
+        with conn.checkout() as connection:
+            return load_data(query, connection, params)
+
+    with metrics.timer('query_seconds', statement='load_data'):
+        data = pd.read_sql_query(query, conn, params=params)
+    metrics.increment('rows_fetched', len(data), statement='load_data')
+    return data
+
+def to_prepared_statement(query, param_names):
+    """Rewrite a query with %(name)s placeholders into the $1, $2, ... form
+        PREPARE expects
+    
+    Arguments:
+        query: String, query with %(name)s placeholders
+        param_names: List of placeholder names; the first becomes $1
+        
+    Returns: String"""
+
+    positions = {name: idx+1 for idx, name in enumerate(param_names)}
+    return re.sub(r"%\((\w+)\)s", lambda match: "${}".format(positions[match.group(1)]), query).strip().rstrip(';')
+
+def prepare(cursor, name, query, param_names):
+    """Prepare a statement on the cursor's connection, unless it already is
+    
+    Arguments:
+        cursor: Cursor on a PSQL connection
+        name: String, name of the prepared statement
+        query: String, query with %(name)s placeholders
+        param_names: List of placeholder names, in the order EXECUTE passes them
+        
+    Returns: String, the EXECUTE statement, with %s for each parameter"""
+
+    # Prepared statements belong to the session, and pooled connections are reused
+    cursor.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s", (name,))
+    if cursor.fetchone() is None:
+        cursor.execute("PREPARE {} AS {}".format(name, to_prepared_statement(query, param_names)))
+    return "EXECUTE {} ({})".format(name, ", ".join(["%s"]*len(param_names)))
+
+def load_prepared(name, query, conn, params):
+    """Run a query as a server-side prepared statement, so Postgres plans it
+        once per connection instead of on every call
+    
+    Arguments:
+        name: String, name of the prepared statement
+        query: String, what query to run, with %(name)s placeholders
+        conn: PSQL Connection, or a ConnectionPool
+        params: Dictionary, values for the placeholders
+        
+    Returns: Pandas Dataframe"""
+
+    if is_pool(conn):
+        with conn.checkout() as connection:
+            return load_prepared(name, query, connection, params)
+
+    param_names = sorted(params)
+    cursor = conn.cursor()
+    try:
+        with metrics.timer('query_seconds', statement=name):
+            cursor.execute(prepare(cursor, name, query, param_names), [params[p] for p in param_names])
+            column_names = [desc[0] for desc in cursor.description]
+            data = pd.DataFrame(cursor.fetchall(), columns=column_names)
+        metrics.increment('rows_fetched', len(data), statement=name)
+        return data
+    finally:
+        cursor.close()
+
+def stream_data(query, conn, chunk_size=10000, cursor_name='feedback_stream', params=None):
+    """Stream the results of a query in chunks, using a server-side cursor
+        so the full result never has to fit in memory
+    
+    Arguments:
+        query: String, what query to run
+        conn: PSQL Connection, or a ConnectionPool; a pooled connection
+            is held until the stream is exhausted or closed
+        chunk_size: Integer, number of rows fetched per round-trip and per chunk
+        cursor_name: String, name of the server-side cursor
+        params: Dictionary or None, values for the query's %(name)s placeholders
+        
+    Returns: Generator of Pandas Dataframes, each with at most chunk_size rows"""
+
+    if is_pool(conn):
+        with conn.checkout() as connection:
+            yield from stream_data(query, connection, chunk_size, cursor_name, params)
+        return
+
+    # withhold keeps the cursor open if the caller commits between chunks
+    cursor = conn.cursor(name=cursor_name, withhold=True)
+    cursor.itersize = chunk_size
+    try:
+        cursor.execute(query, params)
+        column_names = None
+        while True:
+            # Timed per round-trip, not while the caller works on a chunk
+            with metrics.timer('query_seconds', statement=cursor_name):
+                rows = cursor.fetchmany(chunk_size)
+            if column_names is None:
+                column_names = [desc[0] for desc in cursor.description]
+            if len(rows) == 0:
+                break
+            metrics.increment('rows_fetched', len(rows), statement=cursor_name)
+            yield pd.DataFrame(rows, columns=column_names)
+    finally:
+        cursor.close()
 
 def close_connection(connection, cursor):
     """Close connection to PSQL database
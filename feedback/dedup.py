@@ -0,0 +1,226 @@
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from feedback.evaluation import convert
+from feedback.fr_feedback import all_tasks
+
+# Mersenne prime for the MinHash permutations
+MINHASH_PRIME = (1 << 61) - 1
+
+def remove_punctuation(match):
+    """Replacement for a character that is neither a letter, a digit nor a
+        space: symbols, such as emoji, are kept, and the rest become a space"""
+
+    return match.group(0) if unicodedata.category(match.group(0)).startswith('S') else " "
+
+def normalize_comment(comment):
+    """Normalize a comment so trivially different copies hash the same:
+        lowercase, digits replaced, punctuation and extra spaces removed
+        Letters of every script and symbols such as emoji are kept, so
+        comments in other languages, or of emoji alone, stay distinct
+
+    Arguments:
+        comment: String
+
+    Returns: String"""
+
+    comment = str(comment).lower()
+    comment = re.sub(r"\d+", "0", comment, flags=re.UNICODE)
+    comment = re.sub(r"[^\w\s]", remove_punctuation, comment, flags=re.UNICODE)
+    return " ".join(comment.split())
+
+def get_shingles(comment, k=3):
+    """Overlapping word k-grams of a normalized comment; short comments are
+        a single shingle
+
+    Arguments:
+        comment: String, normalized
+        k: Integer, words per shingle
+
+    Returns: Set of Strings"""
+
+    words = comment.split()
+    if len(words) <= k:
+        return {comment}
+    return {" ".join(words[i:i+k]) for i in range(len(words)-k+1)}
+
+def get_minhash_signatures(comments, num_perm=64, k=3, seed=42):
+    """MinHash signature of each comment's shingles
+
+    Arguments:
+        comments: List of normalized comments
+        num_perm: Integer, number of hash functions
+        k: Integer, words per shingle
+        seed: Integer, seed for the hash functions
+
+    Returns: Numpy array, one row of num_perm values per comment"""
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+
+    signatures = np.empty((len(comments), num_perm), dtype=np.uint64)
+    for idx, comment in enumerate(comments):
+        hashes = np.array([zlib.crc32(s.encode('utf-8')) for s in get_shingles(comment, k)], dtype=np.uint64)
+        # 32-bit hashes times 31-bit multipliers stay below 2^63
+        signatures[idx] = ((np.outer(hashes, a) + b) % MINHASH_PRIME).min(axis=0)
+    return signatures
+
+def cluster_comments(comments, threshold=0.8, num_perm=64, bands=16, k=3):
+    """Group near-identical comments
+        Comments with the same normalized text are always grouped; with a
+        threshold below 1, comments whose estimated Jaccard similarity (of
+        word k-grams) is at least the threshold are grouped too, found
+        through locality-sensitive hashing of their MinHash signatures
+
+    Arguments:
+        comments: Series of volunteer comments
+        threshold: Float, minimum similarity to group two comments;
+            1 only groups identical normalized text
+        num_perm: Integer, number of MinHash functions
+        bands: Integer, number of LSH bands; num_perm must be a multiple
+        k: Integer, words per shingle
+
+    Returns: Series with the same index as comments, holding the index label
+        of each comment's representative (its first member); a comment with
+        no text left after normalization is its own representative"""
+
+    normalized = comments.fillna("").map(normalize_comment)
+    # Empty comments share no content, so they are never grouped
+    non_empty = (normalized != "").to_numpy()
+    # Exact duplicates of the normalized text collapse to their first occurrence
+    first = normalized[non_empty].drop_duplicates()
+    parent = np.arange(len(first))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        root_a, root_b = find(i), find(j)
+        parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    if threshold < 1 and len(first) > 1:
+        signatures = get_minhash_signatures(list(first), num_perm, k)
+        rows = num_perm//bands
+        for band in range(bands):
+            buckets = {}
+            for idx, key in enumerate(map(bytes, signatures[:, band*rows:(band+1)*rows])):
+                buckets.setdefault(key, []).append(idx)
+            for members in buckets.values():
+                if len(members) < 2:
+                    continue
+                bucket_signatures = signatures[members]
+                for j in range(1, len(members)):
+                    # Candidates are only merged if their signatures agree often enough,
+                    # checked against every earlier member of the bucket, not just the first
+                    similar = np.mean(bucket_signatures[:j] == bucket_signatures[j], axis=1) >= threshold
+                    for other in np.flatnonzero(similar):
+                        union(members[other], members[j])
+
+    labels = first.index.to_numpy()
+    representative_of_text = {text: labels[find(idx)] for idx, text in enumerate(first)}
+    clusters = comments.index.to_numpy().copy()
+    clusters[non_empty] = normalized[non_empty].map(representative_of_text).to_numpy()
+    return pd.Series(clusters, index=comments.index)
+
+def deduplicate(feedbacks, threshold=0.8, **kwargs):
+    """Keep one representative per group of near-identical comments
+
+    Arguments:
+        feedbacks: DataFrame of feedbacks, with volunteer_comment
+        threshold: Float, minimum similarity to group two comments
+        kwargs: Passed on to cluster_comments
+
+    Returns: Tuple of (DataFrame of representatives, Series mapping each
+        row's index label to its representative's)"""
+
+    clusters = cluster_comments(feedbacks['volunteer_comment'], threshold, **kwargs)
+    representatives = feedbacks.loc[clusters.unique()]
+    print("Deduplicated {} comments to {} representatives".format(len(feedbacks), len(representatives)))
+    return representatives, clusters
+
+def fan_out_labels(annotated_feedback, feedbacks, clusters, tasks=all_tasks):
+    """Copy each representative's labels to every member of its group
+
+    Arguments:
+        annotated_feedback: DataFrame with owner_id and the tasks, for the
+            representatives, from generate_prompts_and_analyze_feedback
+        feedbacks: DataFrame of every feedback, with id and owner_type
+        clusters: Series, from deduplicate
+
+    Returns: DataFrame with owner_id, the tasks and owner_type for every feedback"""
+
+    labels = annotated_feedback.drop_duplicates(subset='owner_id').set_index('owner_id')[tasks]
+    representative_ids = feedbacks.loc[clusters.to_numpy(), 'id'].to_numpy()
+    fanned_out = labels.reindex(representative_ids).reset_index(drop=True)
+    fanned_out.insert(0, 'owner_id', feedbacks['id'].to_numpy())
+    fanned_out['owner_type'] = feedbacks['owner_type'].to_numpy()
+    return fanned_out
+
+def get_members(feedbacks, clusters):
+    """The members each representative's labels should be copied to, for
+        batch runs, where labels arrive later
+
+    Arguments:
+        feedbacks: DataFrame of every feedback, with id and owner_type
+        clusters: Series, from deduplicate
+
+    Returns: Dictionary mapping "owner_id:owner_type" of each representative
+        with other members to a list of [owner_id, owner_type] of those members"""
+
+    members = {}
+    owners = feedbacks[['id', 'owner_type']].astype(str)
+    for i, representative in clusters.items():
+        if i == representative:
+            continue
+        key = "{}:{}".format(*owners.loc[representative])
+        members.setdefault(key, []).append(list(owners.loc[i]))
+    return members
+
+def get_cluster_report(clusters):
+    """Distribution of cluster sizes
+
+    Arguments:
+        clusters: Series, from cluster_comments or deduplicate
+
+    Returns: Tuple of (DataFrame with the number of clusters of each size,
+        dictionary with comments, clusters, calls saved and largest cluster)"""
+
+    sizes = clusters.value_counts()
+    distribution = sizes.value_counts().sort_index().rename_axis('cluster_size').reset_index(name='clusters')
+    summary = {'comments': len(clusters), 'clusters': len(sizes),
+               'calls_saved': 1 - len(sizes)/max(len(clusters), 1),
+               'largest_cluster': int(sizes.max()) if len(sizes) else 0}
+    return distribution, summary
+
+def get_dedup_report(groundtruth, thresholds=(1.0, 0.9, 0.8, 0.7, 0.5), tasks=all_tasks, **kwargs):
+    """Calls saved and label accuracy of fanning out at several thresholds,
+        measured by copying each representative's annotation to its members
+
+    Arguments:
+        groundtruth: DataFrame of annotations, with volunteer_comment and the tasks
+            (e.g. data/annotations/pre_deploy_eval.csv)
+        thresholds: List of similarity thresholds to try
+        tasks: List of tasks to score
+        kwargs: Passed on to cluster_comments
+
+    Returns: DataFrame with one row per threshold"""
+
+    groundtruth = groundtruth.reset_index(drop=True)
+    truth = groundtruth[tasks].apply(lambda column: column.map(convert))
+    rows = []
+    for threshold in thresholds:
+        clusters = cluster_comments(groundtruth['volunteer_comment'], threshold, **kwargs)
+        fanned_out = truth.loc[clusters.to_numpy()].to_numpy()
+        _, summary = get_cluster_report(clusters)
+        rows.append({'threshold': threshold, **summary,
+                     'label_accuracy': (fanned_out == truth.to_numpy()).mean(),
+                     'comment_accuracy': (fanned_out == truth.to_numpy()).all(axis=1).mean()})
+    return pd.DataFrame(rows)
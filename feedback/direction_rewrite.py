@@ -0,0 +1,321 @@
+import datetime
+import difflib
+import json
+import os
+
+import pandas as pd
+
+from feedback.async_engine import run_requests, print_run_stats
+from feedback.batch_collector import stream_output_lines, refresh_shards, is_true
+from feedback.batch_manager import write_shards, submit_shards
+from feedback.cache import get_cache_key, get_prompt_hash
+from feedback.fr_feedback import get_feedback_by_date_instruction, get_predictions_by_date, get_cached_batch_line
+
+default_prompt_path = "{}/../data/prompts/update_direction_location.txt".format(os.path.dirname(__file__))
+default_rewrite_path = "{}/../data/rewrites/direction_rewrites.csv".format(os.path.dirname(__file__))
+default_manifest_path = "{}/../data/state/direction_rewrite_manifest.json".format(os.path.dirname(__file__))
+default_pending_path = "{}/../data/state/direction_rewrite_pending.jsonl".format(os.path.dirname(__file__))
+default_shard_dir = "{}/../data/batches/direction_rewrite".format(os.path.dirname(__file__))
+
+# Task name the rewrite responses are cached and their usage recorded under
+REWRITE_TASK = 'update_direction'
+
+rewrite_columns = ['location_type', 'location_id', 'location_name', 'instruction', 'rewritten_instruction',
+                   'instruction_diff', 'explanation', 'num_comments', 'rescue_ids', 'model', 'created_at']
+
+def load_rewrite_prompt(file_name=default_prompt_path):
+    """Read the prompt that rewrites one location's instructions
+
+    Arguments:
+        file_name: String, location of the prompt
+
+    Returns: String, the prompt text"""
+
+    return open(file_name, encoding='utf-8').read()
+
+def get_direction_complaints(conn, start_date, end_date, organization_id):
+    """Comments labelled direction_problem, with the instructions of their locations
+
+    Arguments:
+        conn: Database PSQL connection or ConnectionPool
+        start_date: String, start date, of the form 2022-05-01
+        end_date: String, end date, of the form 2022-05-10
+        organization_id: Integer, organization whose predictions are used
+
+    Returns: DataFrame, one row per (rescue, donor location, recipient location)"""
+
+    feedbacks = get_feedback_by_date_instruction(conn, start_date, end_date)
+    predictions = get_predictions_by_date(conn, start_date, end_date, organization_id)
+    direction_ids = predictions.loc[predictions['direction_problem'] == True, 'owner_id']
+    return feedbacks[feedbacks['id'].isin(direction_ids)].reset_index(drop=True)
+
+def group_by_location(complaints):
+    """Group complaints by the location whose instructions they may correct
+        Each rescue counts towards both its donor and its recipient location,
+        and a comment repeated at a location is only sent once
+
+    Arguments:
+        complaints: DataFrame from get_direction_complaints
+
+    Returns: DataFrame with one row per location: location_type, location_id,
+        location_name, instruction, comments and rescue_ids"""
+
+    groups = []
+    for location_type in ['donor', 'recipient']:
+        columns = {'{}_location_id'.format(location_type): 'location_id',
+                   '{}_name'.format(location_type): 'location_name',
+                   '{}_instruction'.format(location_type): 'instruction'}
+        rows = complaints[list(columns) + ['id', 'volunteer_comment']].rename(columns=columns)
+        rows = rows.assign(instruction=rows['instruction'].fillna(''))
+        grouped = rows.groupby('location_id', sort=False).agg(
+            location_name=('location_name', 'first'), instruction=('instruction', 'first'),
+            comments=('volunteer_comment', lambda comments: list(dict.fromkeys(comments))),
+            rescue_ids=('id', lambda ids: sorted(set(ids))))
+        groups.append(grouped.reset_index().assign(location_type=location_type))
+    locations = pd.concat(groups, ignore_index=True)
+    return locations[['location_type', 'location_id', 'location_name', 'instruction', 'comments', 'rescue_ids']]
+
+def get_location_content(location):
+    """Render the input the prompt expects for one location
+
+    Arguments:
+        location: Row of the DataFrame from group_by_location
+
+    Returns: String, JSON"""
+
+    return json.dumps({'location_type': location['location_type'], 'location': location['location_name'],
+                       'instruction': location['instruction'], 'volunteer_comments': location['comments']},
+                      indent=2, ensure_ascii=False)
+
+def get_location_key(location):
+    """Key of a location in results and in batch custom_ids, e.g. donor:1234"""
+    return "{}:{}".format(location['location_type'], location['location_id'])
+
+def get_instruction_diff(instruction, rewritten_instruction):
+    """Word-level diff of a proposed rewrite, with removed words in [-...-]
+        and added words in {+...+}
+
+    Arguments:
+        instruction: String, the current instructions
+        rewritten_instruction: String, the proposed instructions
+
+    Returns: String"""
+
+    old_words = instruction.split()
+    new_words = rewritten_instruction.split()
+    diff = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(a=old_words, b=new_words, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            diff.append(" ".join(old_words[i1:i2]))
+            continue
+        if i2 > i1:
+            diff.append("[-{}-]".format(" ".join(old_words[i1:i2])))
+        if j2 > j1:
+            diff.append("{{+{}+}}".format(" ".join(new_words[j1:j2])))
+    return " ".join(diff)
+
+def get_rewrites(locations, results, model_name):
+    """Proposed rewrites from the model's responses, for the locations it
+        changed
+
+    Arguments:
+        locations: DataFrame from group_by_location
+        results: Dictionary mapping location key to the parsed JSON output
+        model_name: String, name of the model
+
+    Returns: DataFrame with rewrite_columns"""
+
+    current_time = datetime.datetime.now()
+    rewrites = []
+    for _, location in locations.iterrows():
+        output = results.get(get_location_key(location))
+        if output is None or not is_true(output.get('direction_change')):
+            continue
+        rewritten_instruction = output.get('rewritten_direction') or ''
+        rewrites.append({'location_type': location['location_type'], 'location_id': location['location_id'],
+                         'location_name': location['location_name'], 'instruction': location['instruction'],
+                         'rewritten_instruction': rewritten_instruction,
+                         'instruction_diff': get_instruction_diff(location['instruction'], rewritten_instruction),
+                         'explanation': output.get('explanation', ''), 'num_comments': len(location['comments']),
+                         'rescue_ids': " ".join(map(str, location['rescue_ids'])), 'model': model_name,
+                         'created_at': current_time})
+    return pd.DataFrame(rewrites, columns=rewrite_columns)
+
+def save_rewrites(rewrites, file_name=default_rewrite_path):
+    """Append proposed rewrites to a CSV, for review before they are applied
+
+    Arguments:
+        rewrites: DataFrame from get_rewrites
+        file_name: String, location of the CSV
+
+    Returns: Nothing"""
+
+    if os.path.dirname(file_name):
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    rewrites.to_csv(file_name, mode='a', header=not os.path.exists(file_name), index=False)
+
+def rewrite_directions(client, locations, model_name, prompt, cache=None, usage=None, **kwargs):
+    """Propose rewrites for every location, one concurrent call per location
+
+    Arguments:
+        client: OpenAI or AsyncOpenAI client
+        locations: DataFrame from group_by_location
+        model_name: String, name of the model
+        prompt: String, from load_rewrite_prompt
+        cache: ResponseCache or None, checked before calling the model
+        usage: UsageTracker or None, records the tokens and latency of each call
+        kwargs: Passed on to run_requests (e.g. max_concurrency, retry)
+
+    Returns: DataFrame with rewrite_columns"""
+
+    results = {}
+    requests = []
+    for _, location in locations.iterrows():
+        content = get_location_content(location)
+        if cache is not None:
+            cached = cache.get(model_name, REWRITE_TASK, prompt, content)
+            if cached is not None:
+                results[get_location_key(location)] = cached
+                continue
+        requests.append({'key': get_location_key(location), 'task': REWRITE_TASK, 'comment': content,
+                         'content': prompt + content})
+    print("{} locations: {} calls, {} from the cache".format(len(locations), len(requests), len(results)))
+
+    new_results, stats = run_requests(client, requests, model_name, usage=usage, **kwargs)
+    print_run_stats(stats)
+    if cache is not None:
+        for request in requests:
+            if request['key'] in new_results:
+                cache.put(model_name, REWRITE_TASK, prompt, request['comment'], new_results[request['key']])
+        cache.commit()
+    results.update(new_results)
+    return get_rewrites(locations, results, model_name)
+
+def get_rewrite_batch_requests(locations, model_name, prompt, cache=None):
+    """Batch API requests, one per location
+
+    Arguments:
+        locations: DataFrame from group_by_location
+        model_name: String, name of the model
+        prompt: String, from load_rewrite_prompt
+        cache: ResponseCache or None; cached requests are returned already
+            answered, in the Batch API output format
+
+    Returns: Generator of Batch API requests"""
+
+    prompt_hash = get_prompt_hash(prompt)
+    for _, location in locations.iterrows():
+        custom_id = get_location_key(location)
+        content = get_location_content(location)
+        if cache is not None:
+            cached = cache.get_by_key(get_cache_key(model_name, prompt, content, prompt_hash))
+            if cached is not None:
+                yield get_cached_batch_line(custom_id, cached)
+                continue
+        yield {'custom_id': custom_id, 'method': 'POST', 'url': "/v1/chat/completions",
+               'body': {'model': model_name, 'messages': [{"role": "user", "content": prompt + content}],
+                        'response_format': {"type": "json_object"}}}
+
+def submit_rewrite_batch(client, locations, model_name, prompt, manifest, cache=None,
+                         pending_file=default_pending_path, shard_dir=default_shard_dir):
+    """Write and submit the rewrite requests, keeping the locations until
+        collect_rewrite_batches parses their responses
+
+    Arguments:
+        client: OpenAI client
+        locations: DataFrame from group_by_location
+        model_name: String, name of the model
+        prompt: String, from load_rewrite_prompt
+        manifest: BatchManifest, separate from the classification batches'
+        cache: ResponseCache or None
+        pending_file: String, JSONL file of the locations awaiting a response
+        shard_dir: String, directory for shard files
+
+    Returns: Tuple of the number of batch requests and a dictionary mapping
+        location key to the cached responses, which need no batch"""
+
+    cached = {}
+    requests = []
+    for request in get_rewrite_batch_requests(locations, model_name, prompt, cache):
+        if 'response' in request:
+            cached[request['custom_id']] = json.loads(request['response']['body']['choices'][0]['message']['content'])
+        else:
+            requests.append(request)
+
+    os.makedirs(os.path.dirname(pending_file), exist_ok=True)
+    with open(pending_file, "a") as w:
+        for _, location in locations.iterrows():
+            if get_location_key(location) not in cached:
+                record = {k: location[k] for k in locations.columns}
+                record.update({'location_id': str(record['location_id']), 'model': model_name,
+                               'rescue_ids': [str(i) for i in record['rescue_ids']]})
+                w.write(json.dumps(record) + "\n")
+
+    if len(requests) > 0:
+        write_shards(requests, manifest, shard_dir=shard_dir)
+        submit_shards(client, manifest)
+    return len(requests), cached
+
+def load_pending_locations(pending_file=default_pending_path):
+    """Locations submitted by submit_rewrite_batch, the latest submission of each
+
+    Returns: DataFrame like group_by_location's, with a model column"""
+
+    if not os.path.exists(pending_file):
+        return pd.DataFrame(columns=['location_type', 'location_id', 'location_name', 'instruction', 'comments',
+                                     'rescue_ids', 'model'])
+    records = {}
+    for line in open(pending_file):
+        record = json.loads(line)
+        records[get_location_key(record)] = record
+    return pd.DataFrame(list(records.values()))
+
+def collect_rewrite_batches(client, manifest, cache=None, output_file=default_rewrite_path,
+                            pending_file=default_pending_path):
+    """Parse the finished rewrite batches and save their proposed rewrites
+
+    Arguments:
+        client: OpenAI client
+        manifest: BatchManifest passed to submit_rewrite_batch
+        cache: ResponseCache or None, stores each parsed response
+        output_file: String, CSV the rewrites are appended to
+        pending_file: String, JSONL file of the locations awaiting a response
+
+    Returns: DataFrame of the saved rewrites"""
+
+    pending = load_pending_locations(pending_file)
+    keys = {get_location_key(location): i for i, location in pending.iterrows()}
+    prompt = load_rewrite_prompt()
+
+    results = {}
+    for name in refresh_shards(client, manifest):
+        for line in stream_output_lines(client, manifest.shards[name]['output_file_id']):
+            output = json.loads(line)
+            try:
+                results[output['custom_id']] = json.loads(output['response']['body']['choices'][0]['message']['content'])
+            except Exception as e:
+                print("Error processing rewrite {}: {}".format(output.get('custom_id'), e))
+        manifest.update_shard(name, status='ingested')
+        manifest.release_shard(name)
+    manifest.save()
+
+    answered = pending[[get_location_key(location) in results for _, location in pending.iterrows()]]
+    rewrites = []
+    for model_name, locations in answered.groupby('model'):
+        rewrites.append(get_rewrites(locations, results, model_name))
+        if cache is not None:
+            for _, location in locations.iterrows():
+                cache.put(model_name, REWRITE_TASK, prompt, get_location_content(location),
+                          results[get_location_key(location)])
+    if cache is not None:
+        cache.commit()
+    rewrites = pd.concat(rewrites, ignore_index=True) if len(rewrites) > 0 else get_rewrites(answered, {}, None)
+    save_rewrites(rewrites, output_file)
+
+    remaining = pending.drop(index=[keys[k] for k in results if k in keys])
+    with open(pending_file, "w") as w:
+        for _, location in remaining.iterrows():
+            w.write(json.dumps(location.to_dict()) + "\n")
+    print("Collected {} locations, {} proposed rewrites; {} locations still pending".format(
+        len(answered), len(rewrites), len(remaining)))
+    return rewrites
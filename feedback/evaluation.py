@@ -0,0 +1,578 @@
+import asyncio
+import os
+
+import numpy as np
+import pandas as pd
+
+from feedback.async_engine import estimate_tokens, run_requests_async, run_coroutine, print_run_stats
+from feedback.backends import get_backend
+from feedback.fr_feedback import all_tasks, load_prompts, get_fused_prompt, analyze_feedback_concurrent, \
+    get_comments, get_request_content, parse_feedback_output, is_complete_output, FUSED_TASK
+from feedback.retry import RetryPolicy
+
+default_evaluation_path = "{}/../results/evaluation".format(os.path.dirname(__file__))
+
+def convert(x):
+    """Convert a prediction from a CSV file into a 0-1 label
+
+    Arguments:
+        x: Prediction; boolean, integer or string
+
+    Returns: Integer, 0 or 1"""
+
+    if x is True or str(x).lower() == "true":
+        return 1
+    elif x is False or str(x).lower() == "false":
+        return 0
+    elif x in [0, 1]:
+        return x
+    elif str(x) in ["0", "1"]:
+        return int(x)
+    else:
+        return 0
+
+def get_accuracy(ground_truth,predicted):
+    """Fraction of 0-1 predictions that match the ground truth"""
+    return 1-np.mean(np.abs(predicted-ground_truth))
+
+def get_precision(ground_truth, predicted):
+    """Fraction of positive predictions that are correct"""
+    return np.sum(predicted * ground_truth) / (np.sum(predicted) + 1e-8)
+
+def get_recall(ground_truth, predicted):
+    """Fraction of positive ground truth labels that are predicted"""
+    return np.sum(predicted * ground_truth) / (np.sum(ground_truth) + 1e-8)
+
+def get_f1(ground_truth,predicted):
+    """Harmonic mean of precision and recall"""
+    precision = get_precision(ground_truth,predicted)
+    recall = get_recall(ground_truth,predicted)
+    return 2*precision*recall/(precision+recall+1e-8)
+
+def load_groundtruth(file_name, annotator='naveen'):
+    """Load the annotations from one annotator
+
+    Arguments:
+        file_name: String, location of the annotation CSV
+            (e.g. data/annotations/pre_deploy_eval.csv)
+        annotator: String, which annotator to use
+
+    Returns: DataFrame with the annotations"""
+
+    groundtruth = pd.read_csv(file_name)
+    return groundtruth[groundtruth["annotator"] == annotator]
+
+def load_predictions(file_name, tasks=all_tasks):
+    """Load predictions from results/evaluation, converting each label to 0-1
+
+    Arguments:
+        file_name: String, location of the predictions CSV
+        tasks: List of tasks predicted
+
+    Returns: DataFrame with the predictions"""
+
+    predictions = pd.read_csv(file_name)
+    for task in tasks:
+        predictions[task] = predictions[task].map(convert)
+    return predictions
+
+def score_predictions(groundtruth, predictions, tasks=all_tasks):
+    """Compute accuracy, precision, recall and F1 for each task
+        Rows are aligned by id when both have one, otherwise by volunteer comment
+
+    Arguments:
+        groundtruth: DataFrame of annotations
+        predictions: DataFrame of predictions
+        tasks: List of tasks to score
+
+    Returns: DataFrame with one row per task"""
+
+    key = 'id' if 'id' in groundtruth and 'id' in predictions else 'volunteer_comment'
+    merged = groundtruth[[key]+tasks].drop_duplicates(subset=key).merge(
+        predictions[[key]+tasks].drop_duplicates(subset=key), on=key, suffixes=('_true','_pred'))
+
+    scores = []
+    for task in tasks:
+        ground_truth = merged[task+'_true'].map(convert).to_numpy()
+        predicted = merged[task+'_pred'].to_numpy()
+        scores.append({
+            'task': task,
+            'accuracy': get_accuracy(ground_truth,predicted),
+            'precision': get_precision(ground_truth,predicted),
+            'recall': get_recall(ground_truth,predicted),
+            'f1': get_f1(ground_truth,predicted),
+        })
+    return pd.DataFrame(scores).set_index('task')
+
+# Tasks that count towards the aggregates reported with the per-task metrics
+issue_tasks = [t for t in all_tasks if t != 'positive_comment']
+donor_tasks = ['inadequate_food', 'earlier_pickup', 'donor_problem']
+aggregate_tasks = {'any_issue': issue_tasks, 'donor_issue': donor_tasks}
+
+metric_names = ['accuracy', 'precision', 'recall', 'f1']
+
+def get_row_keys(frame, key='volunteer_comment'):
+    """Keys that align the rows of annotation and prediction CSVs
+        A few comments appear more than once in the evaluation set, so
+        comments are keyed by their text and how often it appeared before
+
+    Arguments:
+        frame: DataFrame with the key column
+        key: String, 'id' or 'volunteer_comment'
+
+    Returns: Index"""
+
+    if key == 'id':
+        return pd.Index(frame['id'].astype(str))
+    return pd.MultiIndex.from_arrays([frame[key].to_numpy(), frame.groupby(key, sort=False).cumcount().to_numpy()])
+
+def align_labels(frame, keys, key, tasks, name):
+    """Labels of a frame as a (comments x tasks) array, in the order of keys"""
+
+    frame = frame.set_index(get_row_keys(frame, key))
+    missing = (~keys.isin(frame.index)).sum()
+    if missing > 0:
+        raise Exception("{} is missing {} of {} comments".format(name, missing, len(keys)))
+    return frame[tasks].reindex(keys).apply(lambda column: column.map(convert)).to_numpy(dtype=float)
+
+def load_prediction_stack(model_names=None, directory=default_evaluation_path, tasks=all_tasks, key=None):
+    """Load the predictions of several models into one array, aligned by comment
+
+    Arguments:
+        model_names: List of Strings, CSV names in directory without the
+            extension; defaults to every CSV there
+        directory: String, location of the prediction CSVs
+        tasks: List of tasks predicted
+        key: String, 'id' or 'volunteer_comment'; defaults to id when
+            every file has one
+
+    Returns: Tuple of the model names, the row keys (Index) and a boolean
+        array of shape (models, comments, tasks)"""
+
+    if model_names is None:
+        model_names = sorted(f[:-len('.csv')] for f in os.listdir(directory) if f.endswith('.csv'))
+    frames = [pd.read_csv("{}/{}.csv".format(directory, name)) for name in model_names]
+    if key is None:
+        key = 'id' if all('id' in frame for frame in frames) else 'volunteer_comment'
+
+    keys = get_row_keys(frames[0], key)
+    predictions = np.stack([align_labels(frame, keys, key, tasks, name) for frame, name in zip(frames, model_names)])
+    return model_names, keys, predictions.astype(bool)
+
+def load_annotation_stack(file_name, keys, annotators=None, tasks=all_tasks, key='volunteer_comment'):
+    """Load every annotator's labels into one array, aligned with the predictions
+
+    Arguments:
+        file_name: String, location of the annotation CSV
+            (e.g. data/annotations/pre_deploy_eval.csv)
+        keys: Index, the row keys from load_prediction_stack
+        annotators: List of Strings; defaults to every annotator in the file
+        tasks: List of tasks annotated
+        key: String, 'id' or 'volunteer_comment', as used for keys
+
+    Returns: Tuple of the annotator names and an array of shape
+        (annotators, comments, tasks)"""
+
+    annotations = pd.read_csv(file_name)
+    if annotators is None:
+        annotators = annotations['annotator'].unique().tolist()
+    labels = np.stack([align_labels(annotations[annotations['annotator'] == annotator], keys, key, tasks, annotator)
+                       for annotator in annotators])
+    return annotators, labels
+
+def add_aggregates(labels, tasks=all_tasks, aggregates=aggregate_tasks):
+    """Append aggregate labels, positive when any of their tasks is
+
+    Arguments:
+        labels: Array whose last axis is tasks
+        tasks: List of tasks along the last axis
+        aggregates: Dictionary mapping aggregate name to its tasks
+
+    Returns: Tuple of the extended array and the extended task list"""
+
+    labels = np.asarray(labels, dtype=float)
+    columns = [labels]
+    for name, members in aggregates.items():
+        indices = [tasks.index(t) for t in members if t in tasks]
+        columns.append(labels[..., indices].max(axis=-1, keepdims=True))
+    return np.concatenate(columns, axis=-1), list(tasks) + list(aggregates)
+
+def get_metrics(truth, predictions, weights=None):
+    """Accuracy, precision, recall and F1 of every model on every task at once
+        Same definitions as get_accuracy, get_precision, get_recall and get_f1,
+        so soft labels (e.g. the mean of two annotators) are scored the same way
+
+    Arguments:
+        truth: Array of shape (comments, tasks), labels between 0 and 1
+        predictions: Array of shape (models, comments, tasks)
+        weights: Array of shape (samples, comments), how often each comment
+            is counted in each sample, or None to count each once
+
+    Returns: Dictionary mapping metric name to an array of shape
+        (models, tasks), or (samples, models, tasks) with weights"""
+
+    truth = np.asarray(truth, dtype=float)
+    predictions = np.asarray(predictions, dtype=float)
+    sample_weights = np.ones((1, truth.shape[0])) if weights is None else np.asarray(weights, dtype=float)
+
+    true_positives = np.einsum('sc,mct->smt', sample_weights, predictions*truth)
+    predicted_positives = np.einsum('sc,mct->smt', sample_weights, predictions)
+    actual_positives = np.einsum('sc,ct->st', sample_weights, truth)[:, None, :]
+    errors = np.einsum('sc,mct->smt', sample_weights, np.abs(predictions-truth))
+    counts = sample_weights.sum(axis=1)[:, None, None]
+
+    precision = true_positives / (predicted_positives + 1e-8)
+    recall = true_positives / (actual_positives + 1e-8)
+    metrics = {'accuracy': 1 - errors/counts, 'precision': precision, 'recall': recall,
+               'f1': 2*precision*recall/(precision+recall+1e-8)}
+    if weights is None:
+        metrics = {name: values[0] for name, values in metrics.items()}
+    return metrics
+
+def bootstrap_metrics(truth, predictions, num_samples=1000, confidence=0.95, seed=0):
+    """Bootstrap confidence intervals for every metric, model and task
+        Each resample of the comments is a row of counts, so all resamples
+        are scored together by get_metrics
+
+    Arguments:
+        truth: Array of shape (comments, tasks)
+        predictions: Array of shape (models, comments, tasks)
+        num_samples: Integer, number of resamples
+        confidence: Float, coverage of the intervals
+        seed: Integer, seed of the resampling
+
+    Returns: Dictionary mapping metric name to a tuple of the lower and
+        upper bounds, each an array of shape (models, tasks)"""
+
+    num_comments = np.shape(truth)[0]
+    weights = np.random.default_rng(seed).multinomial(num_comments, np.full(num_comments, 1/num_comments),
+                                                      size=num_samples)
+    samples = get_metrics(truth, predictions, weights)
+    tail = (1 - confidence)/2
+    return {name: tuple(np.quantile(values, [tail, 1-tail], axis=0)) for name, values in samples.items()}
+
+def get_kappa(first, second):
+    """Cohen's kappa between two sets of 0-1 labels, per task
+        Leading axes broadcast, e.g. annotations[:, None] against
+        annotations[None, :] gives the kappa of every pair of annotators
+
+    Arguments:
+        first: Array of shape (..., comments, tasks)
+        second: Array of shape (..., comments, tasks)
+
+    Returns: Array of shape (..., tasks); NaN where both label sets are constant and equal"""
+
+    first = np.asarray(first, dtype=float)
+    second = np.asarray(second, dtype=float)
+    observed = (first == second).mean(axis=-2)
+    first_rate = first.mean(axis=-2)
+    second_rate = second.mean(axis=-2)
+    expected = first_rate*second_rate + (1-first_rate)*(1-second_rate)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(expected < 1, (observed-expected)/(1-expected), np.nan)
+
+def evaluate_models(truth, predictions, model_names, tasks=all_tasks, num_samples=1000, confidence=0.95, seed=0):
+    """Score every model on every task and aggregate, with bootstrap intervals
+
+    Arguments:
+        truth: Array of shape (comments, tasks), e.g. the mean over annotators
+        predictions: Array of shape (models, comments, tasks)
+        model_names: List of Strings, one per model
+        tasks: List of tasks along the last axis
+        num_samples: Integer, bootstrap resamples; 0 skips the intervals
+        confidence: Float, coverage of the intervals
+        seed: Integer, seed of the resampling
+
+    Returns: DataFrame with one row per model, task and metric, and
+        columns value, low and high"""
+
+    truth, all_columns = add_aggregates(truth, tasks)
+    predictions, _ = add_aggregates(predictions, tasks)
+    metrics = get_metrics(truth, predictions)
+    intervals = bootstrap_metrics(truth, predictions, num_samples, confidence, seed) if num_samples > 0 else {}
+
+    index = pd.MultiIndex.from_product([model_names, all_columns], names=['model', 'task'])
+    frames = []
+    for name in metric_names:
+        low, high = intervals.get(name, (np.full(metrics[name].shape, np.nan),)*2)
+        frames.append(pd.DataFrame({'metric': name, 'value': metrics[name].ravel(),
+                                    'low': low.ravel(), 'high': high.ravel()}, index=index))
+    return pd.concat(frames).reset_index()
+
+def evaluate_directory(groundtruth_file, annotators=None, model_names=None, directory=default_evaluation_path,
+                       tasks=all_tasks, **kwargs):
+    """Score every prediction CSV in a directory against the mean of the annotators
+
+    Arguments:
+        groundtruth_file: String, location of the annotation CSV
+            (e.g. data/annotations/pre_deploy_eval.csv)
+        annotators: List of Strings; defaults to every annotator in the file
+        model_names: List of Strings, CSV names without the extension; defaults to all
+        directory: String, location of the prediction CSVs
+        tasks: List of tasks to score
+        kwargs: Passed on to evaluate_models
+
+    Returns: Tuple of the DataFrame from evaluate_models and a DataFrame of
+        Cohen's kappa between each pair of annotators, per task"""
+
+    model_names, keys, predictions = load_prediction_stack(model_names, directory, tasks)
+    key = 'id' if keys.nlevels == 1 else 'volunteer_comment'
+    annotators, annotations = load_annotation_stack(groundtruth_file, keys, annotators, tasks, key)
+
+    scores = evaluate_models(annotations.mean(axis=0), predictions, model_names, tasks, **kwargs)
+    binary_annotations, all_columns = add_aggregates(annotations, tasks)
+    kappas = get_kappa(binary_annotations[:, None], binary_annotations[None, :])
+    pairs = [(i, j) for i in range(len(annotators)) for j in range(i+1, len(annotators))]
+    agreement = pd.DataFrame([kappas[i, j] for i, j in pairs], columns=all_columns,
+                             index=pd.Index(["{}/{}".format(annotators[i], annotators[j]) for i, j in pairs],
+                                            name='annotators'))
+    return scores, agreement
+
+def get_prompt_token_savings(tasks=all_tasks):
+    """Estimate the prompt tokens per comment for per-task and fused prompts
+
+    Arguments:
+        tasks: List of tasks
+
+    Returns: Dictionary with the per-task and fused token estimates"""
+
+    prompts = load_prompts(tasks)
+    per_task_tokens = sum([estimate_tokens(prompts[t]) for t in tasks])
+    fused_tokens = estimate_tokens(get_fused_prompt(prompts, tasks))
+    return {'per_task_tokens': per_task_tokens, 'fused_tokens': fused_tokens,
+            'calls_per_comment': len(tasks), 'ratio': fused_tokens/per_task_tokens}
+
+def compare_fused_to_per_task(groundtruth_file, per_task_file, fused_file, annotator='naveen', tasks=all_tasks):
+    """Score fused predictions against per-task predictions on the same annotations
+
+    Arguments:
+        groundtruth_file: String, location of the annotation CSV
+        per_task_file: String, predictions from one prompt per task
+            (e.g. results/evaluation/gpt-4o-mini.csv)
+        fused_file: String, predictions from the fused prompt
+        annotator: String, which annotator to score against
+        tasks: List of tasks to score
+
+    Returns: DataFrame with per-task and fused metrics side by side,
+        and their difference"""
+
+    groundtruth = load_groundtruth(groundtruth_file, annotator)
+    per_task = score_predictions(groundtruth, load_predictions(per_task_file, tasks), tasks)
+    fused = score_predictions(groundtruth, load_predictions(fused_file, tasks), tasks)
+
+    comparison = pd.concat({'per_task': per_task, 'fused': fused, 'difference': fused-per_task}, axis=1)
+    return comparison
+
+def predict_evaluation_set(dataset, model_name, output_file, fused=False, tasks=all_tasks, backend=None, **kwargs):
+    """Run the classifier over an evaluation set and save predictions
+        in the same format as results/evaluation
+
+    Arguments:
+        dataset: DataFrame with id, donor_name, recipient_name and volunteer_comment
+        model_name: String, name of the model
+        output_file: String, where to write the predictions CSV
+        fused: Boolean, whether to use the fused prompt
+        tasks: List of tasks to predict
+        backend: String, ModelBackend or None; by default chosen from the model name
+        kwargs: Passed on to analyze_feedback_concurrent
+
+    Returns: DataFrame of predictions
+
+    Side Effects: Writes the predictions to output_file"""
+
+    client = get_backend(model_name, backend).get_async_client()
+    prompts = load_prompts(tasks)
+    if fused:
+        prompts = {FUSED_TASK: get_fused_prompt(prompts, tasks)}
+
+    predictions = analyze_feedback_concurrent(client, dataset, prompts, tasks, model_name, fused=fused,
+                                              close_client=True, **kwargs)
+    predictions = predictions[['volunteer_comment','id']+tasks]
+    predictions.to_csv(output_file, index=False)
+    return predictions
+
+# Prompt variants of the ablation study; 'baseline' is the prompt as written
+ablations = ['no_few_shot', 'no_guidelines', 'no_explanations']
+prompt_variants = ['baseline', 'fused'] + ablations
+
+# The model the ablation CSVs in results/evaluation were run with
+ablation_model = 'gpt-4o-mini'
+
+def get_ablation_prompt(prompt, task, variant):
+    """Remove one part of a task's prompt, the way the ablation study did
+
+    Arguments:
+        prompt: String, the prompt text for the task
+        task: String, the task
+        variant: String, one of ablations
+
+    Returns: String, the ablated prompt"""
+
+    basic_ending = ("Responses should be formatted in JSON to maintain uniformity and clarity across reports. "
+                    "The response should have two keys: {} and explanation. \n Now, it’s your turn. \n "
+                    "Analyze the following rescue: \n".format(task))
+    if variant == 'no_few_shot':
+        prompt = prompt.split("Example Comment Analysis:")[0] + ("Now, it’s your turn. \n Analyze the following "
+                 "rescue; note that the JSON should have two keys: {} and explanation: \n".format(task))
+    elif variant == 'no_guidelines':
+        prompt = prompt.split("Notes:")[0] + "\n Example Comment Analysis\n" + prompt.split("Example Comment Analysis:")[1]
+        prompt = prompt.split("Now, it’s your turn")[0] + basic_ending
+    elif variant == 'no_explanations':
+        prompt = "\n".join([line for line in prompt.split("\n") if '"explanation"' not in line])
+    else:
+        raise Exception("Ablation {} not found; ablations are {}".format(variant, ablations))
+    return prompt + "\n"
+
+def get_variant_prompts(variant, tasks=all_tasks):
+    """Prompts for one variant
+
+    Arguments:
+        variant: String, one of prompt_variants
+        tasks: List of tasks
+
+    Returns: Dictionary mapping prompt name to the prompt text; a single
+        FUSED_TASK prompt for the fused variant"""
+
+    prompts = load_prompts(tasks)
+    if variant == 'baseline':
+        return prompts
+    if variant == 'fused':
+        return {FUSED_TASK: get_fused_prompt(prompts, tasks)}
+    return {task: get_ablation_prompt(prompts[task], task, variant) for task in tasks}
+
+def get_cache_task(task, variant):
+    """Task name a variant's responses are cached under; other variants get
+        their own, since ResponseCache.remove_stale_prompts would otherwise
+        drop them as stale versions of the production prompt
+
+    Arguments:
+        task: String, task name or FUSED_TASK
+        variant: String, one of prompt_variants
+
+    Returns: String, e.g. recipient_problem@no_few_shot"""
+
+    if variant == 'baseline':
+        return task
+    return "{}@{}".format(task, variant)
+
+def get_output_name(model_name, variant):
+    """Name of the predictions CSV of a run, following results/evaluation:
+        gpt-4o.csv, meta-llama_Meta-Llama-3.1-8B-Instruct-Turbo.csv, and
+        ablation_no_few_shot.csv for the ablations of ablation_model
+
+    Arguments:
+        model_name: String, name of the model
+        variant: String, one of prompt_variants
+
+    Returns: String, without the extension"""
+
+    name = model_name.replace("/", "_")
+    if variant == 'baseline':
+        return name
+    if model_name == ablation_model:
+        return "ablation_{}".format(variant)
+    return "{}_ablation_{}".format(name, variant)
+
+def load_evaluation_dataset(groundtruth_file, names_file, annotator='naveen'):
+    """Comments of the evaluation set, with the donor and recipient names
+        the prompts mention
+
+    Arguments:
+        groundtruth_file: String, location of the annotation CSV
+            (e.g. data/annotations/pre_deploy_eval.csv)
+        names_file: String, CSV with delivery_id, donor_name and recipient_name
+            (e.g. data/annotations/donor_recipient_annotated_names.csv)
+        annotator: String, whose rows to take the comments from
+
+    Returns: DataFrame with id, donor_name, recipient_name and volunteer_comment"""
+
+    dataset = load_groundtruth(groundtruth_file, annotator)[['volunteer_comment', 'id']]
+    names = pd.read_csv(names_file)[['delivery_id', 'donor_name', 'recipient_name']]
+    dataset = dataset.merge(names, left_on='id', right_on='delivery_id', how='left')
+    return dataset.drop(columns='delivery_id').reset_index(drop=True)
+
+def predict_evaluation_runs(dataset, runs, tasks=all_tasks, backend=None, cache=None, max_concurrency=16,
+                            rate_limits=None, max_retries=5):
+    """Run several (model, prompt variant) pairs over an evaluation set at once
+        Every (run, comment, task) call is in flight in one event loop, with
+        each provider's concurrency and request rate shared by its runs
+
+    Arguments:
+        dataset: DataFrame with id, donor_name, recipient_name and volunteer_comment
+        runs: List of (model name, variant) tuples
+        tasks: List of tasks to predict
+        backend: String, ModelBackend or None; by default chosen from each model name
+        cache: ResponseCache or None, checked before calling the model
+        max_concurrency: Integer, calls in flight per provider
+        rate_limits: Dictionary mapping backend name to requests per second, or None
+        max_retries: Integer, retries of each failed call
+
+    Returns: Dictionary mapping each run to a DataFrame of predictions in
+        the format of results/evaluation"""
+
+    rate_limits = rate_limits or {}
+    comments = get_comments(dataset)
+    backends = {run: get_backend(run[0], backend) for run in runs}
+    policies = {b.name: RetryPolicy(max_retries=max_retries, requests_per_second=rate_limits.get(b.name))
+                for b in backends.values()}
+    runs_per_provider = {name: sum(b.name == name for b in backends.values()) for name in policies}
+
+    results = {}
+    requests = {}
+    prompts = {}
+    for run in runs:
+        model_name, variant = run
+        prompts[run] = get_variant_prompts(variant, tasks)
+        results[run] = {}
+        requests[run] = []
+        for i, comment in comments.items():
+            for task in prompts[run]:
+                if cache is not None:
+                    cached = cache.get(model_name, get_cache_task(task, variant), prompts[run][task], comment)
+                    if cached is not None:
+                        results[run][(i, task)] = cached
+                        continue
+                requests[run].append({'key': (i, task), 'task': task, 'comment': comment,
+                                      'content': get_request_content(prompts[run][task], comment)})
+    print("{} runs: {} calls, {} from the cache".format(
+        len(runs), sum(map(len, requests.values())), sum(map(len, results.values()))))
+
+    async def run_all():
+        clients = {run: backends[run].get_async_client(max_retries=0) for run in runs}
+        try:
+            return await asyncio.gather(*[
+                run_requests_async(clients[run], requests[run], run[0],
+                                   max_concurrency=max(1, max_concurrency//runs_per_provider[backends[run].name]),
+                                   retry=policies[backends[run].name])
+                for run in runs])
+        finally:
+            for client in clients.values():
+                await client.close()
+
+    predictions = {}
+    for run, (new_results, stats) in zip(runs, run_coroutine(run_all())):
+        print("{} ({}):".format(*run))
+        print_run_stats(stats)
+        if cache is not None:
+            for request in requests[run]:
+                key = request['key']
+                if key in new_results and is_complete_output(new_results[key], key[1], tasks):
+                    cache.put(run[0], get_cache_task(key[1], run[1]), prompts[run][key[1]], request['comment'],
+                              new_results[key])
+        results[run].update(new_results)
+
+        run_predictions = dataset[['volunteer_comment', 'id']].copy()
+        for task in tasks:
+            run_predictions[task] = None
+        for (i, task), feedback_info in results[run].items():
+            try:
+                for label, value in parse_feedback_output(feedback_info, task, tasks).items():
+                    run_predictions.at[i, label] = value
+            except Exception as e:
+                print(f"Error processing feedback {i} for task {task}: {e}")
+        predictions[run] = run_predictions
+
+    if cache is not None:
+        cache.commit()
+        print("Cache: {}".format(cache.stats()))
+    return predictions
@@ -0,0 +1,256 @@
+import argparse
+import email.parser
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from feedback.fr_feedback import all_tasks
+
+# Share of comments with each label; the rest are False
+LABEL_RATES = {task: 0.1 for task in all_tasks}
+LABEL_RATES['positive_comment'] = 0.5
+
+def get_fake_labels(content):
+    """Deterministic labels for a request: the same content always gets the
+        same labels, for every task, so any task's response parses
+
+    Arguments:
+        content: String, the request content
+
+    Returns: Dictionary mapping each task to a boolean, plus the direction
+        rewrite fields and an explanation"""
+
+    rng = random.Random(hashlib.sha256(content.encode('utf-8')).hexdigest())
+    labels = {task: rng.random() < LABEL_RATES[task] for task in all_tasks}
+    # Fields of the direction rewrite prompt
+    labels['direction_change'] = rng.random() < 0.2
+    labels['rewritten_direction'] = "Fake rewritten direction" if labels['direction_change'] else ""
+    labels['explanation'] = "Fake label from fake_server.py"
+    return labels
+
+class FakeModel:
+    """Behaviour of the fake server: latency, errors and token counts"""
+
+    def __init__(self, latency=0.5, jitter=0.25, error_rate=0.0, rate_limit_rate=0.0,
+                 batch_latency=5.0, batch_failure_rate=0.0, seed=42):
+        """Arguments:
+            latency: Float, mean seconds per chat completion
+            jitter: Float, latency varies uniformly by this many seconds
+            error_rate: Float, share of calls that fail with a 500
+            rate_limit_rate: Float, share of calls that fail with a 429
+            batch_latency: Float, seconds before a batch completes
+            batch_failure_rate: Float, share of batches that fail instead
+            seed: Integer, seed for latencies and errors"""
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.batch_latency = batch_latency
+        self.batch_failure_rate = batch_failure_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.seen_prefixes = set()
+        self.files = {}
+        self.batches = {}
+
+    def get_failure(self):
+        """Status code of an injected failure, or None"""
+
+        with self.lock:
+            draw = self.rng.random()
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def get_delay(self):
+        with self.lock:
+            return max(self.latency + self.rng.uniform(-self.jitter, self.jitter), 0)
+
+    def get_usage(self, content, completion):
+        """Token counts, about 4 characters per token, with the prompt
+            before the comment counted as cached after its first use,
+            in 128-token steps above 1024 tokens, like OpenAI's prompt cache"""
+
+        prompt_tokens = len(content)//4 + 1
+        prefix = content.rsplit("For this rescue,", 1)[0]
+        prefix_tokens = len(prefix)//4
+        with self.lock:
+            cached = prefix in self.seen_prefixes
+            self.seen_prefixes.add(prefix)
+        cached_tokens = (prefix_tokens//128)*128 if cached and prefix_tokens >= 1024 else 0
+        completion_tokens = len(completion)//4 + 1
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+                'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+
+    def complete(self, body):
+        """A chat completion response body for a request body"""
+
+        content = "".join(message['content'] for message in body['messages'])
+        completion = json.dumps(get_fake_labels(content))
+        return {'id': 'chatcmpl-{}'.format(uuid.uuid4().hex), 'object': 'chat.completion',
+                'created': int(time.time()), 'model': body.get('model', 'fake'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': completion}}],
+                'usage': self.get_usage(content, completion)}
+
+    def add_file(self, data, purpose, filename):
+        file_id = 'file-{}'.format(uuid.uuid4().hex)
+        with self.lock:
+            self.files[file_id] = {'data': data, 'info': {
+                'id': file_id, 'object': 'file', 'bytes': len(data), 'created_at': int(time.time()),
+                'filename': filename, 'purpose': purpose, 'status': 'processed'}}
+        return self.files[file_id]['info']
+
+    def create_batch(self, body):
+        batch_id = 'batch_{}'.format(uuid.uuid4().hex)
+        batch = {'id': batch_id, 'object': 'batch', 'endpoint': body['endpoint'],
+                 'input_file_id': body['input_file_id'], 'completion_window': body['completion_window'],
+                 'status': 'in_progress', 'created_at': int(time.time()), 'output_file_id': None,
+                 'error_file_id': None, 'metadata': body.get('metadata'),
+                 'request_counts': {'total': 0, 'completed': 0, 'failed': 0}}
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Timer(self.batch_latency, self.run_batch, [batch_id]).start()
+        return batch
+
+    def run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        with self.lock:
+            if self.rng.random() < self.batch_failure_rate:
+                batch.update({'status': 'failed', 'failed_at': int(time.time())})
+                return
+        lines = []
+        for line in self.files[batch['input_file_id']]['data'].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            lines.append(json.dumps({'id': 'batch_req_{}'.format(uuid.uuid4().hex),
+                                     'custom_id': request['custom_id'],
+                                     'response': {'status_code': 200, 'request_id': uuid.uuid4().hex,
+                                                  'body': self.complete(request['body'])},
+                                     'error': None}))
+        output = self.add_file(("\n".join(lines) + "\n").encode('utf-8'), 'batch_output',
+                               '{}_output.jsonl'.format(batch_id))
+        with self.lock:
+            batch.update({'status': 'completed', 'output_file_id': output['id'], 'completed_at': int(time.time()),
+                          'request_counts': {'total': len(lines), 'completed': len(lines), 'failed': 0}})
+
+def get_handler(model):
+    """HTTP handler for the subset of the OpenAI API the pipeline uses"""
+
+    class FakeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately; without this, each
+        # response waits out the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_error_json(self, status, message):
+            headers = {'Retry-After': '1'} if status == 429 else None
+            self.send_json(status, {'error': {'message': message, 'type': 'fake_error', 'code': status}}, headers)
+
+        def read_body(self):
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def do_POST(self):
+            path = self.path.split('?')[0]
+            data = self.read_body()
+            if path.endswith('/chat/completions'):
+                failure = model.get_failure()
+                time.sleep(model.get_delay())
+                if failure is not None:
+                    self.send_error_json(failure, "Injected failure")
+                else:
+                    self.send_json(200, model.complete(json.loads(data)))
+            elif path.endswith('/files'):
+                message = email.parser.BytesParser().parsebytes(
+                    b"Content-Type: " + self.headers['Content-Type'].encode('utf-8') + b"\r\n\r\n" + data)
+                fields = {part.get_param('name', header='content-disposition'): part for part in message.get_payload()}
+                upload = fields['file']
+                self.send_json(200, model.add_file(upload.get_payload(decode=True),
+                                                   fields['purpose'].get_payload(decode=True).decode('utf-8'),
+                                                   upload.get_filename()))
+            elif path.endswith('/batches'):
+                self.send_json(200, model.create_batch(json.loads(data)))
+            else:
+                self.send_error_json(404, "Unknown path {}".format(path))
+
+        def do_GET(self):
+            parts = self.path.split('?')[0].strip('/').split('/')
+            if len(parts) >= 3 and parts[-3] == 'files' and parts[-1] == 'content' and parts[-2] in model.files:
+                data = model.files[parts[-2]]['data']
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            elif len(parts) >= 2 and parts[-2] == 'files' and parts[-1] in model.files:
+                self.send_json(200, model.files[parts[-1]]['info'])
+            elif len(parts) >= 2 and parts[-2] == 'batches' and parts[-1] in model.batches:
+                self.send_json(200, model.batches[parts[-1]])
+            else:
+                self.send_error_json(404, "Unknown path {}".format(self.path))
+
+    return FakeHandler
+
+class FakeServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections under concurrent load,
+    # and each dropped connection waits a second to retry
+    request_queue_size = 1024
+    daemon_threads = True
+
+def start_fake_server(host='localhost', port=8765, **kwargs):
+    """Start the fake server on a background thread
+
+    Arguments:
+        host: String, interface to listen on
+        port: Integer, port to listen on; 0 picks a free one
+        kwargs: Passed on to FakeModel
+
+    Returns: FakeServer; its base url is
+        http://{host}:{server.server_port}/v1, server.model is its FakeModel,
+        and server.shutdown() stops it"""
+
+    model = FakeModel(**kwargs)
+    server = FakeServer((host, port), get_handler(model))
+    server.model = model
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='interface to listen on', type=str, default='localhost')
+    parser.add_argument('--port', help='port to listen on', type=int, default=8765)
+    parser.add_argument('--latency', help='mean seconds per chat completion', type=float, default=0.5)
+    parser.add_argument('--jitter', help='latency varies uniformly by this many seconds', type=float, default=0.25)
+    parser.add_argument('--error_rate', help='share of calls that fail with a 500', type=float, default=0.0)
+    parser.add_argument('--rate_limit_rate', help='share of calls that fail with a 429', type=float, default=0.0)
+    parser.add_argument('--batch_latency', help='seconds before a batch completes', type=float, default=5.0)
+    parser.add_argument('--batch_failure_rate', help='share of batches that fail instead of completing', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeServer((args.host, args.port), get_handler(FakeModel(
+        args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.batch_latency,
+        args.batch_failure_rate)))
+    print("Fake model server on http://{}:{}/v1".format(args.host, args.port))
+    server.serve_forever()
@@ -1,35 +1,70 @@
-from feedback.database import load_data
-import openai 
+from feedback.database import load_data, load_prepared, stream_data
+from feedback.async_engine import run_requests, print_run_stats, parse_json_output
+from feedback.cache import get_cache_key, get_prompt_hash
+from feedback.custom_id import encode_custom_id
+from feedback.backends import get_backend
+from feedback.checkpoint import merge_local_labels
+from feedback import metrics
 import json
 import os
+import time
+import pandas as pd
 
-openai_api_key = os.environ.get("OPENAI_API_KEY")
+all_tasks = ['recipient_problem', 'inadequate_food', 'donor_problem', 
+            'direction_problem','earlier_pickup','system_problem',
+            'update_contact','positive_comment']
 
-def get_feedback_by_date(conn,start_date,end_date):
-    """Get all the feedback received between the start and end dates
-    
-    Arguments:
-        cursor: Database PSQL cursor
-        start_date: String, start date, of the form 2022-05-01
-        end_date: String, end date, of the form 2022-05-10
-    
-    Returns: DataFrame, with organized info on all feedback"""
-    
-    feedbacks_query = f"""WITH all_ids as (
+# Pseudo-task name used when all tasks are classified in one call
+FUSED_TASK = 'fused'
+
+PROMPT_ENDING = "Now, it’s your turn. Analyze the following rescue:"
+
+ROLES_EXPLAINED = """Roles Explained:
+The Donor - Provides the food.
+The Volunteer Driver - Transports the food.
+The Recipient - Receives the food.
+
+"""
+
+# Rescues in the window are filtered on their own, before their location
+# arrays are unnested, so only those rows are expanded
+WINDOW_IDS_QUERY = """window_summaries AS MATERIALIZED (
+    SELECT
+    ds.donor_ids,
+    ds.donor_location_ids,
+    ds.recipient_ids,
+    ds.recipient_location_ids,
+    ds.delivery_id,
+    ds.delivery_type,
+    ds.published_at
+    FROM delivery_summaries ds
+    WHERE
+    {filters}
+    AND ds.volunteer_comment IS NOT NULL
+    ),
+    all_ids AS (
     SELECT
-    ds.donor_ids[c1.ord] as donor_id,
+    ws.donor_ids[c1.ord] AS donor_id,
     c1.element AS donor_location_id,
-    ds.recipient_ids[c2.ord2] as recipient_id,
+    ws.recipient_ids[c2.ord2] AS recipient_id,
     c2.element AS recipient_location_id,
-    ds.delivery_id,
-    ds.delivery_type
+    ws.delivery_id,
+    ws.delivery_type,
+    ws.published_at
     FROM
-    delivery_summaries ds,
-    LATERAL unnest(ds.donor_location_ids) WITH ORDINALITY AS c1(element, ord),
-    LATERAL unnest(ds.recipient_location_ids) WITH ORDINALITY AS c2(element, ord2)
-    WHERE
-    ds.published_at between '{start_date}' AND '{end_date}' and ds.volunteer_comment is not null
-    )
+    window_summaries ws,
+    LATERAL unnest(ws.donor_location_ids) WITH ORDINALITY AS c1(element, ord),
+    LATERAL unnest(ws.recipient_location_ids) WITH ORDINALITY AS c2(element, ord2)
+    )"""
+
+def get_feedback_by_date_query():
+    """Build the query for all the feedback received between the start and end dates
+        The dates are bound as %(start_date)s and %(end_date)s, so the text
+        never changes and Postgres can reuse its plan
+    
+    Returns: String, SQL query"""
+    
+    feedbacks_query = """WITH {}
     select d.id as donor_id,
     dl.id as donor_location_id,
     d.name || ' - ' || dl.name as donor_name,
@@ -45,37 +80,133 @@ def get_feedback_by_date(conn,start_date,end_date):
     inner join recipients r on ai.recipient_id=r.id
     inner join recipient_locations rl on ai.recipient_location_id=rl.id
     inner join RESCUES rescue on ai.delivery_id=rescue.id;
-        """
+        """.format(WINDOW_IDS_QUERY.format(filters="ds.published_at BETWEEN %(start_date)s AND %(end_date)s"))
+
+    return feedbacks_query
 
-    feedbacks = load_data(feedbacks_query, conn)
+def get_feedback_by_date(conn,start_date,end_date):
+    """Get all the feedback received between the start and end dates
+    
+    Arguments:
+        cursor: Database PSQL cursor
+        start_date: String, start date, of the form 2022-05-01
+        end_date: String, end date, of the form 2022-05-10
+    
+    Returns: DataFrame, with organized info on all feedback"""
+
+    feedbacks = load_prepared('feedback_by_date', get_feedback_by_date_query(), conn,
+                              {'start_date': start_date, 'end_date': end_date})
     feedbacks = feedbacks[feedbacks['volunteer_comment'] != '']
 
     return feedbacks
 
+def stream_feedback(conn,feedbacks_query,chunk_size=10000,params=None):
+    """Stream the results of a feedback query in chunks, in bounded memory
+    
+    Arguments:
+        conn: Database PSQL connection
+        feedbacks_query: String, e.g. from get_feedback_by_date_query
+        chunk_size: Integer, number of rows per chunk
+        params: Dictionary or None, values for the query's placeholders
+    
+    Returns: Generator of DataFrames, each indexed from 0, 
+        with empty comments removed"""
+
+    for feedbacks in stream_data(feedbacks_query, conn, chunk_size, params=params):
+        feedbacks = feedbacks[feedbacks['volunteer_comment'] != '']
+        if len(feedbacks) > 0:
+            yield feedbacks.reset_index(drop=True)
 
-def get_predictions_by_date(conn,start_date,end_date,organization_id):
-    """Get all the feedback received between the start and end dates
+def stream_feedback_by_date(conn,start_date,end_date,chunk_size=10000):
+    """Stream all the feedback received between the start and end dates
     
     Arguments:
-        cursor: Database PSQL cursor
+        conn: Database PSQL connection
         start_date: String, start date, of the form 2022-05-01
         end_date: String, end date, of the form 2022-05-10
+        chunk_size: Integer, number of rows per chunk
     
-    Returns: DataFrame, with organized info on all feedback"""
+    Returns: Generator of DataFrames, with organized info on all feedback"""
+
+    return stream_feedback(conn, get_feedback_by_date_query(), chunk_size,
+                           {'start_date': start_date, 'end_date': end_date})
+
+def get_new_feedback_query(end_date=None):
+    """Build the query for the feedback published after a given time that has
+        not been written to rescue_feedback yet, or whose row there is missing
+        a label, e.g. because its LLM call failed
+        The times are bound as %(since)s and, optionally, %(end_date)s
+    
+    Arguments:
+        end_date: String or None, whether the query has an end date
+    
+    Returns: String, SQL query"""
+
+    filters = "ds.published_at > %(since)s"
+    if end_date:
+        filters += " AND ds.published_at <= %(end_date)s"
+    labelled = " AND ".join(["rf.{} IS NOT NULL".format(task) for task in all_tasks])
+    filters += "\n    AND NOT EXISTS (SELECT 1 FROM rescue_feedback rf WHERE rf.owner_id = ds.delivery_id AND {})".format(labelled)
+    feedbacks_query = """WITH {}
+    select d.id as donor_id,
+    dl.id as donor_location_id,
+    d.name || ' - ' || dl.name as donor_name,
+    r.id as recipient_id,
+    rl.id as recipient_location_id,
+    r.name || ' - ' || rl.name as recipient_name,
+    ai.delivery_id as id,
+    ai.delivery_type as owner_type,
+    ai.published_at,
+    rescue.volunteer_comment
+    from all_ids ai
+    inner join donors d on ai.donor_id=d.id
+    inner join donor_locations dl on ai.donor_location_id=dl.id
+    inner join recipients r on ai.recipient_id=r.id
+    inner join recipient_locations rl on ai.recipient_location_id=rl.id
+    inner join RESCUES rescue on ai.delivery_id=rescue.id;
+        """.format(WINDOW_IDS_QUERY.format(filters=filters))
+
+    return feedbacks_query
+
+def get_new_feedback(conn,since,end_date=None):
+    """Get the feedback published after a given time that has not 
+        been written to rescue_feedback yet, or is missing a label there
     
-    feedbacks_query = f"""SELECT rf.*
+    Arguments:
+        conn: Database PSQL connection
+        since: String, only rescues published after this time, of the form 2022-05-01 12:00:00
+        end_date: String or None, optional end date, of the form 2022-05-10
+    
+    Returns: DataFrame, with organized info on all new feedback, 
+        including when each rescue was published"""
+
+    params = {'since': since}
+    if end_date:
+        params['end_date'] = end_date
+    feedbacks = load_data(get_new_feedback_query(end_date), conn, params)
+    feedbacks = feedbacks[feedbacks['volunteer_comment'] != '']
+    feedbacks = feedbacks.reset_index(drop=True)
+
+    return feedbacks
+
+def get_predictions_by_date_query():
+    """Build the query for the predictions on one organization's rescues
+        published between the start and end dates, bound as %(start_date)s,
+        %(end_date)s and %(organization_id)s
+    
+    Returns: String, SQL query"""
+
+    feedbacks_query = """SELECT rf.*
     FROM rescue_feedback rf
     JOIN rescues r ON rf.owner_id = r.id
     JOIN organizations_donations od ON r.donation_id = od.donation_id
-    WHERE r.published_at BETWEEN '{start_date}' AND '{end_date}'
-    AND od.organization_id = {organization_id};
+    WHERE r.published_at BETWEEN %(start_date)s AND %(end_date)s
+    AND od.organization_id = %(organization_id)s;
         """
 
-    feedbacks = load_data(feedbacks_query, conn)
+    return feedbacks_query
 
-    return feedbacks
-
-def get_feedback_by_date_instruction(conn,start_date,end_date):
+def get_predictions_by_date(conn,start_date,end_date,organization_id):
     """Get all the feedback received between the start and end dates
     
     Arguments:
@@ -84,29 +215,29 @@ def get_feedback_by_date_instruction(conn,start_date,end_date):
         end_date: String, end date, of the form 2022-05-10
     
     Returns: DataFrame, with organized info on all feedback"""
+
+    feedbacks = load_prepared('predictions_by_date', get_predictions_by_date_query(), conn,
+                              {'start_date': start_date, 'end_date': end_date,
+                               'organization_id': int(organization_id)})
+
+    return feedbacks
+
+def get_feedback_by_date_instruction_query():
+    """Build the query for all the feedback received between the start and end dates,
+        along with the special instructions for each location
+        The dates are bound as %(start_date)s and %(end_date)s, and instructions
+        are only aggregated for the locations of rescues in the window
     
-    feedbacks_query = f"""WITH all_ids AS (
-    SELECT
-    ds.donor_ids[c1.ord] AS donor_id,
-    c1.element AS donor_location_id,
-    ds.recipient_ids[c2.ord2] AS recipient_id,
-    c2.element AS recipient_location_id,
-    ds.delivery_id,
-    ds.delivery_type
-    FROM
-    delivery_summaries ds,
-    LATERAL unnest(ds.donor_location_ids) WITH ORDINALITY AS c1(element, ord),
-    LATERAL unnest(ds.recipient_location_ids) WITH ORDINALITY AS c2(element, ord2)
-    WHERE
-    ds.published_at BETWEEN '{start_date}' AND '{end_date}'
-    AND ds.volunteer_comment IS NOT NULL
-    ),
+    Returns: String, SQL query"""
+    
+    feedbacks_query = """WITH {},
     donor_instr AS (
     SELECT
     owner_id AS donor_location_id,
     STRING_AGG(text, '; ') AS donor_instruction
     FROM SPECIAL_INSTRUCTIONS
     WHERE owner_type = 'DonorLocation'
+    AND owner_id IN (SELECT donor_location_id FROM all_ids)
     GROUP BY owner_id
     ),
     recipient_instr AS (
@@ -115,6 +246,7 @@ def get_feedback_by_date_instruction(conn,start_date,end_date):
     STRING_AGG(text, '; ') AS recipient_instruction
     FROM SPECIAL_INSTRUCTIONS
     WHERE owner_type = 'RecipientLocation'
+    AND owner_id IN (SELECT recipient_location_id FROM all_ids)
     GROUP BY owner_id
     )
     SELECT
@@ -137,116 +269,557 @@ def get_feedback_by_date_instruction(conn,start_date,end_date):
     INNER JOIN RESCUES rescue ON ai.delivery_id = rescue.id
     LEFT JOIN donor_instr di ON di.donor_location_id = ai.donor_location_id
     LEFT JOIN recipient_instr ri ON ri.recipient_location_id = ai.recipient_location_id;
-        """
+        """.format(WINDOW_IDS_QUERY.format(filters="ds.published_at BETWEEN %(start_date)s AND %(end_date)s"))
+
+    return feedbacks_query
+
+def get_feedback_by_date_instruction(conn,start_date,end_date):
+    """Get all the feedback received between the start and end dates
+    
+    Arguments:
+        cursor: Database PSQL cursor
+        start_date: String, start date, of the form 2022-05-01
+        end_date: String, end date, of the form 2022-05-10
+    
+    Returns: DataFrame, with organized info on all feedback"""
 
-    feedbacks = load_data(feedbacks_query, conn)
+    feedbacks = load_prepared('feedback_by_date_instruction', get_feedback_by_date_instruction_query(), conn,
+                              {'start_date': start_date, 'end_date': end_date})
     feedbacks = feedbacks[feedbacks['volunteer_comment'] != '']
 
     return feedbacks
 
+def stream_feedback_by_date_instruction(conn,start_date,end_date,chunk_size=10000):
+    """Stream all the feedback received between the start and end dates,
+        along with the special instructions for each location
+    
+    Arguments:
+        conn: Database PSQL connection
+        start_date: String, start date, of the form 2022-05-01
+        end_date: String, end date, of the form 2022-05-10
+        chunk_size: Integer, number of rows per chunk
+    
+    Returns: Generator of DataFrames, with organized info on all feedback"""
+
+    return stream_feedback(conn, get_feedback_by_date_instruction_query(), chunk_size,
+                           {'start_date': start_date, 'end_date': end_date})
+
+
+def normalize_prompt(prompt):
+    """Normalize line endings and drop trailing whitespace, so that an editor
+        saving a prompt file with CRLF or a final newline doesn't change the
+        bytes every request starts with, nor the prompt's cache hash
+    
+    Arguments:
+        prompt: String, the prompt file's contents
+    
+    Returns: String"""
+
+    return prompt.replace('\r\n', '\n').replace('\r', '\n').rstrip()
+
+def load_prompts(tasks):
+    """Read in the prompt for each task from data/prompts
+    
+    Arguments:
+        tasks: List of task names, each with a prompt file
+    
+    Returns: Dictionary mapping task name to the normalized prompt text"""
+
+    prompts = {}
+    for t in tasks:
+        with open("{}/../data/prompts/{}.txt".format(os.path.dirname(__file__), t), encoding='utf-8') as f:
+            prompts[t] = normalize_prompt(f.read())
+    return prompts
+
+def load_request_prompts(tasks=all_tasks, fused=False, cache=None):
+    """Load the prompts requests are built from, once per run rather than
+        once per chunk of comments
+    
+    Arguments:
+        tasks: List of task names
+        fused: Boolean, whether to combine them into one FUSED_TASK prompt
+        cache: ResponseCache or None, whose entries from older versions of
+            the prompts are removed
+    
+    Returns: Dictionary mapping task name, or FUSED_TASK, to the prompt text"""
+
+    prompts = load_prompts(tasks)
+    if fused:
+        prompts = {FUSED_TASK: get_fused_prompt(prompts, tasks)}
+    if cache is not None:
+        cache.remove_stale_prompts(prompts)
+    return prompts
+
+def get_fused_prompt(prompts, tasks):
+    """Combine the per-task prompts into one prompt that asks for every task at once
+        The shared roles preamble is only included once
+    
+    Arguments:
+        prompts: Dictionary mapping task name to the prompt text
+        tasks: List of tasks to include
+    
+    Returns: String, the fused prompt"""
+
+    fused_prompt = (
+        "Task Description: As an analyst for our food rescue platform, your task is to carefully review "
+        "feedback provided by volunteer drivers and answer {} separate questions about each comment. "
+        "Each question has its own description, guidelines and examples below; apply each question's "
+        "guidelines independently of the others.\n\n".format(len(tasks))
+    )
+    fused_prompt += ROLES_EXPLAINED
+
+    for idx, task in enumerate(tasks):
+        task_prompt = prompts[task].split(PROMPT_ENDING)[0].replace(ROLES_EXPLAINED, "")
+        fused_prompt += "Question {} ({}):\n{}\n".format(idx+1, task, task_prompt.strip())
+        fused_prompt += "\n"
+
+    keys = ", ".join('"{}"'.format(task) for task in tasks)
+    fused_prompt += (
+        "Respond with a single JSON object with one boolean key per question ({}) "
+        "and an \"explanation\" key. ".format(keys)
+    )
+    fused_prompt += PROMPT_ENDING + "\n"
+    return fused_prompt
+
+def parse_feedback_output(feedback_info, task, tasks):
+    """Extract the labels from a parsed model response
+    
+    Arguments:
+        feedback_info: Dictionary, the JSON output of the model
+        task: String, the task that was asked, or FUSED_TASK
+        tasks: List of all tasks, used to unpack fused responses
+    
+    Returns: Dictionary mapping task name to its label"""
+
+    if task == FUSED_TASK:
+        return {t: feedback_info[t] for t in tasks if t in feedback_info}
+    return {task: feedback_info[task]}
+
+def is_complete_output(feedback_info, task, tasks=all_tasks):
+    """Check whether a parsed response has the label(s) we asked for,
+        so that only usable responses are cached; a fused response missing
+        any task would otherwise be served from the cache without it forever
+    
+    Arguments:
+        feedback_info: Dictionary, the JSON output of the model
+        task: String, the task that was asked, or FUSED_TASK
+        tasks: List of all tasks, which a fused response must all have
+    
+    Returns: Boolean"""
+
+    if task == FUSED_TASK:
+        return all(t in feedback_info for t in tasks)
+    return task in feedback_info
+
+def get_cached_batch_line(custom_id, feedback_info):
+    """Format a cached response like a line of Batch API output
+    
+    Arguments:
+        custom_id: String, custom id of the request
+        feedback_info: Dictionary, the cached JSON output
+    
+    Returns: Dictionary in the Batch API output format"""
+
+    return {'custom_id': custom_id, 
+            'response': {'body': {'choices': [{'message': {'content': json.dumps(feedback_info)}}]}}}
+
+def get_comments(feedbacks):
+    """Render the comment sent to the model for every rescue, as column
+        operations rather than a lookup per cell
+    
+    Arguments:
+        feedbacks: DataFrame with donor_name, recipient_name and volunteer_comment
+    
+    Returns: Series of Strings, with the same index as feedbacks"""
+
+    return ('For this rescue, the donor is ' + feedbacks['donor_name'].astype(str)
+            + '; the recipient is ' + feedbacks['recipient_name'].astype(str)
+            + '. Comment: ' + feedbacks['volunteer_comment'].astype(str))
+
+def get_request_content(prompt, comment):
+    """Build the content of one request: the task's prompt, unchanged, then
+        the comment. Every request for a task then starts with the same
+        bytes, which the provider can serve from its prompt cache; the
+        prompt's line endings and trailing whitespace are normalized by
+        load_prompts, so they don't vary between runs either
+    
+    Arguments:
+        prompt: String, the prompt text for the task
+        comment: String, the rendered rescue comment
+    
+    Returns: String, the request content"""
+
+    return prompt + comment
 
-def get_batch_feedback(feedbacks, prompts, tasks, model_name):
+def get_local_result(local_labels, i, task):
+    """Labels the pre-filter resolved for one request, in the same format as
+        the model's JSON output
+    
+    Arguments:
+        local_labels: DataFrame from LocalPrefilter.resolve, or None
+        i: Index label of the rescue in feedbacks
+        task: String, the task being asked, or FUSED_TASK, which is only
+            resolved when every task is
+    
+    Returns: Dictionary mapping task name to its label, or None if the
+        model is still needed"""
+
+    if local_labels is None:
+        return None
+    tasks = list(local_labels.columns) if task == FUSED_TASK else [task]
+    labels = {t: local_labels.at[i, t] for t in tasks}
+    if any(pd.isnull(v) for v in labels.values()):
+        return None
+    return {t: bool(v) for t, v in labels.items()}
+
+def get_batch_feedback(feedbacks, prompts, tasks, model_name, cache=None, local_labels=None):
     """Analyze the feedback using prompts to classify different properties
+        Requests are yielded one at a time, so they can be written straight
+        to a JSONL file without holding every request in memory
     
     Arguments:
-        client: OpenAI client
         feedbacks: Dataframe of all the feedbacks
         prompts: Dictionary mapping prompt name to the prompt text
-        tasks: List of prompts we're looking into
+        tasks: List of prompts we're looking into; use [FUSED_TASK] 
+            with a fused prompt to classify every task in one request
+        model_name: String, name of the model
+        cache: ResponseCache or None; cached requests are returned already
+            answered, in the Batch API output format (with a 'response' key), 
+            and the rest carry a 'cache_key' so their output can be cached
+        local_labels: DataFrame from LocalPrefilter.resolve, or None; resolved
+            requests are returned already answered, like cached ones
     
-    Returns: DataFrame with annotated feedback"""
-
-    all_data = []
-
-    for i in range(len(feedbacks)):
-        comment = (
-            f'For this rescue, the donor is {feedbacks.loc[i, "donor_name"]};'
-            f' the recipient is {feedbacks.loc[i, "recipient_name"]}.'
-            f' Comment: {feedbacks.loc[i, "volunteer_comment"]}'
-        )
+    Returns: Generator of Batch API requests"""
 
-        id = feedbacks.loc[i,"id"]
-        owner_type = feedbacks.loc[i,'owner_type']
+    request_model = model_name.replace("_self_reflection","")
+    prompt_hashes = {task: get_prompt_hash(prompts[task]) for task in tasks}
+    comments = get_comments(feedbacks)
 
+    for i, id, owner_type, comment in zip(feedbacks.index, feedbacks['id'], feedbacks['owner_type'], comments):
         for task in tasks:
-            custom_id = "{}_{}_{}".format(task,id,owner_type)
+            custom_id = encode_custom_id(task,id,owner_type)
+            local_result = get_local_result(local_labels, i, task)
+            if local_result is not None:
+                metrics.increment('requests_resolved', model=model_name, task=task, source='local')
+                yield get_cached_batch_line(custom_id, local_result)
+                continue
+            if cache is not None:
+                cache_key = get_cache_key(model_name, prompts[task], comment, prompt_hashes[task])
+                cached = cache.get_by_key(cache_key)
+                if cached is not None:
+                    metrics.increment('requests_resolved', model=model_name, task=task, source='cache')
+                    yield get_cached_batch_line(custom_id, cached)
+                    continue
+            metrics.increment('requests_built', model=model_name, task=task)
+
             formatted_dict = {'custom_id': custom_id, 
             'method': 'POST', 
             'url': "/v1/chat/completions", 
             'body': {
-                'model': model_name.replace("_self_reflection",""), 
-                'messages': [{"role": "user", "content": prompts[task] + comment}], 
+                'model': request_model, 
+                'messages': [{"role": "user", "content": get_request_content(prompts[task], comment)}], 
                 'response_format':{"type": "json_object"},
             }}
-            all_data.append(formatted_dict)
-    return all_data 
+            if cache is not None:
+                formatted_dict['cache_key'] = {'key': cache_key, 'model': model_name, 'task': task,
+                                               'prompt_hash': prompt_hashes[task]}
+            yield formatted_dict
+
+def write_batch_requests(requests, file_name):
+    """Write Batch API requests to a JSONL file as they are generated
+    
+    Arguments:
+        requests: Iterable of Batch API request dictionaries
+        file_name: String, location of the JSONL file
+    
+    Returns: Integer, number of requests written"""
+
+    num_requests = 0
+    with open(file_name, "w") as w:
+        for request in requests:
+            w.write(json.dumps(request))
+            w.write("\n")
+            num_requests += 1
+    return num_requests
 
 
-def analyze_feedback(client, feedbacks, prompts, tasks, model_name):
+def get_dead_letter_row(feedbacks, i):
+    """Fields of a rescue needed to replay its requests from the dead-letter file
+    
+    Arguments:
+        feedbacks: Dataframe of all the feedbacks
+        i: Index label of the rescue
+    
+    Returns: Dictionary of the rescue's fields"""
+
+    fields = ['id', 'owner_type', 'donor_name', 'recipient_name', 'volunteer_comment', 'published_at']
+    return {field: feedbacks.at[i, field] for field in fields if field in feedbacks}
+
+def analyze_feedback(client, feedbacks, prompts, tasks, model_name, cache=None, usage=None, local_labels=None,
+                     retry=None, dead_letters=None, checkpoint=None):
     """Analyze the feedback using prompts to classify different properties
     
     Arguments:
         client: OpenAI client
         feedbacks: Dataframe of all the feedbacks
         prompts: Dictionary mapping prompt name to the prompt text
-        tasks: List of prompts we're looking into
+        tasks: List of prompts we're looking into; use [FUSED_TASK] 
+            with a fused prompt to classify every task in one request
+        model_name: String, name of the model
+        cache: ResponseCache or None, checked before calling the model
+        usage: UsageTracker or None, records the tokens and latency of each call
+        local_labels: DataFrame from LocalPrefilter.resolve, or None; resolved
+            requests skip the model
+        retry: RetryPolicy or None, retries failed calls with backoff
+        dead_letters: DeadLetterFile or None, records requests that still fail
+        checkpoint: Checkpoint or None, records the labels of each model call
+            as it completes
     
     Returns: DataFrame with annotated feedback"""
-    for i in range(len(feedbacks)):
-        comment = (
-            f'For this rescue, the donor is {feedbacks.loc[i, "donor_name"]};'
-            f' the recipient is {feedbacks.loc[i, "recipient_name"]}.'
-            f' Comment: {feedbacks.loc[i, "volunteer_comment"]}'
+
+    def call(content, task):
+        start = time.perf_counter()
+        response = client.chat.completions.create(
+            model=model_name.replace("_self_reflection",""),
+            messages=[{"role": "user", "content": content}],
+            response_format={"type": "json_object"},
         )
+        seconds = time.perf_counter() - start
+        if usage is not None:
+            usage.record(task, response.usage, seconds)
+        metrics.record_llm_call(model_name, task, response.usage, seconds)
+        return parse_json_output(response.choices[0].message.content)
+
+    comments = get_comments(feedbacks)
+    try:
+        for n, (i, comment) in enumerate(comments.items()):
+            print("On Rescue {} out of {}".format(n+1,len(feedbacks)))
+
+            for task in tasks:
+                feedback_info = None
+                called = False
+                try:
+                    feedback_info = get_local_result(local_labels, i, task)
+                    if feedback_info is not None:
+                        metrics.increment('requests_resolved', model=model_name, task=task, source='local')
+                    elif cache is not None:
+                        feedback_info = cache.get(model_name, task, prompts[task], comment)
+                        if feedback_info is not None:
+                            metrics.increment('requests_resolved', model=model_name, task=task, source='cache')
+                    called = feedback_info is None
+                    if called:
+                        metrics.increment('requests_built', model=model_name, task=task)
+                        content = get_request_content(prompts[task], comment)
+                        if retry is not None:
+                            feedback_info = retry.call(call, content, task)
+                        else:
+                            feedback_info = call(content, task)
+                        if cache is not None and is_complete_output(feedback_info, task):
+                            cache.put(model_name, task, prompts[task], comment, feedback_info)
+                    labels = parse_feedback_output(feedback_info, task, all_tasks)
+                    for label, value in labels.items():
+                        feedbacks.loc[i, label] = value
+                    if called and checkpoint is not None:
+                        checkpoint.add(feedbacks.at[i, 'id'], feedbacks.at[i, 'owner_type'], labels,
+                                       get_prompt_hash(prompts[task]))
+                except Exception as e:
+                    if called and feedback_info is None:
+                        metrics.increment('llm_calls', model=model_name, task=task, status='error')
+                    else:
+                        metrics.increment('parse_errors', model=model_name, task=task)
+                    print(f"Error processing feedback {i} for task {task}: {e}")
+                    if dead_letters is not None:
+                        dead_letters.add(get_dead_letter_row(feedbacks, i), task, model_name, e)
+    finally:
+        if checkpoint is not None:
+            checkpoint.flush()
+
+    return feedbacks 
+
+def analyze_feedback_concurrent(client, feedbacks, prompts, tasks, model_name, max_concurrency=16,
+                                requests_per_minute=None, tokens_per_minute=None, fused=False, cache=None,
+                                usage=None, local_labels=None, retry=None, dead_letters=None, checkpoint=None,
+                                close_client=False):
+    """Analyze the feedback, running all (rescue, task) calls concurrently
+    
+    Arguments:
+        client: OpenAI or AsyncOpenAI client
+        feedbacks: Dataframe of all the feedbacks
+        prompts: Dictionary mapping prompt name to the prompt text
+        tasks: List of prompts we're looking into
+        model_name: String, name of the model
+        max_concurrency: Integer, maximum number of calls in flight
+        requests_per_minute: Integer or None, request budget
+        tokens_per_minute: Integer or None, token budget
+        fused: Boolean, whether prompts holds a single FUSED_TASK prompt
+            that classifies every task in one call
+        cache: ResponseCache or None, checked before calling the model
+        usage: UsageTracker or None, records the tokens and latency of each call
+        local_labels: DataFrame from LocalPrefilter.resolve, or None; resolved
+            requests skip the model
+        retry: RetryPolicy or None, retries failed calls with backoff
+        dead_letters: DeadLetterFile or None, records requests that still fail
+        checkpoint: Checkpoint or None, records the labels of each model call
+            as it completes
+        close_client: Boolean, whether to close an async client once the
+            calls are done; see run_requests
+    
+    Returns: DataFrame with annotated feedback"""
+
+    feedbacks = feedbacks.copy()
+    request_tasks = [FUSED_TASK] if fused else tasks
+    results = {}
+    requests = []
+    with metrics.timer('stage_seconds', stage='build'):
+        for i, comment in get_comments(feedbacks).items():
+            for task in request_tasks:
+                local_result = get_local_result(local_labels, i, task)
+                if local_result is not None:
+                    metrics.increment('requests_resolved', model=model_name, task=task, source='local')
+                    results[(i, task)] = local_result
+                    continue
+                if cache is not None:
+                    cached = cache.get(model_name, task, prompts[task], comment)
+                    if cached is not None:
+                        metrics.increment('requests_resolved', model=model_name, task=task, source='cache')
+                        results[(i, task)] = cached
+                        continue
+                metrics.increment('requests_built', model=model_name, task=task)
+                requests.append({'key': (i, task), 'task': task,
+                                 'content': get_request_content(prompts[task], comment), 'comment': comment})
+
+    def record(key, feedback_info):
+        i, task = key
+        try:
+            labels = parse_feedback_output(feedback_info, task, tasks)
+        except Exception:
+            return
+        checkpoint.add(feedbacks.at[i, 'id'], feedbacks.at[i, 'owner_type'], labels, prompt_hashes[task])
+
+    prompt_hashes = {task: get_prompt_hash(prompts[task]) for task in prompts}
+    try:
+        with metrics.timer('stage_seconds', stage='llm'):
+            new_results, stats = run_requests(client, requests, model_name, max_concurrency=max_concurrency,
+                                              requests_per_minute=requests_per_minute,
+                                              tokens_per_minute=tokens_per_minute, usage=usage, retry=retry,
+                                              on_result=record if checkpoint is not None else None,
+                                              close_client=close_client)
+    finally:
+        if checkpoint is not None:
+            checkpoint.flush()
+    print_run_stats(stats)
+    if dead_letters is not None:
+        for (i, task), error in stats['errors'].items():
+            dead_letters.add(get_dead_letter_row(feedbacks, i), task, model_name, error)
 
-        print("On Rescue {} out of {}".format(i+1,len(feedbacks)))
+    if cache is not None:
+        for request in requests:
+            i, task = request['key']
+            if request['key'] in new_results and is_complete_output(new_results[request['key']], task):
+                cache.put(model_name, task, prompts[task], request['comment'], new_results[request['key']])
+        cache.commit()
+        print("Cache: {}".format(cache.stats()))
+    results.update(new_results)
 
+    with metrics.timer('stage_seconds', stage='parse'):
         for task in tasks:
-            # if task == 'donor_problem':
+            feedbacks[task] = None
+        for (i, task), feedback_info in results.items():
             try:
-                response = client.chat.completions.create(
-                    model=model_name.replace("_self_reflection",""),
-                    messages=[{"role": "user", "content": prompts[task] + comment}],
-                    response_format={"type": "json_object"},
-                )
-                output = response.choices[0].message.content
-                feedback_info = json.loads(output)
-                feedbacks.loc[i, f'{task}'] = feedback_info[task]
+                for label, value in parse_feedback_output(feedback_info, task, tasks).items():
+                    feedbacks.at[i, label] = value
             except Exception as e:
+                metrics.increment('parse_errors', model=model_name, task=task)
                 print(f"Error processing feedback {i} for task {task}: {e}")
 
     return feedbacks 
 
-def generate_prompts_and_analyze_feedback(feedbacks,model_name,batch=False):
+def generate_prompts_and_analyze_feedback(feedbacks,model_name,batch=False,max_concurrency=16,
+                                          requests_per_minute=500,tokens_per_minute=200000,fused=False,
+                                          cache=None,usage=None,prefilter=None,backend=None,retry=None,
+                                          dead_letters=None,checkpoint=None,prompts=None):
     """Use the OpenAI client to generate prompts
     
     Arguments:
         feedbacks: DataFrame of feedbacks
+        model_name: String, name of the model
+        batch: Boolean, whether to build Batch API requests instead of calling the model
+        max_concurrency: Integer, maximum number of calls in flight; 
+            1 runs the calls serially
+        requests_per_minute: Integer or None, request budget for concurrent runs
+        tokens_per_minute: Integer or None, token budget for concurrent runs
+        fused: Boolean, whether to classify all tasks with one combined prompt
+            instead of one prompt per task
+        cache: ResponseCache or None, checked before calling the model or
+            writing a batch request
+        usage: UsageTracker or None, records the tokens and latency of each call
+        prefilter: LocalPrefilter or None; labels it is confident about are
+            resolved locally, and only the rest are sent to the model
+        backend: String, ModelBackend or None; by default chosen from the model name
+        retry: RetryPolicy or None, retries failed calls with backoff, in place
+            of the client's own retries
+        dead_letters: DeadLetterFile or None, records requests that still fail
+        checkpoint: Checkpoint or None, for non-batch runs; labels it holds
+            from an interrupted run are reused, and new ones are added to it
+        prompts: Dictionary from load_request_prompts, or None to load the
+            prompts on every call; pass them (and a ModelBackend) when
+            calling once per chunk
     
     Returns: DataFrame with annotated feedback"""
 
-    if 'gpt' in model_name:
-        client = openai.OpenAI(api_key=openai_api_key)
-    else:
-        raise Exception("Model {} not found".format(model_name))
+    backend = get_backend(model_name, backend)
+    if not batch:
+        max_retries = 0 if retry is not None else 2
+        if max_concurrency > 1:
+            client = backend.get_async_client(max_retries)
+        else:
+            client = backend.get_client(max_retries)
 
     feedbacks = feedbacks[feedbacks['volunteer_comment'].notnull()]
 
-    prompts = {}
-
-    tasks = ['recipient_problem', 'inadequate_food', 'donor_problem', 
-            'direction_problem','earlier_pickup','system_problem',
-            'update_contact','positive_comment']
-    for t in tasks:
-         prompts[t] = open("{}/../data/prompts/{}.txt".format(os.path.dirname(__file__), t)).read()
+    tasks = all_tasks
+    if prompts is None:
+        prompts = load_request_prompts(tasks, fused, cache)
+    request_tasks = list(prompts)
 
+    local_labels = None
+    if prefilter is not None:
+        local_labels = prefilter.resolve(feedbacks['volunteer_comment'])
+        resolved = local_labels.notnull()
+        print("Pre-filter resolved {} of {} task labels; {} of {} comments need no model call".format(
+            int(resolved.to_numpy().sum()), resolved.size, int(resolved.all(axis=1).sum()), len(resolved)))
+    if checkpoint is not None and not batch:
+        # A fused prompt gives every task's label
+        label_hashes = {task: get_prompt_hash(prompts[FUSED_TASK] if fused else prompts[task]) for task in tasks}
+        completed = checkpoint.get_local_labels(feedbacks, tasks, label_hashes)
+        print("Checkpoint holds {} of {} task labels".format(int(completed.notnull().to_numpy().sum()), completed.size))
+        local_labels = merge_local_labels(completed, local_labels)
 
     if batch:
-        annotated_feedback = get_batch_feedback(feedbacks, prompts, tasks,model_name)
+        annotated_feedback = get_batch_feedback(feedbacks, prompts, request_tasks,model_name,cache=cache,
+                                                local_labels=local_labels)
     else:
-        annotated_feedback = analyze_feedback(client, feedbacks, prompts, tasks,model_name)
+        if max_concurrency > 1:
+            annotated_feedback = analyze_feedback_concurrent(client, feedbacks, prompts, tasks, model_name,
+                                                             max_concurrency=max_concurrency,
+                                                             requests_per_minute=requests_per_minute,
+                                                             tokens_per_minute=tokens_per_minute,
+                                                             fused=fused,
+                                                             cache=cache,
+                                                             usage=usage,
+                                                             local_labels=local_labels,
+                                                             retry=retry,
+                                                             dead_letters=dead_letters,
+                                                             checkpoint=checkpoint,
+                                                             close_client=True)
+        else:
+            annotated_feedback = analyze_feedback(client, feedbacks, prompts, request_tasks,model_name,cache=cache,usage=usage,
+                                                  local_labels=local_labels,retry=retry,dead_letters=dead_letters,
+                                                  checkpoint=checkpoint)
+            for task in tasks:
+                if task not in annotated_feedback:
+                    annotated_feedback[task] = None
         annotated_feedback = annotated_feedback.rename(columns={'rescue_id': 'old_rescue_id'})
-        annotated_feedback = annotated_feedback.rename(columns={'id': 'owner_id'})[['owner_id']+tasks]
         annotated_feedback = annotated_feedback.rename(columns={'id': 'owner_id'})[['owner_id']+tasks+['owner_type']]
 
     return annotated_feedback
\ No newline at end of file
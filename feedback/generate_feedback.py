@@ -1,9 +1,21 @@
-from fr_feedback import get_feedback_by_date, generate_prompts_and_analyze_feedback
-from database import open_connection
+from fr_feedback import get_feedback_by_date, stream_feedback_by_date, generate_prompts_and_analyze_feedback, all_tasks, \
+    load_request_prompts
+from database import ConnectionPool
+from backends import get_backend
+from cache import ResponseCache
+from prefilter import load_prefilter
+from dedup import deduplicate, fan_out_labels, get_cluster_report
+from usage import UsageTracker
+from checkpoint import Checkpoint, default_checkpoint_path
+from retry import RetryPolicy, DeadLetterFile, take_dead_letters, finish_replay, default_dead_letter_path
+from watermark import load_watermark, save_watermark, get_unprocessed_feedback, advance_watermark
 import argparse
-from psycopg2.extras import execute_values
+from bulk_writer import write_rescue_feedback
+from feedback import metrics
 import datetime
 import os
+import time
+import pandas as pd
 
 current_time = datetime.datetime.now()
 
@@ -11,7 +23,30 @@ model_name = 'gpt-4o-mini'
 parser = argparse.ArgumentParser()
 parser.add_argument('--start_date',   help='num beneficiaries (arms)', type=str)
 parser.add_argument('--end_date', help='volunteers per arm', type=str)
+parser.add_argument('--max_concurrency', help='maximum number of LLM calls in flight', type=int, default=16)
+parser.add_argument('--requests_per_minute', help='request budget for the LLM', type=int, default=500)
+parser.add_argument('--tokens_per_minute', help='token budget for the LLM', type=int, default=200000)
+parser.add_argument('--fused', help='classify all tasks with one combined prompt', action='store_true')
+parser.add_argument('--no_cache', help='do not reuse cached LLM responses', action='store_true')
+parser.add_argument('--incremental', help='only process comments published since the last run; --start_date is used for the first run', action='store_true')
+parser.add_argument('--lookback_days', help='in incremental mode, how far back to look for late comments', type=float, default=7)
+parser.add_argument('--stream', help='fetch and process comments in chunks through a server-side cursor', action='store_true')
+parser.add_argument('--chunk_size', help='number of rows per chunk when streaming', type=int, default=10000)
+parser.add_argument('--prefilter', help='resolve labels a local TF-IDF model is confident about without the LLM (train with train_prefilter.py)', action='store_true')
+parser.add_argument('--prefilter_threshold', help='confidence the pre-filter needs to resolve a label; defaults to the trained threshold', type=float)
+parser.add_argument('--dedup_threshold', help='group comments at least this similar (1: identical after normalization) and classify one per group', type=float)
+parser.add_argument('--on_conflict', help='ignore: keep existing predictions; update: overwrite them', type=str, default='ignore', choices=['ignore','update'])
+parser.add_argument('--backend', help='model backend, e.g. openai, together, openai_compatible or fake; chosen from the model name by default', type=str)
+parser.add_argument('--max_retries', help='retries per LLM call, with backoff, before it goes to the dead-letter file', type=int, default=5)
+parser.add_argument('--requests_per_second', help='LLM calls per second, retries included, through a token bucket; unthrottled by default', type=float)
+parser.add_argument('--dead_letter_file', help='where requests that fail after every retry are recorded', type=str, default=default_dead_letter_path)
+parser.add_argument('--replay_dead_letters', help='classify the rescues in the dead-letter file instead of a date range', action='store_true')
+parser.add_argument('--checkpoint_file', help='where completed labels are saved, so a crashed or killed run resumes where it stopped', type=str, default=default_checkpoint_path)
+parser.add_argument('--no_checkpoint', help='do not save or resume from a checkpoint', action='store_true')
+parser.add_argument('--metrics_file', help='record stage timers, counters, tokens and latencies to this file: Prometheus text if it ends in .prom, JSON lines otherwise', type=str)
 args = parser.parse_args()
+if args.stream and (args.incremental or args.replay_dead_letters):
+    parser.error("--stream reads a date range, so it can't be combined with --incremental or --replay_dead_letters")
 start_date      = args.start_date
 end_date = args.end_date
 
@@ -20,38 +55,100 @@ username = os.environ.get("POSTGRES_USER")
 password = os.environ.get("POSTGRES_PASSWORD") 
 ip_address = os.environ.get("DATABASE_HOST") 
 port = os.environ.get("DATABASE_PORT")
-openai_api_key = os.environ.get("OPENAI_API_KEY")
 
-connection_dict = open_connection(db_name,username,password,ip_address,port)
-connection = connection_dict['connection']
-cursor = connection_dict['cursor']
+if args.metrics_file:
+    metrics.enable('generate_feedback')
+run_start = time.perf_counter()
 
-feedbacks = get_feedback_by_date(connection,start_date,end_date)
-if len(feedbacks) > 0:
-    annotated_feedback = generate_prompts_and_analyze_feedback(feedbacks,model_name)
+pool = ConnectionPool(db_name,username,password,ip_address,port)
 
-    columns = ['owner_id','positive_comment']
+cache = None if args.no_cache else ResponseCache()
+prefilter = load_prefilter(threshold=args.prefilter_threshold) if args.prefilter else None
+backend = get_backend(model_name,args.backend)
+prompts = load_request_prompts(fused=args.fused,cache=cache)
+usage = UsageTracker(model_name)
+retry = RetryPolicy(max_retries=args.max_retries,requests_per_second=args.requests_per_second)
+dead_letters = DeadLetterFile(args.dead_letter_file)
+checkpoint = None if args.no_checkpoint else Checkpoint(model_name, args.checkpoint_file)
+if checkpoint is not None and checkpoint.resumed > 0:
+    print("Resuming from a checkpoint with labels for {} rescues".format(checkpoint.resumed))
 
-    values = [tuple(row) for row in annotated_feedback.to_numpy()]
+if args.replay_dead_letters:
+    # Whole rescues are replayed; tasks that already succeeded come from the cache
+    records = take_dead_letters(args.dead_letter_file)
+    feedbacks = pd.DataFrame([record['row'] for record in records])
+    if len(feedbacks) > 0:
+        feedbacks = feedbacks.drop_duplicates(subset=['id','owner_type']).reset_index(drop=True)
+        feedbacks['id'] = pd.to_numeric(feedbacks['id'])
+    print("Replaying {} dead letters for {} rescues".format(len(records),len(feedbacks)))
+    feedback_chunks = [feedbacks]
+    args.on_conflict = 'update'
+elif args.incremental:
+    watermark = load_watermark('generate_feedback')
+    with metrics.timer('stage_seconds', stage='fetch'):
+        feedbacks = get_unprocessed_feedback(pool,watermark,start_date,end_date,args.lookback_days)
+    print("Found {} new comments since {}".format(len(feedbacks),watermark['published_at']))
+    feedback_chunks = [feedbacks]
+elif args.stream:
+    feedback_chunks = stream_feedback_by_date(pool,start_date,end_date,args.chunk_size)
+else:
+    with metrics.timer('stage_seconds', stage='fetch'):
+        feedback_chunks = [get_feedback_by_date(pool,start_date,end_date)]
+
+# Each chunk is classified and committed before the next one is fetched
+labelled_ids = set()
+for feedbacks in feedback_chunks:
+    if len(feedbacks) == 0:
+        continue
+    metrics.increment('comments', len(feedbacks))
+    representatives = feedbacks
+    if args.dedup_threshold is not None:
+        with metrics.timer('stage_seconds', stage='dedup'):
+            representatives, clusters = deduplicate(feedbacks,args.dedup_threshold)
+        distribution, summary = get_cluster_report(clusters)
+        print("Cluster sizes:\n{}\n{}".format(distribution.to_string(index=False),summary))
+    with metrics.timer('stage_seconds', stage='classify'):
+        annotated_feedback = generate_prompts_and_analyze_feedback(representatives,model_name,
+                                                                   max_concurrency=args.max_concurrency,
+                                                                   requests_per_minute=args.requests_per_minute,
+                                                                   tokens_per_minute=args.tokens_per_minute,
+                                                                   fused=args.fused,
+                                                                   cache=cache,
+                                                                   usage=usage,
+                                                                   prefilter=prefilter,
+                                                                   backend=backend,
+                                                                   prompts=prompts,
+                                                                   retry=retry,
+                                                                   dead_letters=dead_letters,
+                                                                   checkpoint=checkpoint)
+    if args.dedup_threshold is not None:
+        annotated_feedback = fan_out_labels(annotated_feedback,feedbacks,clusters)
 
-    print(columns,values)
-    all_vals = set()
-    reduced_values = []
-    for v in values:
-        if v[0] not in all_vals:
-            reduced_values.append(v)
-            all_vals.add(v[0])
     columns = list(annotated_feedback.columns)+['created_at','updated_at']
 
     values = [tuple(row)+(current_time,current_time) for row in annotated_feedback.to_numpy()]
 
-    insert_query = f"""
-        INSERT INTO rescue_feedback ({', '.join(columns)}) 
-        VALUES %s
-        ON CONFLICT DO NOTHING
-    """
-
-    execute_values(cursor, insert_query, values)
-connection.commit()
-cursor.close()
-connection.close()
+    with metrics.timer('stage_seconds', stage='write'):
+        write_rescue_feedback(pool, values, columns, on_conflict=args.on_conflict)
+    # Rescues with a failed task stay out of the watermark, so the next run retries them
+    labelled_ids.update(annotated_feedback.loc[annotated_feedback[all_tasks].notnull().all(axis=1), 'owner_id'])
+# Every label is in the database now, so the next run starts afresh
+if checkpoint is not None:
+    checkpoint.clear()
+if args.replay_dead_letters:
+    finish_replay(args.dead_letter_file)
+if dead_letters.count > 0:
+    print("{} requests failed after {} retries; rerun with --replay_dead_letters to retry them".format(
+        dead_letters.count,args.max_retries))
+if args.incremental:
+    save_watermark('generate_feedback', advance_watermark(watermark,feedbacks[feedbacks['id'].isin(list(labelled_ids))],
+                                                          args.lookback_days))
+usage.print_report()
+print("Usage report written to {}".format(usage.save_report('generate_feedback')))
+pool.close()
+if cache is not None:
+    cache.close()
+metrics.observe('run_seconds', time.perf_counter() - run_start)
+metrics.save(args.metrics_file)
+if args.metrics_file:
+    print("Metrics written to {}".format(args.metrics_file))
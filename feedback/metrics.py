@@ -0,0 +1,272 @@
+"""Counters and histograms for a pipeline run, exported in the Prometheus text format
+
+Library modules record into the registry of this module as feedback.metrics.
+The CLI scripts in feedback/ import their other modules by file name, but must
+import this one as `from feedback import metrics`: imported as `metrics`, it
+would be a second copy of the module, whose registry the library never sees."""
+
+import bisect
+import datetime
+import json
+import os
+import threading
+import time
+
+from feedback.usage import get_usage_counts, get_cost
+
+# Every metric is exported with this prefix, e.g. feedback_rows_fetched_total
+METRIC_PREFIX = 'feedback_'
+
+# Upper bounds, in seconds, of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms for one run, each keyed by
+        a name and a set of labels"""
+
+    def __init__(self, run_name, buckets=DEFAULT_BUCKETS):
+        """Start an empty registry
+
+        Arguments:
+            run_name: String, added to every metric as the run label
+                (e.g. 'generate_feedback')
+            buckets: Tuple of Floats, upper bounds of the histogram buckets"""
+
+        self.run_name = run_name
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def increment(self, name, value=1, **labels):
+        """Add to a counter
+
+        Arguments:
+            name: String, name of the counter
+            value: Number to add
+            labels: Label values, e.g. task='donor_problem'
+
+        Returns: Nothing"""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a value, usually seconds, to a histogram
+
+        Arguments:
+            name: String, name of the histogram
+            value: Float
+            labels: Label values
+
+        Returns: Nothing"""
+
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'counts': [0]*(len(self.buckets) + 1), 'count': 0, 'sum': 0.0,
+                                        'max': value}
+            histogram = self.histograms[key]
+            histogram['counts'][bucket] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['max'] = max(histogram['max'], value)
+
+    def get_records(self):
+        """Snapshot of every metric
+
+        Returns: List of dictionaries with name, type, labels, and either the
+            counter's value or the histogram's count, sum, max and
+            cumulative bucket counts"""
+
+        records = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                records.append({'name': name, 'type': 'counter', 'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip([str(b) for b in self.buckets] + ['+Inf'], histogram['counts']):
+                    cumulative += count
+                    buckets[bound] = cumulative
+                records.append({'name': name, 'type': 'histogram', 'labels': dict(labels),
+                                'count': histogram['count'], 'sum': histogram['sum'], 'max': histogram['max'],
+                                'buckets': buckets})
+        return records
+
+    def to_prometheus(self):
+        """Render every metric in the Prometheus text exposition format
+
+        Returns: String"""
+
+        lines = []
+        declared = set()
+        for record in self.get_records():
+            labels = dict({'run': self.run_name}, **record['labels'])
+            if record['type'] == 'counter':
+                name = METRIC_PREFIX + record['name'] + '_total'
+                if name not in declared:
+                    lines.append("# TYPE {} counter".format(name))
+                    declared.add(name)
+                lines.append("{}{} {}".format(name, format_labels(labels), record['value']))
+                continue
+            name = METRIC_PREFIX + record['name']
+            if name not in declared:
+                lines.append("# TYPE {} histogram".format(name))
+                declared.add(name)
+            for bound, count in record['buckets'].items():
+                lines.append("{}_bucket{} {}".format(name, format_labels(dict(labels, le=bound)), count))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), record['sum']))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), record['count']))
+        return "\n".join(lines) + "\n"
+
+    def save(self, file_name):
+        """Write every metric to a file: a .prom file is replaced with the
+            Prometheus text format (e.g. for node_exporter's textfile
+            collector), and any other file gets one JSON line per metric
+            appended, stamped with the run and time
+
+        Arguments:
+            file_name: String, location of the file
+
+        Returns: Nothing"""
+
+        if os.path.dirname(file_name):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        if file_name.endswith('.prom'):
+            # Replaced in one step, so a scrape never reads half a file
+            with open(file_name + '.tmp', "w") as w:
+                w.write(self.to_prometheus())
+            os.replace(file_name + '.tmp', file_name)
+            return
+
+        stamp = {'run': self.run_name, 'time': str(datetime.datetime.now()),
+                 'elapsed_seconds': time.time() - self.started}
+        with open(file_name, "a") as w:
+            for record in self.get_records():
+                w.write(json.dumps(dict(stamp, **record), default=str))
+                w.write("\n")
+
+class Timer:
+    """Context manager that adds the seconds its block took to a histogram"""
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+class NullTimer:
+    """Timer used while metrics are disabled; it records nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+# The registry every module records into, or None while metrics are disabled
+registry = None
+
+def format_labels(labels):
+    """Render labels as {name="value",...}, escaped for Prometheus"""
+
+    if len(labels) == 0:
+        return ""
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels.items()]
+    return "{" + ",".join(escaped) + "}"
+
+def enable(run_name, buckets=DEFAULT_BUCKETS):
+    """Start recording metrics, replacing any earlier registry
+
+    Arguments:
+        run_name: String, name of the run, e.g. 'generate_feedback'
+        buckets: Tuple of Floats, upper bounds of the histogram buckets
+
+    Returns: MetricsRegistry"""
+
+    global registry
+    registry = MetricsRegistry(run_name, buckets)
+    return registry
+
+def disable():
+    """Stop recording metrics"""
+    global registry
+    registry = None
+
+def is_enabled():
+    """Whether metrics are being recorded"""
+    return registry is not None
+
+def increment(name, value=1, **labels):
+    """Add to a counter; does nothing while metrics are disabled"""
+    if registry is not None:
+        registry.increment(name, value, **labels)
+
+def observe(name, value, **labels):
+    """Add a value to a histogram; does nothing while metrics are disabled"""
+    if registry is not None:
+        registry.observe(name, value, **labels)
+
+def timer(name, **labels):
+    """Time a block into a histogram of seconds, e.g.
+        with metrics.timer('stage_seconds', stage='fetch'):
+
+    Arguments:
+        name: String, name of the histogram
+        labels: Label values
+
+    Returns: Context manager"""
+
+    if registry is None:
+        return NULL_TIMER
+    return Timer(registry, name, labels)
+
+def record_llm_call(model_name, task, usage, seconds=None, batch=False):
+    """Count one model response, its tokens and cost, and its latency
+
+    Arguments:
+        model_name: String, name of the model
+        task: String or None, task name or FUSED_TASK
+        usage: CompletionUsage object, dictionary or None
+        seconds: Float or None, how long the call took
+        batch: Boolean, whether it was billed at Batch API prices
+
+    Returns: Nothing"""
+
+    if registry is None:
+        return
+    task = task or 'unknown'
+    registry.increment('llm_calls', model=model_name, task=task, status='ok')
+    counts = get_usage_counts(usage)
+    for kind, count in counts.items():
+        registry.increment('llm_tokens', count, model=model_name, task=task, kind=kind.replace('_tokens', ''))
+    cost = get_cost(model_name, counts['prompt_tokens'], counts['cached_tokens'], counts['completion_tokens'], batch)
+    if cost == cost:
+        registry.increment('llm_cost_usd', cost, model=model_name, task=task)
+    if seconds is not None:
+        registry.observe('llm_latency_seconds', seconds, model=model_name, task=task)
+
+def save(file_name):
+    """Write the metrics recorded so far, if they are enabled and a file is given
+
+    Arguments:
+        file_name: String or None; see MetricsRegistry.save
+
+    Returns: Nothing"""
+
+    if registry is not None and file_name:
+        registry.save(file_name)
@@ -0,0 +1,182 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+
+from feedback.evaluation import convert
+from feedback.fr_feedback import all_tasks
+
+default_training_path = "{}/../data/annotations/training.csv".format(os.path.dirname(__file__))
+default_model_path = "{}/../data/models/prefilter.pkl".format(os.path.dirname(__file__))
+
+def is_empty_comment(comments):
+    """Find comments with no words in them, e.g. blank or only punctuation
+
+    Arguments:
+        comments: Series of Strings
+
+    Returns: Series of Booleans"""
+
+    return ~comments.fillna("").astype(str).str.contains(r"[A-Za-z0-9]", regex=True)
+
+class LocalPrefilter:
+    """CPU-only TF-IDF + logistic regression classifier per task, used to
+        label the comments it is confident about without calling the LLM"""
+
+    def __init__(self, threshold=0.95, tasks=all_tasks):
+        """Create an untrained pre-filter
+
+        Arguments:
+            threshold: Float, a task is resolved locally when the predicted
+                probability of the chosen label is at least this
+            tasks: List of tasks to classify"""
+
+        self.threshold = threshold
+        self.tasks = tasks
+        self.pipelines = {}
+
+    def fit(self, training):
+        """Train one classifier per task
+            Rows labelled -1 for a task are left out of that task's training
+
+        Arguments:
+            training: DataFrame with volunteer_comment and one column per task
+                (e.g. data/annotations/training.csv)
+
+        Returns: self"""
+
+        for task in self.tasks:
+            rows = training[(training[task] != -1) & training['volunteer_comment'].notnull()]
+            labels = rows[task].map(convert)
+            if labels.nunique() < 2:
+                print("Skipping {}: its training labels are all {}".format(task, labels.iloc[0] if len(labels) else None))
+                continue
+            pipeline = make_pipeline(TfidfVectorizer(), LogisticRegression(max_iter=1000))
+            pipeline.fit(rows['volunteer_comment'].astype(str), labels)
+            self.pipelines[task] = pipeline
+        return self
+
+    def predict_proba(self, comments):
+        """Probability that each task's label is true
+
+        Arguments:
+            comments: Series of volunteer comments
+
+        Returns: DataFrame, with the same index as comments and one column
+            per task; NaN for tasks without a classifier"""
+
+        probabilities = pd.DataFrame(np.nan, index=comments.index, columns=self.tasks)
+        if len(comments) == 0:
+            return probabilities
+        text = comments.fillna("").astype(str)
+        for task, pipeline in self.pipelines.items():
+            probabilities[task] = pipeline.predict_proba(text)[:, 1]
+        return probabilities
+
+    def resolve(self, comments, threshold=None):
+        """Label the (comment, task) pairs the pre-filter is confident about
+            Comments with no words are resolved as having no label at all
+
+        Arguments:
+            comments: Series of volunteer comments
+            threshold: Float or None, overrides self.threshold
+
+        Returns: DataFrame with the same index as comments and one column per
+            task, holding True/False where resolved and None where the LLM
+            is still needed"""
+
+        threshold = self.threshold if threshold is None else threshold
+        probabilities = self.predict_proba(comments)
+        confident = np.maximum(probabilities, 1-probabilities) >= threshold
+
+        local_labels = (probabilities >= 0.5).astype(object).where(confident, None)
+        local_labels[is_empty_comment(comments)] = False
+        return local_labels
+
+    def save(self, path=default_model_path):
+        """Save the trained pre-filter
+
+        Arguments:
+            path: String, location of the pickle
+
+        Returns: Nothing"""
+
+        # Saved as plain fields, so scripts and the feedback package can both load it
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        w = open(path, "wb")
+        pickle.dump({'threshold': self.threshold, 'tasks': self.tasks, 'pipelines': self.pipelines}, w)
+        w.close()
+
+def load_prefilter(path=default_model_path, threshold=None):
+    """Load a pre-filter saved by LocalPrefilter.save
+
+    Arguments:
+        path: String, location of the pickle
+        threshold: Float or None, overrides the saved threshold
+
+    Returns: LocalPrefilter"""
+
+    saved = pickle.load(open(path, "rb"))
+    prefilter = LocalPrefilter(saved['threshold'] if threshold is None else threshold, saved['tasks'])
+    prefilter.pipelines = saved['pipelines']
+    return prefilter
+
+def count_resolved(local_labels):
+    """Number of (comment, task) pairs resolved locally
+
+    Arguments:
+        local_labels: DataFrame, from LocalPrefilter.resolve
+
+    Returns: Integer"""
+
+    return int(local_labels.notnull().to_numpy().sum())
+
+def get_prefilter_report(prefilter, groundtruth, llm_predictions=None,
+                         thresholds=(0.8, 0.9, 0.95, 0.98, 0.99)):
+    """Calls saved against recall lost at several thresholds
+        Without LLM predictions, the LLM is assumed to be always right,
+        so recall lost is an upper bound
+
+    Arguments:
+        prefilter: Trained LocalPrefilter
+        groundtruth: DataFrame of annotations, with volunteer_comment and the tasks
+        llm_predictions: DataFrame or None, LLM predictions on the same comments
+            (e.g. results/evaluation/gpt-4o-mini.csv)
+        thresholds: List of thresholds to try
+
+    Returns: DataFrame with one row per threshold and task, and an 'all' row
+        per threshold; calls_saved is the share of per-task calls skipped,
+        comments_skipped the share of comments a fused call is skipped for"""
+
+    tasks = prefilter.tasks
+    groundtruth = groundtruth.drop_duplicates(subset='volunteer_comment').reset_index(drop=True)
+    truth = groundtruth[tasks].apply(lambda column: column.map(convert)).to_numpy()
+    if llm_predictions is None:
+        llm = truth
+    else:
+        llm_predictions = llm_predictions.drop_duplicates(subset='volunteer_comment')
+        llm = groundtruth[['volunteer_comment']].merge(llm_predictions, on='volunteer_comment', how='left')
+        llm = llm[tasks].apply(lambda column: column.map(convert)).to_numpy()
+
+    rows = []
+    for threshold in thresholds:
+        local_labels = prefilter.resolve(groundtruth['volunteer_comment'], threshold)
+        resolved = local_labels.notnull().to_numpy()
+        local = local_labels.fillna(False).to_numpy().astype(int)
+        combined = np.where(resolved, local, llm)
+        comments_skipped = resolved.all(axis=1).mean()
+
+        for idx, task in enumerate(tasks + ['all']):
+            columns = slice(None) if task == 'all' else slice(idx, idx+1)
+            positives = truth[:, columns].sum() + 1e-8
+            llm_recall = (llm[:, columns]*truth[:, columns]).sum()/positives
+            combined_recall = (combined[:, columns]*truth[:, columns]).sum()/positives
+            rows.append({'threshold': threshold, 'task': task,
+                         'calls_saved': resolved[:, columns].mean(), 'comments_skipped': comments_skipped,
+                         'llm_recall': llm_recall, 'prefilter_recall': combined_recall,
+                         'recall_lost': llm_recall - combined_recall})
+    return pd.DataFrame(rows)
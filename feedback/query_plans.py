@@ -0,0 +1,102 @@
+import json
+
+from feedback.database import is_pool, prepare
+
+# Indexes the feedback queries rely on; each is (name, statement)
+RECOMMENDED_INDEXES = [
+    # get_feedback_by_date, get_new_feedback: range scan of the window, skipping rescues without comments
+    ('delivery_summaries_published_at_commented',
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS delivery_summaries_published_at_commented "
+     "ON delivery_summaries (published_at) WHERE volunteer_comment IS NOT NULL"),
+    # get_feedback_by_date_instruction: instructions of the locations in the window only
+    ('special_instructions_owner',
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS special_instructions_owner "
+     "ON special_instructions (owner_type, owner_id)"),
+    # get_predictions_by_date
+    ('rescues_published_at',
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS rescues_published_at ON rescues (published_at)"),
+    ('organizations_donations_organization',
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS organizations_donations_organization "
+     "ON organizations_donations (organization_id, donation_id)"),
+    # get_new_feedback's NOT EXISTS, and get_predictions_by_date's join
+    ('rescue_feedback_owner_id',
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS rescue_feedback_owner_id ON rescue_feedback (owner_id)"),
+]
+
+def create_indexes(connection, indexes=RECOMMENDED_INDEXES):
+    """Create the recommended indexes, without locking the tables for writes
+
+    Arguments:
+        connection: PSQL connection; CREATE INDEX CONCURRENTLY needs
+            autocommit, which is turned on for the duration
+        indexes: List of (name, statement) tuples
+
+    Returns: Nothing"""
+
+    autocommit = connection.autocommit
+    connection.autocommit = True
+    try:
+        cursor = connection.cursor()
+        for name, statement in indexes:
+            print("Creating index {}".format(name))
+            cursor.execute(statement)
+        cursor.close()
+    finally:
+        connection.autocommit = autocommit
+
+def drop_indexes(connection, indexes=RECOMMENDED_INDEXES):
+    """Drop the recommended indexes, to measure the queries without them
+
+    Arguments:
+        connection: PSQL connection
+        indexes: List of (name, statement) tuples
+
+    Returns: Nothing"""
+
+    autocommit = connection.autocommit
+    connection.autocommit = True
+    try:
+        cursor = connection.cursor()
+        for name, _ in indexes:
+            cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+        cursor.close()
+    finally:
+        connection.autocommit = autocommit
+
+def explain_analyze(cursor, query, params=None):
+    """Run a query under EXPLAIN ANALYZE
+
+    Arguments:
+        cursor: Cursor on a PSQL connection, or a ConnectionPool
+        query: String, what query to run, with %(name)s placeholders
+        params: Dictionary, List or None, values for the placeholders
+
+    Returns: Dictionary with planning_ms, execution_ms, rows and the JSON plan"""
+
+    if is_pool(cursor):
+        with cursor.cursor() as pooled_cursor:
+            return explain_analyze(pooled_cursor, query, params)
+
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query.strip().rstrip(';'), params)
+    result = cursor.fetchone()[0]
+    if isinstance(result, str):
+        result = json.loads(result)
+    plan = result[0]
+    return {'planning_ms': plan.get('Planning Time'), 'execution_ms': plan.get('Execution Time'),
+            'rows': plan['Plan'].get('Actual Rows'), 'plan': plan}
+
+def explain_analyze_prepared(cursor, name, query, params):
+    """Run a query as a prepared statement under EXPLAIN ANALYZE, the way
+        load_prepared runs it
+
+    Arguments:
+        cursor: Cursor on a PSQL connection
+        name: String, name of the prepared statement
+        query: String, what query to run, with %(name)s placeholders
+        params: Dictionary, values for the placeholders
+
+    Returns: Dictionary with planning_ms, execution_ms, rows and the JSON plan"""
+
+    param_names = sorted(params)
+    execute = prepare(cursor, name, query, param_names)
+    return explain_analyze(cursor, execute, [params[p] for p in param_names])
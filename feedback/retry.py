@@ -0,0 +1,383 @@
+import asyncio
+import datetime
+import json
+import os
+import random
+import threading
+import time
+
+import openai
+
+from feedback import metrics
+
+default_dead_letter_path = "{}/../data/state/dead_letters.jsonl".format(os.path.dirname(__file__))
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = [408, 409, 429, 500, 502, 503, 504]
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the model while the circuit breaker is open"""
+
+def get_status_code(error):
+    """HTTP status code of an API error, or None"""
+    return getattr(error, 'status_code', None)
+
+def is_retryable(error):
+    """Whether a failed call may succeed if tried again
+
+    Arguments:
+        error: Exception raised by the call
+
+    Returns: Boolean"""
+
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, json.JSONDecodeError)):
+        return True
+    return get_status_code(error) in RETRYABLE_STATUS_CODES
+
+def get_retry_after(error):
+    """Seconds the server asked us to wait, from the Retry-After or
+        retry-after-ms headers of an API error
+
+    Arguments:
+        error: Exception raised by the call
+
+    Returns: Float, or None if the server did not say"""
+
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms'])/1000
+        if headers.get('retry-after') is not None:
+            return float(headers['retry-after'])
+    except ValueError:
+        # Retry-After may also be an HTTP date, which we don't parse
+        return None
+    return None
+
+class TokenBucket:
+    """Thread-safe token bucket of requests per second that halves its rate
+        on each rate-limit response and recovers gradually on success"""
+
+    def __init__(self, rate, capacity=None, min_rate=0.1, recovery=0.05):
+        """Create a full bucket
+
+        Arguments:
+            rate: Float, requests per second at most
+            capacity: Float or None, largest burst; defaults to one second of requests
+            min_rate: Float, the rate never drops below this
+            recovery: Float, fraction of the maximum rate regained per success"""
+
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self):
+        """Take a token if one is available
+
+        Returns: Float, seconds to wait before trying again, or 0 if taken"""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens)/self.rate
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        wait = self._take()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._take()
+
+    async def acquire_async(self):
+        """Wait, without blocking the event loop, until a request may be sent"""
+        wait = self._take()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+    def slow_down(self):
+        """Halve the rate after a rate-limit response"""
+        with self.lock:
+            self.rate = max(self.rate/2, self.min_rate)
+
+    def speed_up(self):
+        """Regain some of the rate after a success"""
+        with self.lock:
+            self.rate = min(self.rate + self.recovery*self.max_rate, self.max_rate)
+
+class CircuitBreaker:
+    """Stops calling the model after a run of failures, then lets a single
+        trial call through once reset_timeout has passed"""
+
+    def __init__(self, failure_threshold=20, reset_timeout=60):
+        """Create a closed breaker
+
+        Arguments:
+            failure_threshold: Integer, consecutive failed calls (after
+                retries) that open the breaker
+            reset_timeout: Float, seconds the breaker stays open"""
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may be made now, and whether it is the trial call
+            let through while the breaker is half-open
+
+        Returns: Tuple of (Boolean, Boolean)"""
+
+        with self.lock:
+            if self.opened_at is None:
+                return True, False
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True, True
+            return False, False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def cancel_trial(self):
+        """Free the trial slot when the trial call ends without a result,
+            e.g. when its task is cancelled"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print("Circuit breaker open after {} consecutive failures".format(self.failures))
+                self.opened_at = time.monotonic()
+
+class RetryPolicy:
+    """Shared call layer: jittered exponential backoff that honors
+        Retry-After, an adaptive token bucket and a circuit breaker"""
+
+    def __init__(self, max_retries=5, base_delay=1, max_delay=60, requests_per_second=None,
+                 failure_threshold=20, reset_timeout=60):
+        """Create a retry policy
+
+        Arguments:
+            max_retries: Integer, retries after the first attempt
+            base_delay: Float, backoff before the first retry, in seconds
+            max_delay: Float, longest backoff, in seconds
+            requests_per_second: Float or None, starting rate of the token bucket;
+                None leaves calls unthrottled
+            failure_threshold: Integer, consecutive failures that open the breaker
+            reset_timeout: Float, seconds the breaker stays open"""
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(requests_per_second) if requests_per_second else None
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.retries = 0
+
+    def get_delay(self, attempt, error):
+        """Seconds to wait before a retry: full jitter on an exponential
+            backoff, but never less than the server's Retry-After
+
+        Arguments:
+            attempt: Integer, number of attempts made so far
+            error: Exception raised by the last attempt
+
+        Returns: Float"""
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay*2**attempt))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def _before_attempt(self):
+        """Returns: Boolean, whether this attempt is the breaker's trial call"""
+        allowed, trial = self.breaker.allow()
+        if not allowed:
+            metrics.increment('circuit_open_rejections')
+            raise CircuitOpenError("Circuit breaker is open")
+        return trial
+
+    def _after_error(self, attempt, error, trial=False):
+        """Decide whether to retry, and how long to wait
+
+        Returns: Float, seconds to wait, or None to give up"""
+
+        if get_status_code(error) == 429 and self.bucket is not None:
+            self.bucket.slow_down()
+        # A failed trial reopens the breaker rather than being retried through it
+        if trial or attempt >= self.max_retries or not is_retryable(error):
+            self.breaker.record_failure()
+            return None
+        self.retries += 1
+        metrics.increment('llm_retries', reason=get_status_code(error) or type(error).__name__)
+        return self.get_delay(attempt, error)
+
+    def _after_success(self):
+        self.breaker.record_success()
+        if self.bucket is not None:
+            self.bucket.speed_up()
+
+    def call(self, function, *args, **kwargs):
+        """Call a function under the policy
+
+        Arguments:
+            function: Function that makes one model call
+            args, kwargs: Passed on to function
+
+        Returns: The function's result
+
+        Raises: The last error, once retries are exhausted, or CircuitOpenError"""
+
+        attempt = 0
+        while True:
+            trial = self._before_attempt()
+            try:
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                result = function(*args, **kwargs)
+            except CircuitOpenError:
+                if trial:
+                    self.breaker.cancel_trial()
+                raise
+            except Exception as e:
+                delay = self._after_error(attempt, e, trial)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                if trial:
+                    self.breaker.cancel_trial()
+                raise
+            self._after_success()
+            return result
+
+    async def call_async(self, function, *args, **kwargs):
+        """Await a coroutine function under the policy
+
+        Arguments:
+            function: Coroutine function that makes one model call
+            args, kwargs: Passed on to function
+
+        Returns: The function's result
+
+        Raises: The last error, once retries are exhausted, or CircuitOpenError"""
+
+        attempt = 0
+        while True:
+            trial = self._before_attempt()
+            try:
+                if self.bucket is not None:
+                    await self.bucket.acquire_async()
+                result = await function(*args, **kwargs)
+            except CircuitOpenError:
+                if trial:
+                    self.breaker.cancel_trial()
+                raise
+            except Exception as e:
+                delay = self._after_error(attempt, e, trial)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                if trial:
+                    self.breaker.cancel_trial()
+                raise
+            self._after_success()
+            return result
+
+class DeadLetterFile:
+    """Append-only JSONL file of (rescue, task) requests that failed after
+        every retry, so that a later run can replay them"""
+
+    def __init__(self, path=default_dead_letter_path):
+        """Arguments:
+            path: String, location of the file"""
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, row, task, model_name, error):
+        """Record one failed request
+
+        Arguments:
+            row: Dictionary of the rescue's fields, e.g. id, owner_type,
+                donor_name, recipient_name and volunteer_comment
+            task: String, task name or FUSED_TASK
+            model_name: String, name of the model
+            error: Exception or String, why it failed
+
+        Returns: Nothing"""
+
+        record = {'row': {k: (None if v is None else str(v)) for k, v in row.items()}, 'task': task,
+                  'model': model_name, 'error': str(error), 'failed_at': str(datetime.datetime.now())}
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as w:
+                w.write(json.dumps(record))
+                w.write("\n")
+            self.count += 1
+
+def take_dead_letters(path=default_dead_letter_path):
+    """Move the dead letters aside to replay them, so failures during the
+        replay start a fresh file; letters from an unfinished replay are
+        picked up again
+
+    Arguments:
+        path: String, location of the dead-letter file
+
+    Returns: List of dead-letter records"""
+
+    replay_path = path + ".replaying"
+    if os.path.exists(path):
+        with open(replay_path, "a") as w:
+            w.write(open(path).read())
+        os.remove(path)
+    if not os.path.exists(replay_path):
+        return []
+
+    records = []
+    for line in open(replay_path):
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            pass
+    return records
+
+def finish_replay(path=default_dead_letter_path):
+    """Drop the dead letters taken by take_dead_letters, once their replay
+        is written
+
+    Arguments:
+        path: String, location of the dead-letter file
+
+    Returns: Nothing"""
+
+    if os.path.exists(path + ".replaying"):
+        os.remove(path + ".replaying")
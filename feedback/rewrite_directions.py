@@ -0,0 +1,65 @@
+from direction_rewrite import get_direction_complaints, group_by_location, load_rewrite_prompt, rewrite_directions, \
+    save_rewrites, get_rewrites, submit_rewrite_batch, collect_rewrite_batches, default_rewrite_path, \
+    default_manifest_path
+from database import open_pool_from_environment
+from backends import get_backend
+from batch_manager import BatchManifest
+from cache import ResponseCache
+from retry import RetryPolicy
+from usage import UsageTracker
+import argparse
+import pandas as pd
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--start_date', help='start of the window direction complaints are taken from', type=str)
+parser.add_argument('--end_date', help='end of the window direction complaints are taken from', type=str)
+parser.add_argument('--organization_id', help='organization whose direction_problem predictions are used', type=int, default=1)
+parser.add_argument('--complaints_file', help='CSV shaped like get_feedback_by_date_instruction to read complaints from instead of the database', type=str)
+parser.add_argument('--model', help='model that proposes the rewrites', type=str, default='gpt-4o-mini')
+parser.add_argument('--backend', help='model backend, e.g. openai, together, openai_compatible or fake; chosen from the model name by default', type=str)
+parser.add_argument('--batch', help='submit one Batch API request per location instead of calling the model now', action='store_true')
+parser.add_argument('--collect', help='save the rewrites of finished batches from earlier --batch runs', action='store_true')
+parser.add_argument('--max_concurrency', help='maximum number of LLM calls in flight', type=int, default=16)
+parser.add_argument('--max_retries', help='retries per LLM call, with backoff', type=int, default=5)
+parser.add_argument('--no_cache', help='do not reuse cached LLM responses', action='store_true')
+parser.add_argument('--output_file', help='CSV the proposed rewrites are appended to', type=str, default=default_rewrite_path)
+parser.add_argument('--manifest_file', help='where the rewrite batches are tracked', type=str, default=default_manifest_path)
+args = parser.parse_args()
+
+backend = get_backend(args.model, args.backend)
+cache = None if args.no_cache else ResponseCache()
+
+if args.collect:
+    collect_rewrite_batches(backend.get_batch_client(), BatchManifest(args.manifest_file), cache=cache,
+                            output_file=args.output_file)
+else:
+    if args.complaints_file:
+        complaints = pd.read_csv(args.complaints_file)
+    else:
+        pool = open_pool_from_environment()
+        complaints = get_direction_complaints(pool, args.start_date, args.end_date, args.organization_id)
+        pool.close()
+
+    locations = group_by_location(complaints)
+    print("{} direction complaints at {} locations".format(complaints['id'].nunique(), len(locations)))
+    prompt = load_rewrite_prompt()
+
+    if args.batch:
+        num_requests, cached = submit_rewrite_batch(backend.get_batch_client(), locations, args.model, prompt,
+                                                    BatchManifest(args.manifest_file), cache=cache)
+        rewrites = get_rewrites(locations, cached, args.model)
+        save_rewrites(rewrites, args.output_file)
+        print("Submitted {} locations; {} were cached, with {} proposed rewrites".format(
+            num_requests, len(cached), len(rewrites)))
+    else:
+        usage = UsageTracker(args.model)
+        rewrites = rewrite_directions(backend.get_async_client(max_retries=0), locations, args.model, prompt,
+                                      cache=cache, usage=usage, max_concurrency=args.max_concurrency,
+                                      retry=RetryPolicy(max_retries=args.max_retries), close_client=True)
+        save_rewrites(rewrites, args.output_file)
+        print("Saved {} proposed rewrites to {}".format(len(rewrites), args.output_file))
+        usage.print_report()
+        print("Usage report written to {}".format(usage.save_report('rewrite_directions')))
+
+if cache is not None:
+    cache.close()
@@ -0,0 +1,60 @@
+from evaluation import predict_evaluation_runs, load_evaluation_dataset, get_output_name, evaluate_directory, \
+    prompt_variants, default_evaluation_path
+from cache import ResponseCache
+import argparse
+import os
+import pandas as pd
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--models', help='comma-separated models to run', type=str, default='gpt-4o-mini')
+parser.add_argument('--variants', help='comma-separated prompt variants to run with every model: ' + ', '.join(prompt_variants),
+                    type=str, default='baseline')
+parser.add_argument('--eval_file', help='annotations whose comments are classified, and scored against', type=str,
+                    default="{}/../data/annotations/pre_deploy_eval.csv".format(os.path.dirname(__file__)))
+parser.add_argument('--annotator', help='annotator whose rows the comments are taken from', type=str, default='naveen')
+parser.add_argument('--names_file', help='donor and recipient names of the evaluation rescues', type=str,
+                    default="{}/../data/annotations/donor_recipient_annotated_names.csv".format(os.path.dirname(__file__)))
+parser.add_argument('--dataset_file', help='CSV with id, donor_name, recipient_name and volunteer_comment to classify instead of the annotated comments', type=str)
+parser.add_argument('--output_dir', help='where the prediction CSVs are written', type=str, default=default_evaluation_path)
+parser.add_argument('--backend', help='model backend for every model; chosen from each model name by default', type=str)
+parser.add_argument('--max_concurrency', help='maximum number of LLM calls in flight per provider', type=int, default=16)
+parser.add_argument('--rate_limits', help='comma-separated requests per second per provider, e.g. openai=50,together=10', type=str)
+parser.add_argument('--max_retries', help='retries per LLM call, with backoff', type=int, default=5)
+parser.add_argument('--no_cache', help='do not reuse cached LLM responses', action='store_true')
+parser.add_argument('--no_score', help='do not score the new predictions against the annotations', action='store_true')
+args = parser.parse_args()
+
+variants = args.variants.split(',')
+for variant in variants:
+    if variant not in prompt_variants:
+        raise Exception("Variant {} not found; variants are {}".format(variant, prompt_variants))
+runs = [(model_name, variant) for model_name in args.models.split(',') for variant in variants]
+rate_limits = {}
+if args.rate_limits:
+    for limit in args.rate_limits.split(','):
+        provider, rate = limit.split('=')
+        rate_limits[provider] = float(rate)
+
+if args.dataset_file:
+    dataset = pd.read_csv(args.dataset_file)
+else:
+    dataset = load_evaluation_dataset(args.eval_file, args.names_file, args.annotator)
+
+cache = None if args.no_cache else ResponseCache()
+predictions = predict_evaluation_runs(dataset, runs, backend=args.backend, cache=cache,
+                                      max_concurrency=args.max_concurrency, rate_limits=rate_limits,
+                                      max_retries=args.max_retries)
+if cache is not None:
+    cache.close()
+
+os.makedirs(args.output_dir, exist_ok=True)
+names = []
+for (model_name, variant), run_predictions in predictions.items():
+    names.append(get_output_name(model_name, variant))
+    output_file = "{}/{}.csv".format(args.output_dir, names[-1])
+    run_predictions.to_csv(output_file, index=False)
+    print("Wrote {}".format(output_file))
+
+if not args.no_score and not args.dataset_file and os.path.exists(args.eval_file):
+    scores, agreement = evaluate_directory(args.eval_file, model_names=names, directory=args.output_dir)
+    print(scores.pivot_table(index=['model', 'task'], columns='metric', values='value').round(3).to_string())
@@ -0,0 +1,325 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from feedback.bulk_writer import copy_rows
+from feedback.fake_server import LABEL_RATES
+from feedback.fr_feedback import all_tasks
+
+default_corpus_path = "{}/../results/evaluation/gpt-4o-mini.csv".format(os.path.dirname(__file__))
+
+# Seeding drops the pipeline's tables, so by default it only runs against a
+# database whose name contains one of these
+SCRATCH_DATABASE_MARKERS = ['synthetic', 'loadtest']
+
+# Tables in the order they are loaded, with their columns
+SCHEMA = {
+    'donors': "id bigint, name text",
+    'donor_locations': "id bigint, donor_id bigint, name text",
+    'recipients': "id bigint, name text",
+    'recipient_locations': "id bigint, recipient_id bigint, name text",
+    'rescues': "id bigint, donation_id bigint, published_at timestamp, volunteer_comment text",
+    'delivery_summaries': """delivery_id bigint, delivery_type text, published_at timestamp, volunteer_comment text,
+        donor_ids bigint[], donor_location_ids bigint[], recipient_ids bigint[], recipient_location_ids bigint[]""",
+    'special_instructions': "id bigint, owner_id bigint, owner_type text, text text",
+    'organizations_donations': "organization_id bigint, donation_id bigint",
+    'rescue_feedback': "id bigserial, owner_id bigint, owner_type text, created_at timestamp, updated_at timestamp, "
+        + ", ".join("{} boolean".format(task) for task in all_tasks),
+}
+
+# Keys, added once the rows are loaded
+CONSTRAINTS = {
+    'donors': ["PRIMARY KEY (id)"],
+    'donor_locations': ["PRIMARY KEY (id)"],
+    'recipients': ["PRIMARY KEY (id)"],
+    'recipient_locations': ["PRIMARY KEY (id)"],
+    'rescues': ["PRIMARY KEY (id)"],
+    'delivery_summaries': ["PRIMARY KEY (delivery_id, delivery_type)"],
+    'special_instructions': ["PRIMARY KEY (id)"],
+    'rescue_feedback': ["PRIMARY KEY (id)", "UNIQUE (owner_id, owner_type)"],
+}
+
+def load_corpus(path=default_corpus_path):
+    """Real volunteer comments, whose wording and lengths the synthetic
+        comments follow
+
+    Arguments:
+        path: String, CSV file with a volunteer_comment column
+
+    Returns: List of Strings"""
+
+    comments = pd.read_csv(path)['volunteer_comment'].dropna().astype(str)
+    return list(comments[comments.str.strip() != ''])
+
+def get_synthetic_comments(rng, num_comments, corpus, verbatim_rate=0.3):
+    """Comments with the corpus's length distribution: some repeated word for
+        word, as short stock comments are, the rest drawn word by word
+
+    Arguments:
+        rng: Numpy random Generator
+        num_comments: Integer
+        corpus: List of real comments
+        verbatim_rate: Float, share of comments copied from the corpus
+
+    Returns: Numpy array of Strings"""
+
+    words = np.array(" ".join(corpus).split())
+    # Word counts are roughly log-normal: many one-liners and a long tail
+    log_lengths = np.log([len(comment.split()) for comment in corpus])
+    lengths = np.clip(np.rint(rng.lognormal(log_lengths.mean(), log_lengths.std(), num_comments)), 1, 300).astype(int)
+
+    drawn = words[rng.integers(0, len(words), lengths.sum())]
+    comments = np.array([" ".join(chunk) for chunk in np.split(drawn, np.cumsum(lengths)[:-1])], dtype=object)
+    verbatim = rng.random(num_comments) < verbatim_rate
+    comments[verbatim] = np.array(corpus, dtype=object)[rng.integers(0, len(corpus), verbatim.sum())]
+    return comments
+
+def get_fanout(rng, size, p, maximum=5):
+    """Number of locations per rescue: usually one, occasionally several
+
+    Arguments:
+        rng: Numpy random Generator
+        size: Integer, number of rescues
+        p: Float, probability of a single location
+        maximum: Integer, most locations per rescue
+
+    Returns: Numpy array of Integers"""
+
+    return np.minimum(rng.geometric(p, size), maximum)
+
+def get_locations(rng, owners, num_locations, owner_column, prefix):
+    """Owners and their locations, each owner with at least one location"""
+
+    owner_ids = np.concatenate([owners['id'].to_numpy(),
+                                rng.choice(owners['id'].to_numpy(), max(num_locations - len(owners), 0))])
+    locations = pd.DataFrame({'id': np.arange(1, len(owner_ids)+1), owner_column: owner_ids})
+    locations['name'] = prefix + ' location ' + locations['id'].astype(str)
+    return locations
+
+def get_location_arrays(rng, locations, owner_column, fanout):
+    """Location id and owner id arrays for each rescue, aligned by position
+        as they are in delivery_summaries"""
+
+    picked = rng.integers(0, len(locations), fanout.sum())
+    splits = np.cumsum(fanout)[:-1]
+    location_ids = [list(ids) for ids in np.split(locations['id'].to_numpy()[picked], splits)]
+    owner_ids = [list(ids) for ids in np.split(locations[owner_column].to_numpy()[picked], splits)]
+    return location_ids, owner_ids
+
+def generate_synthetic_data(num_rescues=100000, num_donors=None, num_recipients=None, num_organizations=20,
+                            start_date='2023-01-01', end_date='2024-12-31', comment_rate=0.3,
+                            empty_comment_rate=0.05, instruction_rate=0.3, labelled_rate=0.5,
+                            corpus=None, seed=42):
+    """Generate every table the feedback queries read, at a given scale
+
+    Arguments:
+        num_rescues: Integer, number of rescues
+        num_donors: Integer or None, defaults to one per 200 rescues
+        num_recipients: Integer or None, defaults to one per 200 rescues
+        num_organizations: Integer, organizations the donations belong to
+        start_date: String, earliest publish date
+        end_date: String, latest publish date
+        comment_rate: Float, share of rescues with a volunteer comment
+        empty_comment_rate: Float, share of comments that are empty strings
+        instruction_rate: Float, share of locations with special instructions
+        labelled_rate: Float, share of commented rescues already in rescue_feedback
+        corpus: List of real comments, or None to load the default corpus
+        seed: Integer, random seed
+
+    Returns: Dictionary mapping table name to a DataFrame"""
+
+    rng = np.random.default_rng(seed)
+    corpus = load_corpus() if corpus is None else corpus
+    num_donors = num_donors or max(num_rescues//200, 10)
+    num_recipients = num_recipients or max(num_rescues//200, 10)
+
+    donors = pd.DataFrame({'id': np.arange(1, num_donors+1)})
+    donors['name'] = 'Donor ' + donors['id'].astype(str)
+    recipients = pd.DataFrame({'id': np.arange(1, num_recipients+1)})
+    recipients['name'] = 'Recipient ' + recipients['id'].astype(str)
+    donor_locations = get_locations(rng, donors, int(num_donors*1.5), 'donor_id', 'Donor')
+    recipient_locations = get_locations(rng, recipients, int(num_recipients*1.2), 'recipient_id', 'Recipient')
+
+    start = pd.Timestamp(start_date).value
+    end = pd.Timestamp(end_date).value
+    published_at = pd.to_datetime(np.sort(rng.integers(start, end, num_rescues))).floor('s')
+
+    comments = np.full(num_rescues, None, dtype=object)
+    commented = rng.random(num_rescues) < comment_rate
+    comments[commented] = get_synthetic_comments(rng, commented.sum(), corpus)
+    comments[commented & (rng.random(num_rescues) < empty_comment_rate)] = ''
+
+    ids = np.arange(1, num_rescues+1)
+    rescues = pd.DataFrame({'id': ids, 'donation_id': ids, 'published_at': published_at,
+                            'volunteer_comment': comments})
+
+    donor_location_ids, donor_ids = get_location_arrays(rng, donor_locations, 'donor_id',
+                                                        get_fanout(rng, num_rescues, 0.85))
+    recipient_location_ids, recipient_ids = get_location_arrays(rng, recipient_locations, 'recipient_id',
+                                                                get_fanout(rng, num_rescues, 0.9))
+    delivery_summaries = pd.DataFrame({'delivery_id': ids, 'delivery_type': 'Rescue',
+                                       'published_at': published_at, 'volunteer_comment': comments,
+                                       'donor_ids': donor_ids, 'donor_location_ids': donor_location_ids,
+                                       'recipient_ids': recipient_ids,
+                                       'recipient_location_ids': recipient_location_ids})
+
+    instructions = []
+    for owner_type, locations in (('DonorLocation', donor_locations), ('RecipientLocation', recipient_locations)):
+        owners = locations['id'].to_numpy()[rng.random(len(locations)) < instruction_rate]
+        owners = np.repeat(owners, rng.integers(1, 4, len(owners)))
+        instructions.append(pd.DataFrame({'owner_id': owners, 'owner_type': owner_type,
+                                          'text': get_synthetic_comments(rng, len(owners), corpus, 0)}))
+    special_instructions = pd.concat(instructions, ignore_index=True)
+    special_instructions.insert(0, 'id', np.arange(1, len(special_instructions)+1))
+
+    # Most donations belong to one organization, some to two
+    shared = rng.random(num_rescues) < 0.1
+    organizations_donations = pd.DataFrame({
+        'organization_id': np.concatenate([rng.integers(1, num_organizations+1, num_rescues),
+                                           rng.integers(1, num_organizations+1, shared.sum())]),
+        'donation_id': np.concatenate([ids, ids[shared]])}).drop_duplicates()
+
+    labelled = ids[commented & (rng.random(num_rescues) < labelled_rate)]
+    created_at = pd.Timestamp(end_date)
+    rescue_feedback = pd.DataFrame({'owner_id': labelled, 'owner_type': 'Rescue',
+                                    'created_at': created_at, 'updated_at': created_at})
+    for task in all_tasks:
+        rescue_feedback[task] = rng.random(len(labelled)) < LABEL_RATES[task]
+
+    return {'donors': donors, 'donor_locations': donor_locations, 'recipients': recipients,
+            'recipient_locations': recipient_locations, 'rescues': rescues,
+            'delivery_summaries': delivery_summaries, 'special_instructions': special_instructions,
+            'organizations_donations': organizations_donations, 'rescue_feedback': rescue_feedback}
+
+def get_feedback_frame(tables):
+    """The rows get_feedback_by_date would return for the generated tables,
+        for benchmarks that run without a database
+
+    Arguments:
+        tables: Dictionary mapping table name to a DataFrame,
+            from generate_synthetic_data
+
+    Returns: DataFrame, one row per rescue and location pair, with empty
+        comments removed"""
+
+    summaries = tables['delivery_summaries']
+    summaries = summaries[summaries['volunteer_comment'].notnull() & (summaries['volunteer_comment'] != '')]
+    donors = summaries[['delivery_id', 'donor_location_ids']].explode('donor_location_ids')
+    recipients = summaries[['delivery_id', 'recipient_location_ids']].explode('recipient_location_ids')
+    pairs = donors.merge(recipients, on='delivery_id')
+
+    donor_names = tables['donor_locations'].merge(tables['donors'], left_on='donor_id', right_on='id',
+                                                  suffixes=('', '_donor'))
+    donor_names = (donor_names['name_donor'] + ' - ' + donor_names['name']).set_axis(donor_names['id'])
+    recipient_names = tables['recipient_locations'].merge(tables['recipients'], left_on='recipient_id',
+                                                          right_on='id', suffixes=('', '_recipient'))
+    recipient_names = (recipient_names['name_recipient'] + ' - ' + recipient_names['name']).set_axis(recipient_names['id'])
+
+    comments = tables['rescues'].set_index('id')['volunteer_comment']
+    return pd.DataFrame({'donor_name': pairs['donor_location_ids'].map(donor_names).to_numpy(),
+                         'recipient_name': pairs['recipient_location_ids'].map(recipient_names).to_numpy(),
+                         'id': pairs['delivery_id'].to_numpy(), 'owner_type': 'Rescue',
+                         'volunteer_comment': pairs['delivery_id'].map(comments).to_numpy()})
+
+def is_scratch_database(database_name):
+    """Whether a database is named as one that holds only test data, and may
+        have its tables dropped or filled with fake rows
+
+    Arguments:
+        database_name: String or None, name of the database
+
+    Returns: Boolean"""
+
+    return database_name is not None and any(marker in database_name.lower() for marker in SCRATCH_DATABASE_MARKERS)
+
+def create_schema(cursor, drop=False):
+    """Create the tables, without their keys
+
+    Arguments:
+        cursor: Cursor on a PSQL connection
+        drop: Boolean, whether to drop existing tables first
+
+    Returns: Nothing"""
+
+    for table, columns in SCHEMA.items():
+        if drop:
+            cursor.execute("DROP TABLE IF EXISTS {} CASCADE".format(table))
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(table, columns))
+
+def load_synthetic_data(connection, tables, allow_any_database=False):
+    """Seed a database with generated tables, replacing any existing ones:
+        COPY into bare tables, then build their keys and statistics once,
+        which is much faster than maintaining them row by row
+
+    Arguments:
+        connection: PSQL connection
+        tables: Dictionary mapping table name to a DataFrame,
+            from generate_synthetic_data
+        allow_any_database: Boolean, whether to drop the tables of a database
+            that is_scratch_database doesn't recognize
+
+    Returns: Dictionary mapping table name to the number of rows loaded"""
+
+    database_name = connection.info.dbname
+    if not allow_any_database and not is_scratch_database(database_name):
+        raise Exception("Refusing to drop the tables of {}: its name contains none of {}".format(
+            database_name, SCRATCH_DATABASE_MARKERS))
+
+    cursor = connection.cursor()
+    create_schema(cursor, drop=True)
+
+    counts = {}
+    for table, data in tables.items():
+        start = time.perf_counter()
+        values = data.astype(object).where(data.notnull(), None).itertuples(index=False, name=None)
+        counts[table] = copy_rows(cursor, table, list(data.columns), values)
+        print("Loaded {} rows into {} in {:.1f}s".format(counts[table], table, time.perf_counter() - start))
+
+    for table, constraints in CONSTRAINTS.items():
+        for constraint in constraints:
+            cursor.execute("ALTER TABLE {} ADD {}".format(table, constraint))
+    connection.commit()
+
+    autocommit = connection.autocommit
+    connection.autocommit = True
+    cursor.execute("ANALYZE")
+    connection.autocommit = autocommit
+    cursor.close()
+    return counts
+
+if __name__ == "__main__":
+    from feedback.database import open_connection
+    from feedback.query_plans import create_indexes
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', help='database to seed; its tables are dropped, so its name must contain {}'.format(
+        ' or '.join(SCRATCH_DATABASE_MARKERS)), type=str, required=True)
+    parser.add_argument('--yes_drop_tables', help='seed a database whatever its name, dropping its tables', action='store_true')
+    parser.add_argument('--num_rescues', help='number of rescues to generate', type=int, default=100000)
+    parser.add_argument('--start_date', help='earliest publish date', type=str, default='2023-01-01')
+    parser.add_argument('--end_date', help='latest publish date', type=str, default='2024-12-31')
+    parser.add_argument('--comment_rate', help='share of rescues with a volunteer comment', type=float, default=0.3)
+    parser.add_argument('--labelled_rate', help='share of commented rescues already in rescue_feedback', type=float, default=0.5)
+    parser.add_argument('--seed', help='random seed', type=int, default=42)
+    parser.add_argument('--indexes', help='also create the recommended indexes from query_plans.py', action='store_true')
+    args = parser.parse_args()
+    if not args.yes_drop_tables and not is_scratch_database(args.database):
+        parser.error("seeding drops the tables of {}; use a database named with {}, or pass --yes_drop_tables".format(
+            args.database, ' or '.join(SCRATCH_DATABASE_MARKERS)))
+
+    start = time.perf_counter()
+    tables = generate_synthetic_data(args.num_rescues, start_date=args.start_date, end_date=args.end_date,
+                                     comment_rate=args.comment_rate, labelled_rate=args.labelled_rate,
+                                     seed=args.seed)
+    print("Generated {} rescues in {:.1f}s".format(args.num_rescues, time.perf_counter() - start))
+
+    connection = open_connection(args.database, os.environ.get("POSTGRES_USER"),
+                                 os.environ.get("POSTGRES_PASSWORD"), os.environ.get("DATABASE_HOST"),
+                                 os.environ.get("DATABASE_PORT") or '5432')['connection']
+    load_synthetic_data(connection, tables, allow_any_database=args.yes_drop_tables)
+    if args.indexes:
+        create_indexes(connection)
+    connection.close()
@@ -0,0 +1,28 @@
+from prefilter import LocalPrefilter, get_prefilter_report, default_training_path, default_model_path
+from evaluation import load_groundtruth
+import argparse
+import os
+import pandas as pd
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--training_file', help='annotations to train on', type=str, default=default_training_path)
+parser.add_argument('--eval_file', help='annotations to report calls saved and recall lost on', type=str,
+                    default="{}/../data/annotations/pre_deploy_eval.csv".format(os.path.dirname(__file__)))
+parser.add_argument('--annotator', help='annotator in the evaluation file', type=str, default='naveen')
+parser.add_argument('--llm_predictions', help='LLM predictions on the evaluation comments', type=str,
+                    default="{}/../results/evaluation/gpt-4o-mini.csv".format(os.path.dirname(__file__)))
+parser.add_argument('--threshold', help='confidence needed to resolve a label locally', type=float, default=0.95)
+parser.add_argument('--output', help='where to save the pre-filter', type=str, default=default_model_path)
+args = parser.parse_args()
+
+prefilter = LocalPrefilter(threshold=args.threshold).fit(pd.read_csv(args.training_file))
+prefilter.save(args.output)
+print("Saved pre-filter to {}".format(args.output))
+
+if os.path.exists(args.eval_file):
+    groundtruth = load_groundtruth(args.eval_file, args.annotator)
+    llm_predictions = pd.read_csv(args.llm_predictions) if os.path.exists(args.llm_predictions) else None
+    thresholds = sorted(set([0.8, 0.9, 0.95, 0.98, 0.99, args.threshold]))
+    report = get_prefilter_report(prefilter, groundtruth, llm_predictions, thresholds)
+    print(report[report['task'] == 'all'].to_string(index=False))
+    print(report[report['threshold'] == args.threshold].to_string(index=False))
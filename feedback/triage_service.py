@@ -0,0 +1,441 @@
+import argparse
+import datetime
+import json
+import os
+import queue
+import select
+import signal
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from feedback import metrics
+from feedback.bulk_writer import write_rescue_feedback
+from feedback.backends import get_backend
+from feedback.fr_feedback import generate_prompts_and_analyze_feedback, all_tasks, load_request_prompts
+from feedback.retry import RetryPolicy, DeadLetterFile
+from feedback.watermark import load_watermark, save_watermark, get_unprocessed_feedback, advance_watermark, \
+    default_watermark_path
+
+default_channel = 'new_volunteer_comment'
+
+def get_notify_trigger_query(channel=default_channel):
+    """Trigger that notifies a channel when a rescue gets a volunteer comment,
+        so the service wakes up without waiting for its next poll
+
+    Arguments:
+        channel: String, channel to notify, with the rescue id as the payload
+
+    Returns: String, SQL statements"""
+
+    return """CREATE OR REPLACE FUNCTION notify_{channel}() RETURNS trigger AS $$
+    BEGIN
+    IF NEW.volunteer_comment IS NOT NULL AND NEW.volunteer_comment <> '' THEN
+    PERFORM pg_notify('{channel}', NEW.id::text);
+    END IF;
+    RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS {channel}_trigger ON rescues;
+    CREATE TRIGGER {channel}_trigger AFTER INSERT OR UPDATE OF volunteer_comment ON rescues
+    FOR EACH ROW EXECUTE FUNCTION notify_{channel}();""".format(channel=channel)
+
+class MicroBatcher:
+    """Bounded queue of new comments, handed out in micro-batches of up to
+        batch_size rows, or fewer once batch_window seconds have passed
+        since the first row of the batch arrived
+        A full queue blocks put, which stops the poller fetching more"""
+
+    def __init__(self, batch_size=50, batch_window=2.0, max_queue=1000):
+        """Arguments:
+            batch_size: Integer, most rows per micro-batch
+            batch_window: Float, seconds a micro-batch waits to fill up
+            max_queue: Integer, rows waiting at most"""
+
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = threading.Event()
+
+    def put(self, feedbacks, stop=None):
+        """Queue rows, blocking while the queue is full
+
+        Arguments:
+            feedbacks: DataFrame of new comments
+            stop: threading.Event or None; once set, rows not yet queued are dropped
+
+        Returns: Integer, number of rows queued"""
+
+        detected_at = time.time()
+        queued = 0
+        for row in feedbacks.to_dict('records'):
+            while True:
+                if stop is not None and stop.is_set():
+                    return queued
+                try:
+                    self.queue.put((row, detected_at), timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            queued += 1
+        return queued
+
+    def get_batch(self):
+        """Wait for the next micro-batch
+
+        Returns: Tuple of a DataFrame of rows and a list of the times each
+            row was detected, or None once the batcher is closed and empty,
+            or if nothing arrived within half a second"""
+
+        try:
+            rows = [self.queue.get(timeout=0.5)]
+        except queue.Empty:
+            return None
+        deadline = time.monotonic() + self.batch_window
+        while len(rows) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(self.queue.get(timeout=remaining if not self.closed.is_set() else 0.01))
+            except queue.Empty:
+                if self.closed.is_set():
+                    break
+        return pd.DataFrame([row for row, _ in rows]), [detected_at for _, detected_at in rows]
+
+    def close(self):
+        """Stop waiting for micro-batches to fill; the queued rows are still handed out"""
+        self.closed.set()
+
+    def __len__(self):
+        return self.queue.qsize()
+
+class LatencyStats:
+    """Thread-safe record of how long comments took to reach rescue_feedback,
+        from when the rescue was published and from when the service saw it"""
+
+    def __init__(self, window=10000):
+        """Arguments:
+            window: Integer, latest comments the percentiles are computed over"""
+
+        self.lock = threading.Lock()
+        self.since_published = deque(maxlen=window)
+        self.since_detected = deque(maxlen=window)
+        self.written = 0
+        self.batches = 0
+        self.started = time.time()
+
+    def record(self, published_at, detected_at, written_at):
+        """Record a written micro-batch
+
+        Arguments:
+            published_at: List of publish times (datetime or String), one per row
+            detected_at: List of Floats, epoch seconds each row was fetched
+            written_at: Float, epoch seconds the batch was committed
+
+        Returns: Nothing"""
+
+        published = pd.to_datetime(pd.Series(published_at))
+        if published.dt.tz is None:
+            published = published.dt.tz_localize(datetime.datetime.now().astimezone().tzinfo)
+        published = published.map(lambda t: t.timestamp()).to_numpy()
+        if metrics.is_enabled():
+            for latency in written_at - published:
+                metrics.observe('triage_latency_seconds', latency)
+        with self.lock:
+            self.since_published.extend(written_at - published)
+            self.since_detected.extend(written_at - np.asarray(detected_at))
+            self.written += len(detected_at)
+            self.batches += 1
+
+    def summary(self):
+        """Percentiles of the latest latencies, in seconds
+
+        Returns: Dictionary"""
+
+        with self.lock:
+            summary = {'written': self.written, 'batches': self.batches,
+                       'comments_per_second': self.written/max(time.time() - self.started, 1e-9)}
+            for name, latencies in [('since_published', self.since_published), ('since_detected', self.since_detected)]:
+                for q in [50, 95, 99]:
+                    summary['{}_p{}'.format(name, q)] = float(np.percentile(latencies, q)) if len(latencies) > 0 else None
+        return summary
+
+class TriageService:
+    """Long-running worker that classifies new comments within seconds: a
+        poller fetches comments not yet in rescue_feedback, a MicroBatcher
+        groups them, and worker threads classify each micro-batch with the
+        prompts in fr_feedback and write it to rescue_feedback"""
+
+    def __init__(self, pool, model_name, start_date, parallelism=4, batch_size=50, batch_window=2.0,
+                 max_queue=1000, poll_interval=5.0, lookback_days=7, listen_connection=None,
+                 channel=default_channel, watermark_name='triage_service', watermark_path=default_watermark_path,
+                 stats_file=None, metrics_file=None, **kwargs):
+        """Arguments:
+            pool: ConnectionPool
+            model_name: String, name of the model
+            start_date: String, comments published after this are classified
+                on the first run; later runs resume from the watermark
+            parallelism: Integer, micro-batches classified at once
+            batch_size: Integer, most comments per micro-batch
+            batch_window: Float, seconds a micro-batch waits to fill up
+            max_queue: Integer, comments waiting at most; the poller stops
+                fetching while the queue is full
+            poll_interval: Float, seconds between polls
+            lookback_days: Float, how far before the watermark to look for late comments
+            listen_connection: psycopg2 connection in autocommit mode, or None;
+                notifications on channel trigger a poll straight away
+            channel: String, channel to LISTEN on
+            watermark_name: String, name of the service's watermark
+            watermark_path: String, location of the watermark file
+            stats_file: String or None, JSONL file the latency statistics are appended to
+            metrics_file: String or None, where the metrics are saved with each
+                latency report, if they are enabled
+            kwargs: Passed on to generate_prompts_and_analyze_feedback
+                (e.g. max_concurrency, fused, backend, retry, dead_letters);
+                throttle with a RetryPolicy's requests_per_second, which is
+                shared by every worker"""
+
+        self.pool = pool
+        self.model_name = model_name
+        self.start_date = start_date
+        self.parallelism = parallelism
+        self.poll_interval = poll_interval
+        self.lookback_days = lookback_days
+        self.listen_connection = listen_connection
+        self.channel = channel
+        self.watermark_name = watermark_name
+        self.watermark_path = watermark_path
+        self.stats_file = stats_file
+        self.metrics_file = metrics_file
+        # Each micro-batch would get its own per-minute budget, so together
+        # the workers would use parallelism times the intended rate
+        self.kwargs = dict({'requests_per_minute': None, 'tokens_per_minute': None}, **kwargs)
+        # Loaded once, rather than for every micro-batch
+        self.kwargs['backend'] = get_backend(model_name, self.kwargs.get('backend'))
+        if self.kwargs.get('prompts') is None:
+            self.kwargs['prompts'] = load_request_prompts(fused=self.kwargs.get('fused', False),
+                                                          cache=self.kwargs.get('cache'))
+
+        self.batcher = MicroBatcher(batch_size, batch_window, max_queue)
+        self.stats = LatencyStats()
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.watermark = load_watermark(watermark_name, watermark_path)
+
+    def fetch(self):
+        """New comments that are neither written nor already queued
+
+        Returns: DataFrame"""
+
+        with self.lock:
+            watermark = self.watermark
+        feedbacks = get_unprocessed_feedback(self.pool, watermark, self.start_date, lookback_days=self.lookback_days)
+        with self.lock:
+            in_flight = set(self.in_flight)
+        return feedbacks[~feedbacks['id'].isin(in_flight)]
+
+    def write(self, annotated_feedback):
+        """Write a classified micro-batch to rescue_feedback
+
+        Arguments:
+            annotated_feedback: DataFrame from generate_prompts_and_analyze_feedback
+
+        Returns: Dictionary of write statistics"""
+
+        current_time = datetime.datetime.now()
+        columns = list(annotated_feedback.columns) + ['created_at', 'updated_at']
+        values = [tuple(row) + (current_time, current_time) for row in annotated_feedback.to_numpy()]
+        return write_rescue_feedback(self.pool, values, columns)
+
+    def process(self, feedbacks, detected_at):
+        """Classify and write one micro-batch, then advance the watermark
+            Comments with a label the model failed to give are not written,
+            nor added to the watermark, so a later poll picks them up again
+
+        Arguments:
+            feedbacks: DataFrame, the micro-batch
+            detected_at: List of Floats, when each row was fetched
+
+        Returns: Nothing"""
+
+        try:
+            annotated_feedback = generate_prompts_and_analyze_feedback(feedbacks, self.model_name, **self.kwargs)
+            # Failed LLM calls are swallowed, leaving their labels None
+            resolved = annotated_feedback[all_tasks].notnull().all(axis=1).to_numpy()
+            if resolved.any():
+                self.write(annotated_feedback[resolved])
+        except Exception as e:
+            # Nothing was written, so a later poll picks the comments up again
+            print("Error processing a micro-batch of {} comments: {}".format(len(feedbacks), e))
+            with self.lock:
+                self.in_flight.difference_update(feedbacks['id'])
+            return
+
+        done = ~feedbacks['id'].isin(annotated_feedback.loc[~resolved, 'owner_id']).to_numpy()
+        if not done.all():
+            metrics.increment('triage_retried', int((~done).sum()))
+            print("{} comments had failed labels and will be retried".format(int((~done).sum())))
+        if done.any():
+            self.stats.record(feedbacks['published_at'][done].tolist(), list(np.array(detected_at)[done]), time.time())
+        with self.lock:
+            self.in_flight.difference_update(feedbacks['id'])
+            self.watermark = advance_watermark(self.watermark, feedbacks[done], self.lookback_days)
+            save_watermark(self.watermark_name, self.watermark, self.watermark_path)
+
+    def work(self):
+        """Worker thread: process micro-batches until the batcher is closed and drained"""
+        while True:
+            batch = self.batcher.get_batch()
+            if batch is None:
+                if self.batcher.closed.is_set():
+                    return
+                continue
+            self.process(*batch)
+
+    def wait(self, timeout):
+        """Sleep until the next poll, waking early on a notification or shutdown"""
+
+        if self.listen_connection is None:
+            self.stop.wait(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while not self.stop.is_set() and time.monotonic() < deadline:
+            if select.select([self.listen_connection], [], [], min(0.5, max(deadline - time.monotonic(), 0)))[0]:
+                self.listen_connection.poll()
+                if len(self.listen_connection.notifies) > 0:
+                    self.listen_connection.notifies.clear()
+                    return
+
+    def print_stats(self):
+        """Print, and optionally save, the latency statistics"""
+
+        summary = self.stats.summary()
+        summary.update({'queued': len(self.batcher), 'in_flight': len(self.in_flight),
+                        'time': str(datetime.datetime.now())})
+        print("Triage: {} comments in {} batches ({:.1f}/s), {} queued; seconds since published p50/p95/p99 "
+              "{}/{}/{}, since detected {}/{}/{}".format(
+                  summary['written'], summary['batches'], summary['comments_per_second'], summary['queued'],
+                  *["{:.1f}".format(summary[k]) if summary[k] is not None else '-' for k in
+                    ['since_published_p50', 'since_published_p95', 'since_published_p99',
+                     'since_detected_p50', 'since_detected_p95', 'since_detected_p99']]))
+        if self.stats_file is not None:
+            with open(self.stats_file, "a") as w:
+                w.write(json.dumps(summary) + "\n")
+        metrics.save(self.metrics_file)
+
+    def shutdown(self, *args):
+        """Stop polling; queued and in-flight micro-batches are still finished
+            When called as a signal handler, a second signal stops at once"""
+
+        if len(args) > 0:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if not self.stop.is_set():
+            print("Shutting down after the queued comments are written")
+        self.stop.set()
+
+    def run(self, duration=None, stats_interval=60):
+        """Poll, classify and write until shut down
+
+        Arguments:
+            duration: Float or None, seconds to run for; None runs until
+                SIGINT or SIGTERM
+            stats_interval: Float, seconds between latency reports
+
+        Returns: Dictionary, the final latency statistics"""
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.shutdown)
+            signal.signal(signal.SIGTERM, self.shutdown)
+        if self.listen_connection is not None:
+            self.listen_connection.cursor().execute("LISTEN {}".format(self.channel))
+
+        workers = [threading.Thread(target=self.work) for _ in range(self.parallelism)]
+        for worker in workers:
+            worker.start()
+
+        started = time.monotonic()
+        last_stats = started
+        try:
+            while not self.stop.is_set():
+                try:
+                    feedbacks = self.fetch()
+                except Exception as e:
+                    print("Error polling for new comments: {}".format(e))
+                    feedbacks = None
+                if feedbacks is not None and len(feedbacks) > 0:
+                    with self.lock:
+                        self.in_flight.update(feedbacks['id'])
+                    self.batcher.put(feedbacks, self.stop)
+                if time.monotonic() - last_stats >= stats_interval:
+                    self.print_stats()
+                    last_stats = time.monotonic()
+                if duration is not None and time.monotonic() - started >= duration:
+                    self.shutdown()
+                    break
+                self.wait(self.poll_interval)
+        finally:
+            self.stop.set()
+            self.batcher.close()
+            for worker in workers:
+                worker.join()
+            self.print_stats()
+        return self.stats.summary()
+
+if __name__ == "__main__":
+    from feedback.database import open_pool_from_environment, open_connection
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start_date', help='on the first run, classify comments published after this; later runs resume from the watermark', type=str,
+                        default=str(datetime.date.today()))
+    parser.add_argument('--model', help='model that classifies the comments', type=str, default='gpt-4o-mini')
+    parser.add_argument('--backend', help='model backend, e.g. openai, together, openai_compatible or fake; chosen from the model name by default', type=str)
+    parser.add_argument('--fused', help='classify all tasks with one combined prompt', action='store_true')
+    parser.add_argument('--parallelism', help='micro-batches classified at once', type=int, default=4)
+    parser.add_argument('--max_concurrency', help='maximum number of LLM calls in flight per micro-batch', type=int, default=16)
+    parser.add_argument('--batch_size', help='most comments per micro-batch', type=int, default=50)
+    parser.add_argument('--batch_window', help='seconds a micro-batch waits to fill up', type=float, default=2.0)
+    parser.add_argument('--max_queue', help='comments waiting at most before polling pauses', type=int, default=1000)
+    parser.add_argument('--poll_interval', help='seconds between polls for new comments', type=float, default=5.0)
+    parser.add_argument('--listen', help='also wake up on notifications from the trigger installed with --install_trigger', action='store_true')
+    parser.add_argument('--install_trigger', help='create the trigger on rescues that notifies the service of new comments', action='store_true')
+    parser.add_argument('--requests_per_second', help='LLM calls per second across all workers; unthrottled by default', type=float)
+    parser.add_argument('--lookback_days', help='how far before the watermark to look for late comments', type=float, default=7)
+    parser.add_argument('--max_retries', help='retries per LLM call, with backoff, before it goes to the dead-letter file', type=int, default=5)
+    parser.add_argument('--duration', help='seconds to run for; runs until SIGINT or SIGTERM by default', type=float)
+    parser.add_argument('--stats_interval', help='seconds between latency reports', type=float, default=60)
+    parser.add_argument('--stats_file', help='jsonl file the latency reports are appended to', type=str)
+    parser.add_argument('--metrics_file', help='record timers, counters, tokens and latencies with each latency report: Prometheus text if it ends in .prom, JSON lines otherwise', type=str)
+    args = parser.parse_args()
+
+    if args.metrics_file:
+        metrics.enable('triage_service')
+
+    pool = open_pool_from_environment(maxconn=args.parallelism + 2)
+    listen_connection = None
+    if args.listen or args.install_trigger:
+        listen_connection = open_connection(os.environ.get("POSTGRES_DB"), os.environ.get("POSTGRES_USER"),
+                                            os.environ.get("POSTGRES_PASSWORD"), os.environ.get("DATABASE_HOST"),
+                                            os.environ.get("DATABASE_PORT") or '5432')['connection']
+        listen_connection.autocommit = True
+        if args.install_trigger:
+            listen_connection.cursor().execute(get_notify_trigger_query())
+            print("Installed the {} trigger on rescues".format(default_channel))
+
+    retry = RetryPolicy(max_retries=args.max_retries, requests_per_second=args.requests_per_second)
+    service = TriageService(pool, args.model, args.start_date, parallelism=args.parallelism,
+                            batch_size=args.batch_size, batch_window=args.batch_window, max_queue=args.max_queue,
+                            poll_interval=args.poll_interval, lookback_days=args.lookback_days,
+                            listen_connection=listen_connection if args.listen else None,
+                            stats_file=args.stats_file, metrics_file=args.metrics_file, max_concurrency=args.max_concurrency, fused=args.fused,
+                            backend=args.backend, retry=retry,
+                            dead_letters=DeadLetterFile())
+    service.run(args.duration, args.stats_interval)
+    pool.close()
+    if listen_connection is not None:
+        listen_connection.close()
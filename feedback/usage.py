@@ -0,0 +1,179 @@
+import datetime
+import os
+import threading
+
+import pandas as pd
+
+default_usage_dir = "{}/../data/usage".format(os.path.dirname(__file__))
+
+# USD per million tokens: input, cached input, output
+MODEL_PRICES = {
+    'gpt-4o-mini': {'input': 0.15, 'cached_input': 0.075, 'output': 0.60},
+    'gpt-4o': {'input': 2.50, 'cached_input': 1.25, 'output': 10.00},
+}
+
+# The Batch API bills half the price
+BATCH_DISCOUNT = 0.5
+
+# Prompts shorter than this are never cached by the provider
+MIN_CACHEABLE_TOKENS = 1024
+
+def get_model_prices(model_name):
+    """Prices for a model, matching dated snapshots like gpt-4o-mini-2024-07-18
+        to their base model
+
+    Arguments:
+        model_name: String, name of the model
+
+    Returns: Dictionary of prices per million tokens, or None if unknown"""
+
+    model_name = model_name.replace("_self_reflection","")
+    matches = [m for m in MODEL_PRICES if model_name.startswith(m)]
+    if len(matches) == 0:
+        return None
+    return MODEL_PRICES[max(matches, key=len)]
+
+def get_usage_counts(usage):
+    """Read the token counts from a response's usage, whether it is an OpenAI
+        object or the dictionary found in Batch API output
+
+    Arguments:
+        usage: CompletionUsage object, dictionary or None
+
+    Returns: Dictionary with prompt_tokens, cached_tokens and completion_tokens"""
+
+    if usage is None:
+        return {'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, 'model_dump') else vars(usage)
+    details = usage.get('prompt_tokens_details') or {}
+    return {'prompt_tokens': usage.get('prompt_tokens') or 0,
+            'cached_tokens': details.get('cached_tokens') or 0,
+            'completion_tokens': usage.get('completion_tokens') or 0}
+
+def get_cost(model_name, prompt_tokens, cached_tokens, completion_tokens, batch=False):
+    """Cost of a number of tokens, in USD
+
+    Arguments:
+        model_name: String, name of the model
+        prompt_tokens: Integer, prompt tokens, including cached ones
+        cached_tokens: Integer, prompt tokens served from the provider's cache
+        completion_tokens: Integer, output tokens
+        batch: Boolean, whether they were billed at Batch API prices
+
+    Returns: Float, or NaN if the model's prices are unknown"""
+
+    prices = get_model_prices(model_name)
+    if prices is None:
+        return float('nan')
+    cost = ((prompt_tokens - cached_tokens)*prices['input'] + cached_tokens*prices['cached_input']
+            + completion_tokens*prices['output'])/1e6
+    return cost*BATCH_DISCOUNT if batch else cost
+
+class UsageTracker:
+    """Thread-safe per-task totals of prompt, cached and completion tokens,
+        and latency, for one run"""
+
+    def __init__(self, model_name, batch=False):
+        """Start an empty tracker
+
+        Arguments:
+            model_name: String, name of the model, used for prices
+            batch: Boolean, whether requests were billed at Batch API prices"""
+
+        self.model_name = model_name
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def record(self, task, usage, latency=None):
+        """Add one response's usage
+
+        Arguments:
+            task: String, task name or FUSED_TASK
+            usage: CompletionUsage object, dictionary or None
+            latency: Float or None, seconds the call took
+
+        Returns: Nothing"""
+
+        counts = get_usage_counts(usage)
+        with self.lock:
+            if task not in self.totals:
+                self.totals[task] = {'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0,
+                                     'completion_tokens': 0, 'timed_requests': 0, 'latency': 0.0}
+            totals = self.totals[task]
+            totals['requests'] += 1
+            for name in counts:
+                totals[name] += counts[name]
+            if latency is not None:
+                totals['timed_requests'] += 1
+                totals['latency'] += latency
+
+    def get_cost(self, prompt_tokens, cached_tokens, completion_tokens):
+        """Cost of a number of tokens, in USD
+
+        Returns: Float, or NaN if the model's prices are unknown"""
+
+        return get_cost(self.model_name, prompt_tokens, cached_tokens, completion_tokens, self.batch)
+
+    def report(self):
+        """Summarize the run per task, most expensive first, with a total row
+
+        Returns: DataFrame with requests, token counts, the share of prompt
+            tokens served from the provider's cache, cost and mean latency"""
+
+        columns = ['task', 'requests', 'prompt_tokens', 'cached_tokens', 'completion_tokens',
+                   'mean_prompt_tokens', 'cached_fraction', 'cost', 'cost_share', 'mean_latency']
+        with self.lock:
+            rows = [{'task': task, **totals} for task, totals in self.totals.items()]
+        if len(rows) == 0:
+            return pd.DataFrame(columns=columns)
+
+        report = pd.DataFrame(rows)
+        total = report.drop(columns=['task']).sum()
+        total['task'] = 'total'
+        report = pd.concat([report, total.to_frame().T], ignore_index=True)
+        counts = ['requests', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'timed_requests']
+        report[counts] = report[counts].astype(int)
+        report['latency'] = report['latency'].astype(float)
+
+        report['mean_prompt_tokens'] = report['prompt_tokens']/report['requests'].clip(lower=1)
+        report['cached_fraction'] = report['cached_tokens']/report['prompt_tokens'].clip(lower=1)
+        report['cost'] = [self.get_cost(p, c, o) for p, c, o in
+                          zip(report['prompt_tokens'], report['cached_tokens'], report['completion_tokens'])]
+        report['cost_share'] = report['cost']/max(report['cost'].iloc[-1], 1e-12)
+        report['mean_latency'] = [l/t if t > 0 else None for l, t in
+                                  zip(report['latency'], report['timed_requests'])]
+
+        report = pd.concat([report.iloc[:-1].sort_values('cost', ascending=False), report.iloc[-1:]])
+        return report[columns].reset_index(drop=True)
+
+    def print_report(self):
+        """Print the per-task report, and flag prompts too short to be cached
+
+        Returns: Nothing"""
+
+        report = self.report()
+        if len(report) == 0:
+            print("No usage recorded")
+            return
+        print("Token usage for {}{}:".format(self.model_name, " (batch)" if self.batch else ""))
+        print(report.to_string(index=False, float_format=lambda x: "{:.4f}".format(x)))
+        for task, mean_prompt_tokens in zip(report['task'][:-1], report['mean_prompt_tokens'][:-1]):
+            if mean_prompt_tokens < MIN_CACHEABLE_TOKENS:
+                print("Prompt for {} averages {:.0f} tokens, below the {} needed for prompt caching".format(
+                    task, mean_prompt_tokens, MIN_CACHEABLE_TOKENS))
+
+    def save_report(self, name, usage_dir=default_usage_dir):
+        """Write the per-task report to a timestamped CSV
+
+        Arguments:
+            name: String, name of the run (e.g. 'generate_feedback')
+            usage_dir: String, directory for usage reports
+
+        Returns: String, location of the report"""
+
+        os.makedirs(usage_dir, exist_ok=True)
+        file_name = "{}/{}_{}.csv".format(usage_dir, name, datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+        self.report().to_csv(file_name, index=False)
+        return file_name
@@ -0,0 +1,115 @@
+import datetime
+import json
+import os
+
+from feedback.fr_feedback import get_new_feedback
+
+default_watermark_path = "{}/../data/state/watermarks.json".format(os.path.dirname(__file__))
+
+def load_watermark(name, path=default_watermark_path):
+    """Load the high-water mark for an incremental job
+
+    Arguments:
+        name: String, name of the job (e.g. 'generate_feedback')
+        path: String, location of the watermark file
+
+    Returns: Dictionary with published_at (String or None), the latest
+        publish time processed, and processed_ids, mapping recent
+        rescue ids to their publish time"""
+
+    watermarks = {}
+    if os.path.exists(path):
+        watermarks = json.load(open(path))
+    return watermarks.get(name, {'published_at': None, 'processed_ids': {}})
+
+def save_watermark(name, watermark, path=default_watermark_path):
+    """Save the high-water mark for an incremental job
+
+    Arguments:
+        name: String, name of the job
+        watermark: Dictionary, from advance_watermark
+        path: String, location of the watermark file
+
+    Returns: Nothing
+
+    Side Effects: Atomically rewrites the watermark file"""
+
+    watermarks = {}
+    if os.path.exists(path):
+        watermarks = json.load(open(path))
+    watermarks[name] = watermark
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + ".tmp"
+    w = open(temporary_path, "w")
+    json.dump(watermarks, w, indent=2)
+    w.close()
+    os.replace(temporary_path, path)
+
+def get_lower_bound(watermark, start_date, lookback_days):
+    """Earliest publish time to scan
+        Volunteers comment after the rescue is published, so we look back
+        a few days before the watermark to pick up late comments
+
+    Arguments:
+        watermark: Dictionary, from load_watermark
+        start_date: String, used when there is no watermark yet
+        lookback_days: Float, how far before the watermark to look
+
+    Returns: String, of the form 2022-05-01 12:00:00"""
+
+    if watermark['published_at'] is None:
+        if start_date is None:
+            raise Exception("There is no watermark yet, so the first incremental run needs a --start_date")
+        return start_date
+    published_at = datetime.datetime.fromisoformat(watermark['published_at'])
+    return str(published_at - datetime.timedelta(days=lookback_days))
+
+def get_unprocessed_feedback(conn, watermark, start_date, end_date=None, lookback_days=7):
+    """Get the feedback that has not been processed, neither by a previous
+        incremental run nor in rescue_feedback
+
+    Arguments:
+        conn: Database PSQL connection
+        watermark: Dictionary, from load_watermark
+        start_date: String, used when there is no watermark yet
+        end_date: String or None, optional end date
+        lookback_days: Float, how far before the watermark to look for late comments
+
+    Returns: DataFrame, with organized info on all new feedback"""
+
+    since = get_lower_bound(watermark, start_date, lookback_days)
+    feedbacks = get_new_feedback(conn, since, end_date)
+    processed_ids = set(watermark['processed_ids'])
+    feedbacks = feedbacks[~feedbacks['id'].astype(str).isin(processed_ids)]
+    return feedbacks.reset_index(drop=True)
+
+def advance_watermark(watermark, feedbacks, lookback_days=7):
+    """Move the watermark past a set of processed feedback
+        Only pass the rescues whose labels were all written: the others are
+        picked up again while they are within the lookback window
+
+    Arguments:
+        watermark: Dictionary, from load_watermark
+        feedbacks: DataFrame, processed feedback with id and published_at
+        lookback_days: Float, processed ids are remembered for this long
+
+    Returns: Dictionary, the new watermark"""
+
+    processed_ids = dict(watermark['processed_ids'])
+    for rescue_id, published_at in zip(feedbacks['id'], feedbacks['published_at']):
+        processed_ids[str(rescue_id)] = str(published_at)
+
+    published_at = watermark['published_at']
+    if len(feedbacks) > 0:
+        latest = str(feedbacks['published_at'].max())
+        if published_at is None or datetime.datetime.fromisoformat(latest) > datetime.datetime.fromisoformat(published_at):
+            published_at = latest
+
+    # Ids published before the lookback window will never be scanned again
+    if published_at is not None:
+        cutoff = datetime.datetime.fromisoformat(published_at) - datetime.timedelta(days=lookback_days)
+        processed_ids = {i: t for i, t in processed_ids.items()
+                         if datetime.datetime.fromisoformat(t) > cutoff}
+
+    return {'published_at': published_at, 'processed_ids': processed_ids}
@@ -0,0 +1,85 @@
+from feedback.batch_collector import ResultAssembler
+from feedback.custom_id import encode_custom_id
+from feedback.fr_feedback import all_tasks, parse_feedback_output
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_lines', help='number of lines in the synthetic batch output', type=int, default=1000000)
+parser.add_argument('--seed', help='random seed', type=int, default=42)
+args = parser.parse_args()
+
+def get_output_line(custom_id, task):
+    content = json.dumps({task: random.choice(['True', 'False']), 'explanation': 'synthetic'})
+    return {'custom_id': custom_id,
+            'response': {'body': {'choices': [{'message': {'content': content}}]}}}
+
+def parse_underscore(lines):
+    """The previous collector: task_ownerid_ownertype custom_ids, split
+        three times, into a dictionary per owner"""
+
+    all_data = {}
+    for line in lines:
+        i = json.loads(line)
+        custom_id = i['custom_id']
+        which_task = "_".join(custom_id.split("_")[:-2])
+        owner_id = custom_id.split("_")[-2]
+        owner_type = custom_id.split("_")[-1]
+        if owner_id not in all_data:
+            all_data[owner_id] = {'owner_id': owner_id, 'owner_type': owner_type,
+                                  'created_at': None, 'updated_at': None}
+            for j in all_tasks:
+                all_data[owner_id][j] = False
+        feedback_info = json.loads(i['response']['body']['choices'][0]['message']['content'])
+        for label, value in parse_feedback_output(feedback_info, which_task, all_tasks).items():
+            all_data[owner_id][label] = value
+    return [tuple(row.values()) for row in all_data.values()]
+
+def parse_json_only(lines):
+    """Only the JSON decoding every collector needs: the line, then the
+        model's output inside it"""
+
+    rows = []
+    for line in lines:
+        i = json.loads(line)
+        rows.append(json.loads(i['response']['body']['choices'][0]['message']['content']))
+    return rows
+
+def parse_assembler(lines):
+    assembler = ResultAssembler()
+    for line in lines:
+        assembler.add_line(line)
+    return assembler.to_values(None)
+
+random.seed(args.seed)
+directory = tempfile.mkdtemp()
+underscore_file = "{}/underscore.jsonl".format(directory)
+encoded_file = "{}/encoded.jsonl".format(directory)
+
+with open(underscore_file, "w") as u, open(encoded_file, "w") as e:
+    for idx in range(args.num_lines):
+        task = all_tasks[idx % len(all_tasks)]
+        owner_id = idx // len(all_tasks)
+        line = get_output_line("{}_{}_Rescue".format(task, owner_id), task)
+        u.write(json.dumps(line) + "\n")
+        line['custom_id'] = encode_custom_id(task, owner_id, 'Rescue')
+        e.write(json.dumps(line) + "\n")
+
+# JSON decoding takes most of the time, so the collectors are compared
+# against it rather than against each other alone
+print("{} lines, {:.0f} MB".format(args.num_lines, os.path.getsize(encoded_file)/1e6))
+for name, parse, file_name in [('JSON only', parse_json_only, encoded_file),
+                               ('underscore split', parse_underscore, underscore_file),
+                               ('ResultAssembler', parse_assembler, encoded_file)]:
+    start = time.perf_counter()
+    rows = parse(open(file_name))
+    seconds = time.perf_counter() - start
+    print("{:>16}: {} rows in {:.2f}s ({:.0f} lines/s)".format(name, len(rows), seconds, args.num_lines/seconds))
+
+os.remove(underscore_file)
+os.remove(encoded_file)
+os.rmdir(directory)
@@ -0,0 +1,173 @@
+from feedback.database import open_connection
+from feedback.fr_feedback import get_feedback_by_date_query, get_feedback_by_date_instruction_query, \
+    get_predictions_by_date_query
+from feedback.query_plans import create_indexes, drop_indexes, explain_analyze, explain_analyze_prepared
+import argparse
+import datetime
+import os
+import statistics
+
+import pandas as pd
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--start_date', help='start of the window, of the form 2024-01-01', type=str, default='2024-01-01')
+parser.add_argument('--end_date', help='end of the window, of the form 2024-01-31', type=str, default='2024-01-31')
+parser.add_argument('--organization_id', help='organization for the predictions query', type=int, default=1)
+parser.add_argument('--repeats', help='runs of each query; the median is reported', type=int, default=5)
+parser.add_argument('--indexes', help='with: create the recommended indexes first; without: drop them first; as_is: leave them', type=str, default='as_is', choices=['with','without','as_is'])
+parser.add_argument('--output', help='csv file the timings are appended to', type=str,
+                    default="{}/../../results/benchmarks/feedback_queries.csv".format(os.path.dirname(__file__)))
+args = parser.parse_args()
+
+def get_legacy_queries(start_date, end_date, organization_id):
+    """The previous queries: values interpolated into the text, the date
+        filter inside the unnest joins, and instructions aggregated for
+        every location"""
+
+    feedback_by_date = f"""WITH all_ids as (
+    SELECT
+    ds.donor_ids[c1.ord] as donor_id,
+    c1.element AS donor_location_id,
+    ds.recipient_ids[c2.ord2] as recipient_id,
+    c2.element AS recipient_location_id,
+    ds.delivery_id,
+    ds.delivery_type
+    FROM
+    delivery_summaries ds,
+    LATERAL unnest(ds.donor_location_ids) WITH ORDINALITY AS c1(element, ord),
+    LATERAL unnest(ds.recipient_location_ids) WITH ORDINALITY AS c2(element, ord2)
+    WHERE
+    ds.published_at between '{start_date}' AND '{end_date}' and ds.volunteer_comment is not null
+    )
+    select d.id as donor_id,
+    dl.id as donor_location_id,
+    d.name || ' - ' || dl.name as donor_name,
+    r.id as recipient_id,
+    rl.id as recipient_location_id,
+    r.name || ' - ' || rl.name as recipient_name,
+    ai.delivery_id as id,
+    ai.delivery_type as owner_type,
+    rescue.volunteer_comment
+    from all_ids ai
+    inner join donors d on ai.donor_id=d.id
+    inner join donor_locations dl on ai.donor_location_id=dl.id
+    inner join recipients r on ai.recipient_id=r.id
+    inner join recipient_locations rl on ai.recipient_location_id=rl.id
+    inner join RESCUES rescue on ai.delivery_id=rescue.id;
+        """
+    feedback_by_date_instruction = f"""WITH all_ids AS (
+    SELECT
+    ds.donor_ids[c1.ord] AS donor_id,
+    c1.element AS donor_location_id,
+    ds.recipient_ids[c2.ord2] AS recipient_id,
+    c2.element AS recipient_location_id,
+    ds.delivery_id,
+    ds.delivery_type
+    FROM
+    delivery_summaries ds,
+    LATERAL unnest(ds.donor_location_ids) WITH ORDINALITY AS c1(element, ord),
+    LATERAL unnest(ds.recipient_location_ids) WITH ORDINALITY AS c2(element, ord2)
+    WHERE
+    ds.published_at BETWEEN '{start_date}' AND '{end_date}'
+    AND ds.volunteer_comment IS NOT NULL
+    ),
+    donor_instr AS (
+    SELECT
+    owner_id AS donor_location_id,
+    STRING_AGG(text, '; ') AS donor_instruction
+    FROM SPECIAL_INSTRUCTIONS
+    WHERE owner_type = 'DonorLocation'
+    GROUP BY owner_id
+    ),
+    recipient_instr AS (
+    SELECT
+    owner_id AS recipient_location_id,
+    STRING_AGG(text, '; ') AS recipient_instruction
+    FROM SPECIAL_INSTRUCTIONS
+    WHERE owner_type = 'RecipientLocation'
+    GROUP BY owner_id
+    )
+    SELECT
+    d.id AS donor_id,
+    dl.id AS donor_location_id,
+    d.name || ' - ' || dl.name AS donor_name,
+    r.id AS recipient_id,
+    rl.id AS recipient_location_id,
+    r.name || ' - ' || rl.name AS recipient_name,
+    ai.delivery_id AS id,
+    ai.delivery_type AS owner_type,
+    rescue.volunteer_comment,
+    di.donor_instruction,
+    ri.recipient_instruction
+    FROM all_ids ai
+    INNER JOIN donors d ON ai.donor_id = d.id
+    INNER JOIN donor_locations dl ON ai.donor_location_id = dl.id
+    INNER JOIN recipients r ON ai.recipient_id = r.id
+    INNER JOIN recipient_locations rl ON ai.recipient_location_id = rl.id
+    INNER JOIN RESCUES rescue ON ai.delivery_id = rescue.id
+    LEFT JOIN donor_instr di ON di.donor_location_id = ai.donor_location_id
+    LEFT JOIN recipient_instr ri ON ri.recipient_location_id = ai.recipient_location_id;
+        """
+    predictions_by_date = f"""SELECT rf.*
+    FROM rescue_feedback rf
+    JOIN rescues r ON rf.owner_id = r.id
+    JOIN organizations_donations od ON r.donation_id = od.donation_id
+    WHERE r.published_at BETWEEN '{start_date}' AND '{end_date}'
+    AND od.organization_id = {organization_id};
+        """
+    return {'feedback_by_date': feedback_by_date, 'feedback_by_date_instruction': feedback_by_date_instruction,
+            'predictions_by_date': predictions_by_date}
+
+def measure(run, repeats):
+    """Median timings of repeated EXPLAIN ANALYZE runs"""
+
+    results = [run() for _ in range(repeats)]
+    return {'planning_ms': statistics.median(r['planning_ms'] or 0 for r in results),
+            'execution_ms': statistics.median(r['execution_ms'] for r in results),
+            'rows': results[-1]['rows']}
+
+connection = open_connection(os.environ.get("POSTGRES_DB"), os.environ.get("POSTGRES_USER"),
+                             os.environ.get("POSTGRES_PASSWORD"), os.environ.get("DATABASE_HOST"),
+                             os.environ.get("DATABASE_PORT") or '5432')['connection']
+if args.indexes == 'with':
+    create_indexes(connection)
+elif args.indexes == 'without':
+    drop_indexes(connection)
+connection.autocommit = True
+cursor = connection.cursor()
+cursor.execute("ANALYZE")
+
+params = {'start_date': args.start_date, 'end_date': args.end_date}
+queries = {
+    'feedback_by_date': (get_feedback_by_date_query(), params),
+    'feedback_by_date_instruction': (get_feedback_by_date_instruction_query(), params),
+    'predictions_by_date': (get_predictions_by_date_query(), dict(params, organization_id=args.organization_id)),
+}
+legacy_queries = get_legacy_queries(args.start_date, args.end_date, args.organization_id)
+
+rows = []
+for name, (query, query_params) in queries.items():
+    variants = {
+        'legacy': lambda: explain_analyze(cursor, legacy_queries[name]),
+        'parameterized': lambda: explain_analyze(cursor, query, query_params),
+        'prepared': lambda: explain_analyze_prepared(cursor, 'bench_' + name, query, query_params),
+    }
+    for variant, run in variants.items():
+        rows.append({'query': name, 'variant': variant, **measure(run, args.repeats)})
+
+cursor.execute("DEALLOCATE ALL")
+cursor.execute("SELECT count(*) FROM delivery_summaries")
+num_summaries = cursor.fetchone()[0]
+connection.close()
+
+results = pd.DataFrame(rows)
+results.insert(0, 'run_at', str(datetime.datetime.now()))
+results['indexes'] = args.indexes
+results['start_date'] = args.start_date
+results['end_date'] = args.end_date
+results['delivery_summaries'] = num_summaries
+print(results[['query', 'variant', 'planning_ms', 'execution_ms', 'rows']].to_string(index=False))
+
+os.makedirs(os.path.dirname(args.output), exist_ok=True)
+results.to_csv(args.output, mode='a', header=not os.path.exists(args.output), index=False)
+print("Timings appended to {}".format(args.output))
@@ -0,0 +1,278 @@
+from feedback.async_engine import run_requests
+from feedback.backends import get_backend
+from feedback.batch_collector import parse_output_lines, stream_output_lines, write_results, refresh_shards
+from feedback.batch_manager import BatchManifest, write_shards, submit_shards
+from feedback.bulk_writer import write_rescue_feedback
+from feedback.database import open_pool_from_environment
+from feedback.fr_feedback import all_tasks, load_prompts, get_comments, get_request_content, parse_feedback_output, \
+    get_batch_feedback, write_batch_requests, get_feedback_by_date
+from feedback.synthetic_data import generate_synthetic_data, get_feedback_frame, is_scratch_database, \
+    SCRATCH_DATABASE_MARKERS
+import argparse
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', help='comma-separated numbers of comments to run each path with', type=str, default='1000,5000')
+parser.add_argument('--paths', help='comma-separated paths to run: generate_feedback, batch', type=str, default='generate_feedback,batch')
+parser.add_argument('--latency', help='mean seconds per fake chat completion', type=float, default=0.05)
+parser.add_argument('--batch_latency', help='seconds before a fake batch completes', type=float, default=1.0)
+parser.add_argument('--max_concurrency', help='maximum number of LLM calls in flight', type=int, default=64)
+parser.add_argument('--database', help='fetch from and write to the synthetic database in POSTGRES_DB (seed it with python -m feedback.synthetic_data); otherwise comments are generated in memory and writes go nowhere', action='store_true')
+parser.add_argument('--start_date', help='with --database, start of the window comments are fetched from', type=str, default='2023-01-01')
+parser.add_argument('--end_date', help='with --database, end of the window comments are fetched from', type=str, default='2024-12-31')
+parser.add_argument('--no_memory', help='skip the second, traced pass of each path that measures peak memory', action='store_true')
+parser.add_argument('--tolerance', help='relative drop in throughput or growth in memory flagged as a regression', type=float, default=0.2)
+parser.add_argument('--fail_on_regression', help='exit with status 1 if any stage regressed', action='store_true')
+parser.add_argument('--history', help='jsonl file every run is appended to', type=str,
+                    default="{}/../../results/benchmarks/pipeline_history.jsonl".format(os.path.dirname(__file__)))
+args = parser.parse_args()
+if args.database and not is_scratch_database(os.environ.get("POSTGRES_DB")):
+    parser.error("--database writes fake labels into rescue_feedback, so POSTGRES_DB must name a database seeded by feedback.synthetic_data "
+                 "(its name containing {}), not {}".format(' or '.join(SCRATCH_DATABASE_MARKERS), os.environ.get("POSTGRES_DB")))
+
+model_name = 'fake'
+
+class NullCursor:
+    """Cursor that accepts writes and discards them, so the client-side
+        cost of a write (formatting rows for COPY) is measured without a database"""
+
+    rowcount = 0
+
+    def execute(self, *args):
+        pass
+
+    def copy_expert(self, query, buffer):
+        self.rowcount = len(buffer.getvalue().splitlines())
+
+def get_commit():
+    """Short hash of the checked-out commit, marked if the tree has changes"""
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty.strip() else '')
+
+def start_server():
+    """Run the fake model server in its own process, so its work is not
+        counted against the pipeline's time and memory"""
+
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, '-m', 'feedback.fake_server', '--port', str(port),
+                                '--latency', str(args.latency), '--jitter', str(args.latency/2),
+                                '--batch_latency', str(args.batch_latency)],
+                               stdout=subprocess.DEVNULL,
+                               cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    base_url = 'http://localhost:{}/v1'.format(port)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base_url + '/batches/none')
+        except urllib.error.HTTPError:
+            return process, base_url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise Exception("Fake server did not start on port {}".format(port))
+
+def run_stage(records, path, size, stage, function, count_items):
+    """Time one stage, or trace its peak memory when records is a dictionary
+        of the timed pass's records; tracing slows stages down too much to
+        time them in the same pass
+
+    Arguments:
+        records: List the stage's record is appended to, or dictionary
+            mapping stage to the record its peak memory is added to
+        path: String, the pipeline path
+        size: Integer, number of comments
+        stage: String, name of the stage
+        function: Function running the stage
+        count_items: Function of the stage's result, the number of items it processed
+
+    Returns: The stage's result"""
+
+    if isinstance(records, dict):
+        tracemalloc.start()
+        result = function()
+        records[stage]['peak_mb'] = tracemalloc.get_traced_memory()[1]/1e6
+        tracemalloc.stop()
+        print("  {:<10} peak {:.1f} MB".format(stage, records[stage]['peak_mb']))
+        return result
+
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    items = count_items(result)
+    records.append({'path': path, 'size': size, 'stage': stage, 'items': items, 'seconds': seconds,
+                    'items_per_second': items/max(seconds, 1e-9), 'peak_mb': None})
+    print("  {:<10} {:>8} items in {:7.2f}s ({:9.0f}/s)".format(stage, items, seconds, items/max(seconds, 1e-9)))
+    return result
+
+def get_feedbacks(size):
+    """Comments shaped like get_feedback_by_date's output"""
+
+    if args.database:
+        return get_feedback_by_date(pool, args.start_date, args.end_date).head(size).reset_index(drop=True)
+    # About one rescue in three has a comment, and a few have several locations
+    feedbacks = get_feedback_frame(generate_synthetic_data(num_rescues=size*4, seed=size))
+    return feedbacks.head(size).reset_index(drop=True)
+
+def run_generate_feedback(records, size):
+    """The stages of generate_feedback.py"""
+
+    path = 'generate_feedback'
+    feedbacks = run_stage(records, path, size, 'fetch', lambda: get_feedbacks(size), len)
+
+    def build():
+        requests = []
+        for i, comment in get_comments(feedbacks).items():
+            for task in all_tasks:
+                requests.append({'key': (i, task), 'task': task, 'content': get_request_content(prompts[task], comment)})
+        return requests
+    requests = run_stage(records, path, size, 'build', build, len)
+
+    client = backend.get_async_client()
+    results = run_stage(records, path, size, 'llm', lambda: run_requests(client, requests, model_name,
+                                                                         max_concurrency=args.max_concurrency,
+                                                                         close_client=True)[0], len)
+
+    def parse():
+        annotated_feedback = feedbacks[['id', 'owner_type']].rename(columns={'id': 'owner_id'})
+        for task in all_tasks:
+            annotated_feedback[task] = None
+        for (i, task), feedback_info in results.items():
+            for label, value in parse_feedback_output(feedback_info, task, all_tasks).items():
+                annotated_feedback.at[i, label] = value
+        current_time = datetime.datetime.now()
+        return [tuple(row)+(current_time, current_time) for row in annotated_feedback.to_numpy()]
+    values = run_stage(records, path, size, 'parse', parse, len)
+
+    columns = ['owner_id', 'owner_type'] + all_tasks + ['created_at', 'updated_at']
+    run_stage(records, path, size, 'write',
+              lambda: write_rescue_feedback(pool if args.database else NullCursor(), values, columns,
+                                            on_conflict='update')['rows_staged'], lambda rows: rows)
+
+def run_batch(records, size):
+    """The stages of batch_make_requests.py and batch_process_requests.py"""
+
+    path = 'batch'
+    directory = tempfile.mkdtemp()
+    manifest = BatchManifest("{}/manifest.json".format(directory))
+    feedbacks = run_stage(records, path, size, 'fetch', lambda: get_feedbacks(size), len)
+
+    request_file = "{}/requests.jsonl".format(directory)
+    run_stage(records, path, size, 'build', lambda: write_batch_requests(
+        get_batch_feedback(feedbacks, prompts, all_tasks, model_name), request_file), lambda n: n)
+
+    client = backend.get_batch_client()
+    def round_trip():
+        shards = write_shards((json.loads(line) for line in open(request_file)), manifest,
+                              shard_dir="{}/shards".format(directory))
+        submit_shards(client, manifest)
+        ready = []
+        while len(ready) < len(shards):
+            time.sleep(0.2)
+            ready += refresh_shards(client, manifest)
+        return ready
+    ready = run_stage(records, path, size, 'llm', round_trip,
+                      lambda ready: sum(manifest.shards[name]['num_requests'] for name in ready))
+
+    def parse():
+        return [parse_output_lines(stream_output_lines(client, manifest.shards[name]['output_file_id']))
+                for name in ready]
+    assemblers = run_stage(records, path, size, 'parse', parse, lambda assemblers: sum(map(len, assemblers)))
+
+    run_stage(records, path, size, 'write',
+              lambda: sum(write_results(pool if args.database else NullCursor(), assembler,
+                                        on_conflict='update')['rows_staged'] for assembler in assemblers),
+              lambda rows: rows)
+
+def find_regressions(records, history):
+    """Stages slower or larger than in the latest run of another commit
+        with the same settings
+
+    Arguments:
+        records: List of this run's records
+        history: List of earlier records
+
+    Returns: List of Strings describing each regression"""
+
+    regressions = []
+    for record in records:
+        key = [record[k] for k in ['path', 'size', 'stage', 'database', 'latency', 'max_concurrency']]
+        previous = [r for r in history if r['commit'] != record['commit']
+                    and [r.get(k) for k in ['path', 'size', 'stage', 'database', 'latency', 'max_concurrency']] == key]
+        if len(previous) == 0:
+            continue
+        previous = previous[-1]
+        name = "{} {} at {}".format(record['path'], record['stage'], record['size'])
+        if record['items_per_second'] < (1 - args.tolerance)*previous['items_per_second']:
+            regressions.append("{}: {:.0f}/s, down from {:.0f}/s at {}".format(
+                name, record['items_per_second'], previous['items_per_second'], previous['commit']))
+        # Differences under a megabyte are noise
+        if record['peak_mb'] is not None and previous.get('peak_mb') is not None \
+                and record['peak_mb'] > (1 + args.tolerance)*previous['peak_mb'] + 1:
+            regressions.append("{}: peak {:.1f} MB, up from {:.1f} MB at {}".format(
+                name, record['peak_mb'], previous['peak_mb'], previous['commit']))
+    return regressions
+
+server, base_url = start_server()
+backend = get_backend(model_name, 'fake', base_url=base_url)
+pool = open_pool_from_environment() if args.database else None
+prompts = load_prompts(all_tasks)
+paths = {'generate_feedback': run_generate_feedback, 'batch': run_batch}
+
+records = []
+try:
+    for size in [int(s) for s in args.sizes.split(',')]:
+        for path in args.paths.split(','):
+            print("{} with {} comments".format(path, size))
+            timed = []
+            paths[path](timed, size)
+            if not args.no_memory:
+                print("{} with {} comments, tracing memory".format(path, size))
+                paths[path]({record['stage']: record for record in timed}, size)
+            records += timed
+finally:
+    server.kill()
+    if pool is not None:
+        pool.close()
+
+commit = get_commit()
+run_at = str(datetime.datetime.now())
+for record in records:
+    record.update({'commit': commit, 'run_at': run_at, 'database': args.database, 'latency': args.latency,
+                   'max_concurrency': args.max_concurrency})
+
+history = []
+if os.path.exists(args.history):
+    history = [json.loads(line) for line in open(args.history) if line.strip()]
+regressions = find_regressions(records, history)
+
+os.makedirs(os.path.dirname(args.history), exist_ok=True)
+with open(args.history, "a") as w:
+    for record in records:
+        w.write(json.dumps(record))
+        w.write("\n")
+print("Results for {} appended to {}".format(commit, args.history))
+
+if len(regressions) > 0:
+    print("Regressions (tolerance {:.0%}):".format(args.tolerance))
+    for regression in regressions:
+        print("  " + regression)
+    if args.fail_on_regression:
+        sys.exit(1)
+else:
+    print("No regressions")
@@ -0,0 +1,77 @@
+from feedback.fr_feedback import all_tasks, load_prompts, get_batch_feedback, write_batch_requests
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_rows', help='number of synthetic comments', type=int, default=100000)
+parser.add_argument('--seed', help='random seed', type=int, default=42)
+args = parser.parse_args()
+
+model_name = 'gpt-4o-mini'
+
+def get_synthetic_feedback(num_rows, seed):
+    """Comments shaped like get_feedback_by_date's output"""
+
+    rng = np.random.default_rng(seed)
+    feedbacks = pd.DataFrame({
+        'id': np.arange(num_rows),
+        'owner_type': 'Rescue',
+        'donor_name': ['Donor {}'.format(i) for i in rng.integers(0, 500, num_rows)],
+        'recipient_name': ['Recipient {}'.format(i) for i in rng.integers(0, 500, num_rows)],
+        'volunteer_comment': ['Comment number {} about the pickup'.format(i) for i in range(num_rows)],
+    })
+    return feedbacks
+
+def get_batch_feedback_loc(feedbacks, prompts, tasks, model_name):
+    """The previous implementation: a .loc lookup per cell, accumulated in a list"""
+
+    all_data = []
+    for i in range(len(feedbacks)):
+        comment = (
+            f'For this rescue, the donor is {feedbacks.loc[i, "donor_name"]};'
+            f' the recipient is {feedbacks.loc[i, "recipient_name"]}.'
+            f' Comment: {feedbacks.loc[i, "volunteer_comment"]}'
+        )
+        id = feedbacks.loc[i,"id"]
+        owner_type = feedbacks.loc[i,'owner_type']
+        for task in tasks:
+            all_data.append({'custom_id': "{}_{}_{}".format(task,id,owner_type),
+            'method': 'POST',
+            'url': "/v1/chat/completions",
+            'body': {
+                'model': model_name,
+                'messages': [{"role": "user", "content": prompts[task] + comment}],
+                'response_format':{"type": "json_object"},
+            }})
+    return all_data
+
+feedbacks = get_synthetic_feedback(args.num_rows, args.seed)
+prompts = load_prompts(all_tasks)
+directory = tempfile.mkdtemp()
+file_name = "{}/requests.jsonl".format(directory)
+
+start = time.perf_counter()
+w = open(file_name, "w")
+for request in get_batch_feedback_loc(feedbacks, prompts, all_tasks, model_name):
+    w.write(json.dumps(request))
+    w.write("\n")
+w.close()
+before = time.perf_counter() - start
+
+start = time.perf_counter()
+write_batch_requests(get_batch_feedback(feedbacks, prompts, all_tasks, model_name), file_name)
+after = time.perf_counter() - start
+
+print("{} rows, {} requests, {:.0f} MB".format(len(feedbacks), len(feedbacks)*len(all_tasks),
+                                               os.path.getsize(file_name)/1e6))
+print("  before (.loc, list): {:.2f}s ({:.0f} rows/s)".format(before, len(feedbacks)/before))
+print("   after (vectorized): {:.2f}s ({:.0f} rows/s)".format(after, len(feedbacks)/after))
+
+os.remove(file_name)
+os.rmdir(directory)
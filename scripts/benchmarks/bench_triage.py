@@ -0,0 +1,244 @@
+from feedback.backends import get_backend
+from feedback.database import open_pool_from_environment, open_connection
+from feedback.synthetic_data import generate_synthetic_data, get_feedback_frame, is_scratch_database, \
+    SCRATCH_DATABASE_MARKERS
+from feedback.triage_service import TriageService, get_notify_trigger_query, default_channel
+import argparse
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import pandas as pd
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rate', help='new comments per second', type=float, default=20)
+parser.add_argument('--duration', help='seconds new comments arrive for', type=float, default=30)
+parser.add_argument('--latency', help='mean seconds per fake chat completion', type=float, default=0.2)
+parser.add_argument('--parallelism', help='micro-batches classified at once', type=int, default=4)
+parser.add_argument('--max_concurrency', help='maximum number of LLM calls in flight per micro-batch', type=int, default=16)
+parser.add_argument('--batch_size', help='most comments per micro-batch', type=int, default=50)
+parser.add_argument('--batch_window', help='seconds a micro-batch waits to fill up', type=float, default=1.0)
+parser.add_argument('--max_queue', help='comments waiting at most before polling pauses', type=int, default=1000)
+parser.add_argument('--poll_interval', help='seconds between polls for new comments', type=float, default=0.5)
+parser.add_argument('--fused', help='classify all tasks with one combined prompt', action='store_true')
+parser.add_argument('--database', help='insert the comments into, and triage them from, the synthetic database in POSTGRES_DB (seed it with python -m feedback.synthetic_data); otherwise comments arrive in memory and writes go nowhere', action='store_true')
+parser.add_argument('--listen', help='with --database, install the notify trigger and wake up on its notifications', action='store_true')
+parser.add_argument('--history', help='jsonl file every run is appended to', type=str,
+                    default="{}/../../results/benchmarks/triage_history.jsonl".format(os.path.dirname(__file__)))
+args = parser.parse_args()
+if args.database and not is_scratch_database(os.environ.get("POSTGRES_DB")):
+    parser.error("--database inserts fake rescues and writes fake labels, so POSTGRES_DB must name a database seeded by feedback.synthetic_data "
+                 "(its name containing {}), not {}".format(' or '.join(SCRATCH_DATABASE_MARKERS), os.environ.get("POSTGRES_DB")))
+
+model_name = 'fake'
+
+class NullCursor:
+    """Cursor that accepts writes and discards them, so the client-side
+        cost of a write (formatting rows for COPY) is measured without a database"""
+
+    rowcount = 0
+
+    def execute(self, *args):
+        pass
+
+    def copy_expert(self, query, buffer):
+        self.rowcount = len(buffer.getvalue().splitlines())
+
+class MemoryTriageService(TriageService):
+    """TriageService whose new comments are held in memory until written,
+        standing in for the rescues missing from rescue_feedback"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(NullCursor(), *args, **kwargs)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+    def add(self, feedbacks):
+        with self.pending_lock:
+            for row in feedbacks.to_dict('records'):
+                self.pending[row['id']] = row
+
+    def fetch(self):
+        with self.pending_lock:
+            feedbacks = pd.DataFrame(list(self.pending.values()), columns=list(templates.columns))
+        with self.lock:
+            in_flight = set(self.in_flight)
+        return feedbacks[~feedbacks['id'].isin(in_flight)]
+
+    def write(self, annotated_feedback):
+        statistics = super().write(annotated_feedback)
+        with self.pending_lock:
+            for rescue_id in annotated_feedback['owner_id']:
+                self.pending.pop(rescue_id, None)
+        return statistics
+
+def get_commit():
+    """Short hash of the checked-out commit, marked if the tree has changes"""
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty.strip() else '')
+
+def start_server():
+    """Run the fake model server in its own process, so its work is not
+        counted against the service's time"""
+
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, '-m', 'feedback.fake_server', '--port', str(port),
+                                '--latency', str(args.latency), '--jitter', str(args.latency/2)],
+                               stdout=subprocess.DEVNULL,
+                               cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    base_url = 'http://localhost:{}/v1'.format(port)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base_url + '/batches/none')
+        except urllib.error.HTTPError:
+            return process, base_url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise Exception("Fake server did not start on port {}".format(port))
+
+def get_templates():
+    """Comments the arriving rescues are copied from
+
+    Returns: DataFrame shaped like get_new_feedback's output, and, with
+        --database, the delivery_summaries row of each comment"""
+
+    if not args.database:
+        feedbacks = get_feedback_frame(generate_synthetic_data(num_rescues=4000, seed=0))
+        feedbacks['published_at'] = None
+        return feedbacks, None
+    with pool.cursor() as cursor:
+        cursor.execute("""SELECT r.volunteer_comment, ds.donor_ids, ds.donor_location_ids, ds.recipient_ids,
+            ds.recipient_location_ids FROM rescues r
+            INNER JOIN delivery_summaries ds ON ds.delivery_id = r.id AND ds.delivery_type = 'Rescue'
+            WHERE r.volunteer_comment IS NOT NULL AND r.volunteer_comment <> '' LIMIT 1000""")
+        rows = cursor.fetchall()
+    if len(rows) == 0:
+        raise Exception("No rescues with comments to copy; seed the database with python -m feedback.synthetic_data")
+    return pd.DataFrame(rows, columns=['volunteer_comment', 'donor_ids', 'donor_location_ids', 'recipient_ids',
+                                       'recipient_location_ids']), rows
+
+def insert_rescues(rows, first_id, published_at):
+    """Publish copies of template rescues in the database
+
+    Arguments:
+        rows: List of template rows from get_templates
+        first_id: Integer, id of the first new rescue
+        published_at: datetime, when the rescues are published
+
+    Returns: Nothing"""
+
+    with pool.cursor() as cursor:
+        for i, (comment, donor_ids, donor_location_ids, recipient_ids, recipient_location_ids) in enumerate(rows):
+            rescue_id = first_id + i
+            cursor.execute("INSERT INTO delivery_summaries VALUES (%s, 'Rescue', %s, %s, %s, %s, %s, %s)",
+                           (rescue_id, published_at, comment, donor_ids, donor_location_ids, recipient_ids,
+                            recipient_location_ids))
+            cursor.execute("INSERT INTO rescues VALUES (%s, %s, %s, %s)", (rescue_id, rescue_id, published_at, comment))
+
+def produce(service, first_id):
+    """Publish args.rate comments a second for args.duration seconds
+
+    Arguments:
+        service: TriageService
+        first_id: Integer, id of the first new rescue
+
+    Returns: Nothing"""
+
+    started = time.monotonic()
+    produced = 0
+    while not service.stop.is_set():
+        elapsed = time.monotonic() - started
+        if elapsed >= args.duration:
+            break
+        due = int(elapsed*args.rate) - produced
+        if due > 0:
+            rows = [templates_rows[(produced + i) % len(templates_rows)] for i in range(due)]
+            published_at = datetime.datetime.now()
+            if args.database:
+                insert_rescues(rows, first_id + produced, published_at)
+            else:
+                feedbacks = pd.DataFrame(rows)
+                feedbacks['id'] = range(first_id + produced, first_id + produced + due)
+                feedbacks['published_at'] = published_at
+                service.add(feedbacks)
+            produced += due
+        time.sleep(0.05)
+    counts['produced'] = produced
+
+server, base_url = start_server()
+backend = get_backend(model_name, 'fake', base_url=base_url)
+pool = open_pool_from_environment(maxconn=args.parallelism + 4) if args.database else None
+templates, templates_rows = get_templates()
+if templates_rows is None:
+    templates_rows = templates.drop(columns=['id', 'published_at']).to_dict('records')
+watermark_path = "{}/watermarks.json".format(tempfile.mkdtemp())
+counts = {}
+
+options = dict(parallelism=args.parallelism, batch_size=args.batch_size, batch_window=args.batch_window,
+               max_queue=args.max_queue, poll_interval=args.poll_interval, watermark_path=watermark_path,
+               max_concurrency=args.max_concurrency, fused=args.fused, backend=backend)
+listen_connection = None
+if args.database:
+    with pool.cursor() as cursor:
+        cursor.execute("SELECT coalesce(max(id), 0) + 1 FROM rescues")
+        first_id = cursor.fetchone()[0]
+    if args.listen:
+        listen_connection = open_connection(os.environ.get("POSTGRES_DB"), os.environ.get("POSTGRES_USER"),
+                                            os.environ.get("POSTGRES_PASSWORD"), os.environ.get("DATABASE_HOST"),
+                                            os.environ.get("DATABASE_PORT") or '5432')['connection']
+        listen_connection.autocommit = True
+        listen_connection.cursor().execute(get_notify_trigger_query(default_channel))
+    # Only the rescues published during the run are triaged
+    service = TriageService(pool, model_name, str(datetime.datetime.now()), listen_connection=listen_connection,
+                            **options)
+else:
+    first_id = 1
+    service = MemoryTriageService(model_name, str(datetime.datetime.now()), **options)
+
+print("Publishing {:.0f} comments a second for {:.0f}s, {} parallel micro-batches of up to {}".format(
+    args.rate, args.duration, args.parallelism, args.batch_size))
+producer = threading.Thread(target=produce, args=(service, first_id))
+producer.start()
+try:
+    # Keep polling a little past the last comment, so it is picked up
+    summary = service.run(duration=args.duration + 2*args.poll_interval, stats_interval=10)
+finally:
+    producer.join()
+    server.kill()
+    if args.database:
+        # Remove the published rescues, so runs can be repeated on the same seed
+        with pool.cursor() as cursor:
+            cursor.execute("DELETE FROM rescue_feedback WHERE owner_id >= %s", (first_id,))
+            cursor.execute("DELETE FROM delivery_summaries WHERE delivery_id >= %s", (first_id,))
+            cursor.execute("DELETE FROM rescues WHERE id >= %s", (first_id,))
+        pool.close()
+    if listen_connection is not None:
+        listen_connection.close()
+
+record = dict(summary, produced=counts.get('produced'), commit=get_commit(), run_at=str(datetime.datetime.now()),
+              database=args.database, listen=args.listen, rate=args.rate, duration=args.duration,
+              latency=args.latency, parallelism=args.parallelism, batch_size=args.batch_size,
+              batch_window=args.batch_window, fused=args.fused)
+print("{} of {} published comments written".format(record['written'], record['produced']))
+
+os.makedirs(os.path.dirname(args.history), exist_ok=True)
+with open(args.history, "a") as w:
+    w.write(json.dumps(record))
+    w.write("\n")
+print("Results for {} appended to {}".format(record['commit'], args.history))
@@ -0,0 +1,20 @@
+import openai
+import pytest
+
+from feedback.fake_server import start_fake_server
+
+@pytest.fixture
+def fake_server():
+    """The fake OpenAI server on a free port, answering at once"""
+
+    server = start_fake_server(port=0, latency=0, jitter=0, batch_latency=0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def fake_client(fake_server):
+    """OpenAI client of the fake server, without the SDK's own retries"""
+
+    return openai.OpenAI(base_url="http://localhost:{}/v1".format(fake_server.server_port),
+                         api_key="fake", max_retries=0)
@@ -0,0 +1,98 @@
+import json
+import time
+
+import pandas as pd
+
+from feedback import batch_collector
+from feedback.batch_collector import get_outstanding_shards, ingest_shard, refresh_shards
+from feedback.batch_manager import MAX_ATTEMPTS, BatchManifest, submit_shards, write_shards
+from feedback.custom_id import encode_custom_id
+from feedback.fr_feedback import all_tasks
+
+def get_feedbacks(ids, published_at):
+    return pd.DataFrame({'id': ids, 'owner_type': 'Rescue', 'published_at': pd.to_datetime(published_at)})
+
+def get_batch_requests(ids):
+    return [{'custom_id': encode_custom_id(task, i, 'Rescue'), 'method': 'POST', 'url': "/v1/chat/completions",
+             'body': {'model': 'fake', 'messages': [{'role': 'user', 'content': "{} {}".format(task, i)}]}}
+            for i in ids for task in all_tasks]
+
+def wait_for_shards(client, manifest, timeout=10):
+    """Names of the shards ready to ingest, once the fake server has finished some"""
+    start = time.time()
+    while time.time() - start < timeout:
+        ready = refresh_shards(client, manifest)
+        if len(ready) > 0:
+            return ready
+        time.sleep(0.01)
+    raise TimeoutError("The fake server finished no batch")
+
+def wait_for_status(client, manifest, name, status, timeout=10):
+    """Refresh the shards until a shard reaches a status"""
+    start = time.time()
+    while time.time() - start < timeout:
+        refresh_shards(client, manifest)
+        if manifest.shards[name]['status'] == status:
+            return
+        time.sleep(0.01)
+    raise TimeoutError("Shard {} is still {}".format(name, manifest.shards[name]['status']))
+
+def test_batch_watermark_only_passes_written_rescues(fake_server, fake_client, tmp_path, monkeypatch):
+    written_rows = []
+    def write_rescue_feedback(pool, values, columns, on_conflict='ignore'):
+        written_rows.extend(values)
+        return {'rows_written': len(values)}
+    monkeypatch.setattr(batch_collector, 'write_rescue_feedback', write_rescue_feedback)
+
+    manifest = BatchManifest(str(tmp_path/"manifest.json"))
+    manifest.add_pending_rescues(get_feedbacks([1, 2], ['2024-01-01', '2024-01-02']))
+    # Only rescue 1 goes to the Batch API; rescue 2 is still waiting for its labels
+    write_shards(iter(get_batch_requests([1])), manifest, shard_dir=str(tmp_path))
+    assert manifest.take_written_rescues(all_tasks) == {}, "nothing is written at submission"
+    submit_shards(fake_client, manifest)
+
+    ready = wait_for_shards(fake_client, manifest)
+    ingest_shard(fake_client, manifest, None, ready[0])
+
+    assert {row[0] for row in written_rows} == {'1'}
+    assert manifest.take_written_rescues(all_tasks) == {'1': '2024-01-01 00:00:00'}
+    assert list(manifest.pending_rescues) == ['2']
+    assert json.load(open(manifest.path))['pending_rescues']['2']['written'] == []
+
+def test_failed_batches_are_resubmitted_up_to_max_attempts(fake_server, fake_client, tmp_path):
+    fake_server.model.batch_failure_rate = 1.0
+    manifest = BatchManifest(str(tmp_path/"manifest.json"))
+    name, = write_shards(iter(get_batch_requests([1])), manifest, shard_dir=str(tmp_path))
+
+    for attempt in range(1, MAX_ATTEMPTS):
+        submit_shards(fake_client, manifest)
+        wait_for_status(fake_client, manifest, name, 'written')
+        assert manifest.shards[name]['attempts'] == attempt + 1
+        assert manifest.shards[name]['batch_id'] is None
+
+    submit_shards(fake_client, manifest)
+    wait_for_status(fake_client, manifest, name, 'abandoned')
+    assert get_outstanding_shards(manifest) == []
+    assert manifest.in_flight == {}, "an abandoned shard's requests may be sent again"
+    # Later runs neither resubmit nor check it
+    assert submit_shards(fake_client, manifest) == {}
+    assert refresh_shards(fake_client, manifest) == []
+    assert manifest.shards[name]['status'] == 'abandoned'
+
+def test_error_file_requests_are_requeued(fake_server, fake_client, tmp_path, monkeypatch):
+    manifest = BatchManifest(str(tmp_path/"manifest.json"))
+    requests = get_batch_requests([1, 2])
+    name, = write_shards(iter(requests), manifest, shard_dir=str(tmp_path))
+    submit_shards(fake_client, manifest)
+    wait_for_shards(fake_client, manifest)
+
+    failed = {requests[0]['custom_id']}
+    monkeypatch.setattr(batch_collector, 'get_error_custom_ids', lambda client, file_id: failed)
+    monkeypatch.setattr(batch_collector, 'write_rescue_feedback',
+                        lambda pool, values, columns, on_conflict='ignore': {'rows_written': len(values)})
+    ingest_shard(fake_client, manifest, None, name)
+
+    assert manifest.shards[name]['status'] == 'written'
+    assert manifest.shards[name]['attempts'] == 2
+    assert list(manifest.in_flight) == list(failed)
+    assert [json.loads(line)['custom_id'] for line in open(manifest.shards[name]['path'])] == list(failed)
@@ -0,0 +1,60 @@
+import pandas as pd
+
+from feedback.batch_collector import ResultAssembler
+from feedback.batch_manager import BatchManifest
+from feedback.dedup import cluster_comments, deduplicate, fan_out_labels, get_members, normalize_comment
+from feedback.fr_feedback import all_tasks
+
+def get_feedbacks(comments):
+    return pd.DataFrame({'id': [100 + i for i in range(len(comments))], 'owner_type': 'Rescue',
+                         'volunteer_comment': comments}, index=[10*i for i in range(len(comments))])
+
+def test_normalize_keeps_every_script_and_emoji():
+    assert normalize_comment("  Great, thanks!! Picked up 12 boxes.") == "great thanks picked up 0 boxes"
+    assert normalize_comment("Спасибо, всё хорошо!") == "спасибо всё хорошо"
+    assert normalize_comment("👍") != normalize_comment("👎")
+
+def test_identical_comments_are_grouped():
+    clusters = cluster_comments(pd.Series(["Great!", "great", "👍", "👎", "Спасибо", "спасибо!"]), threshold=1)
+    assert clusters.tolist() == [0, 0, 2, 3, 4, 4]
+
+def test_empty_comments_are_never_grouped():
+    clusters = cluster_comments(pd.Series(["...", "!!", None, "ok", "ok"]), threshold=0.5)
+    assert clusters.tolist() == [0, 1, 2, 3, 3]
+
+def test_near_duplicates_are_grouped_below_one():
+    base = "the recipient was closed when i arrived so i left the food with the neighbour next door"
+    comments = pd.Series([base, base + " again", "the donor had nothing ready for pickup today at all"])
+    assert cluster_comments(comments, threshold=1).tolist() == [0, 1, 2]
+    assert cluster_comments(comments, threshold=0.5).tolist() == [0, 0, 2]
+
+def test_fan_out_labels_copies_representative_labels():
+    feedbacks = get_feedbacks(["Great!", "great", "Nobody answered"])
+    representatives, clusters = deduplicate(feedbacks, threshold=1)
+    assert list(representatives['id']) == [100, 102]
+    annotated = pd.DataFrame({'owner_id': [100, 102], **{task: [True, False] for task in all_tasks}})
+    fanned_out = fan_out_labels(annotated, feedbacks, clusters)
+    assert list(fanned_out['owner_id']) == [100, 101, 102]
+    assert fanned_out[all_tasks].to_numpy().tolist() == [[True]*len(all_tasks), [True]*len(all_tasks),
+                                                         [False]*len(all_tasks)]
+
+def test_batch_fan_out_waits_for_every_task(tmp_path):
+    feedbacks = get_feedbacks(["Great!", "great"])
+    manifest = BatchManifest(str(tmp_path/"manifest.json"))
+    manifest.add_members(get_members(feedbacks, deduplicate(feedbacks, threshold=1)[1]))
+    assert manifest.members == {'100:Rescue': [['101', 'Rescue']]}
+
+    # The representative's tasks arrive in two writes, e.g. two shards
+    first, rest = all_tasks[:1], all_tasks[1:]
+    assembler = ResultAssembler()
+    for task in first:
+        assembler.add(task, '100', 'Rescue', {task: True})
+    assert assembler.fan_out(manifest) == []
+    assert '101' not in assembler.get_written_tasks()
+
+    assembler = ResultAssembler()
+    for task in rest:
+        assembler.add(task, '100', 'Rescue', {task: False})
+    assert assembler.fan_out(manifest) == ['100:Rescue']
+    member_labels = dict(zip(all_tasks, assembler.to_values(None)[1][4:]))
+    assert member_labels == {task: task in first for task in all_tasks}
@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import pytest
+
+from feedback.async_engine import RateLimiter, call_model, run_requests_async
+from feedback.retry import CircuitOpenError, RetryPolicy
+
+RESET_TIMEOUT = 0.05
+
+class ServerError(Exception):
+    status_code = 503
+
+def fail():
+    raise ServerError("injected")
+
+def succeed():
+    return "ok"
+
+def get_policy(**kwargs):
+    return RetryPolicy(max_retries=3, base_delay=0, failure_threshold=1, reset_timeout=RESET_TIMEOUT, **kwargs)
+
+def test_failed_trial_reopens_breaker_until_next_timeout():
+    policy = get_policy()
+    with pytest.raises(ServerError):
+        policy.call(fail)
+    with pytest.raises(CircuitOpenError):
+        policy.call(succeed)
+
+    time.sleep(RESET_TIMEOUT)
+    calls = []
+    def fail_trial():
+        calls.append(1)
+        fail()
+    # The trial is not retried through the breaker it just reopened
+    with pytest.raises(ServerError):
+        policy.call(fail_trial)
+    assert len(calls) == 1
+    with pytest.raises(CircuitOpenError):
+        policy.call(succeed)
+
+    time.sleep(RESET_TIMEOUT)
+    assert policy.call(succeed) == "ok"
+    assert policy.breaker.opened_at is None
+    assert policy.call(succeed) == "ok"
+
+def test_failed_async_trial_reopens_breaker_until_next_timeout():
+    policy = get_policy()
+
+    async def fail_async():
+        fail()
+
+    async def succeed_async():
+        return "ok"
+
+    async def run():
+        with pytest.raises(ServerError):
+            await policy.call_async(fail_async)
+        await asyncio.sleep(RESET_TIMEOUT)
+        with pytest.raises(ServerError):
+            await policy.call_async(fail_async)
+        with pytest.raises(CircuitOpenError):
+            await policy.call_async(succeed_async)
+        await asyncio.sleep(RESET_TIMEOUT)
+        return await policy.call_async(succeed_async)
+
+    assert asyncio.run(run()) == "ok"
+    assert policy.breaker.opened_at is None
+
+def test_cancelled_trial_frees_the_trial_slot():
+    policy = get_policy()
+    with pytest.raises(ServerError):
+        policy.call(fail)
+    time.sleep(RESET_TIMEOUT)
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    async def run():
+        task = asyncio.create_task(policy.call_async(hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert policy.call(succeed) == "ok"
+
+def test_breaker_closes_after_fake_server_recovers(fake_server, fake_client):
+    policy = get_policy()
+    fake_server.model.error_rate = 1.0
+
+    def call():
+        return asyncio.run(call_model(fake_client, "fake", "comment"))
+
+    with pytest.raises(Exception) as error:
+        policy.call(call)
+    assert error.value.status_code == 500
+    time.sleep(RESET_TIMEOUT)
+    with pytest.raises(Exception) as error:
+        policy.call(call)
+    assert error.value.status_code == 500
+    with pytest.raises(CircuitOpenError):
+        policy.call(call)
+
+    fake_server.model.error_rate = 0.0
+    time.sleep(RESET_TIMEOUT)
+    assert policy.call(call).choices[0].message.content
+    assert policy.call(call).choices[0].message.content
+
+def test_retries_acquire_the_rate_limiter(fake_server, fake_client, monkeypatch):
+    # Each call draws its failure, then its latency: every other call fails,
+    # so each request needs one retry
+    draws = iter([0.0, 1.0, 1.0, 1.0]*10)
+    fake_server.model.error_rate = 0.5
+    monkeypatch.setattr(fake_server.model.rng, 'random', lambda: next(draws))
+    acquired = []
+    acquire = RateLimiter.acquire
+    async def counting_acquire(self, tokens):
+        acquired.append(tokens)
+        await acquire(self, tokens)
+    monkeypatch.setattr(RateLimiter, 'acquire', counting_acquire)
+
+    requests = [{'key': i, 'content': "comment {}".format(i)} for i in range(3)]
+    results, stats = asyncio.run(run_requests_async(fake_client, requests, "fake", max_concurrency=1,
+                                                    requests_per_minute=100, retry=get_policy()))
+    assert stats['succeeded'] == 3
+    assert stats['retries'] == 3
+    assert len(acquired) == 6
@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from feedback import watermark
+from feedback.fr_feedback import all_tasks, get_new_feedback_query
+from feedback.watermark import advance_watermark, get_lower_bound, get_unprocessed_feedback
+
+EMPTY_WATERMARK = {'published_at': None, 'processed_ids': {}}
+
+def get_feedbacks(ids, published_at):
+    return pd.DataFrame({'id': ids, 'owner_type': 'Rescue', 'published_at': pd.to_datetime(published_at)})
+
+def test_first_run_needs_a_start_date():
+    with pytest.raises(Exception):
+        get_lower_bound(EMPTY_WATERMARK, None, 7)
+    assert get_lower_bound(EMPTY_WATERMARK, '2024-01-01', 7) == '2024-01-01'
+
+def test_advance_watermark_looks_back_and_forgets_old_ids():
+    new = advance_watermark(EMPTY_WATERMARK, get_feedbacks([1, 2], ['2024-01-01', '2024-01-20']), lookback_days=7)
+    assert new['published_at'] == '2024-01-20 00:00:00'
+    assert list(new['processed_ids']) == ['2'], "ids before the lookback window are never scanned again"
+    assert get_lower_bound(new, None, 7) == '2024-01-13 00:00:00'
+
+def test_processed_ids_are_skipped(monkeypatch):
+    fetched = get_feedbacks([1, 2, 3], ['2024-01-18', '2024-01-19', '2024-01-20'])
+    monkeypatch.setattr(watermark, 'get_new_feedback', lambda conn, since, end_date: fetched)
+    current = advance_watermark(EMPTY_WATERMARK, fetched[fetched['id'] != 2])
+    assert list(get_unprocessed_feedback(None, current, None)['id']) == [2]
+
+def test_rescues_missing_a_label_are_fetched_again():
+    query = get_new_feedback_query()
+    not_exists = query[query.index("NOT EXISTS"):]
+    not_exists = not_exists[:not_exists.index(")")]
+    for task in all_tasks:
+        assert "rf.{} IS NOT NULL".format(task) in not_exists
+    assert "%(end_date)s" not in query
+    assert "ds.published_at <= %(end_date)s" in get_new_feedback_query('2024-02-01')